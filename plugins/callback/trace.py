@@ -12,14 +12,68 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+from ansible import context
 from ansible.plugins.callback import CallbackBase
-from typing import Dict, TextIO
+from typing import Deque, Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
 from datetime import datetime
 from dataclasses import dataclass
 import time
 import os
 import json
 import atexit
+import hashlib
+import importlib.util
+import re
+import socket
+import sys
+import threading
+import uuid
+import zlib
+
+try:
+    from ansible_collections.mhansen.ansible_trace.plugins.module_utils.trace_live import (
+        LiveTraceServer)
+    from ansible_collections.mhansen.ansible_trace.plugins.module_utils.trace_otlp import (
+        OtlpTraceWriter)
+    from ansible_collections.mhansen.ansible_trace.plugins.module_utils.trace_profiling import (
+        ControllerProfiler, ControllerSampler)
+    from ansible_collections.mhansen.ansible_trace.plugins.module_utils.trace_stats import (
+        TaskStats)
+    from ansible_collections.mhansen.ansible_trace.plugins.module_utils.trace_writers import (
+        HAS_SQLITE3, HAS_ZSTANDARD, JsonTraceWriter, PeriodicFlusher,
+        ProtobufTraceWriter, SqliteTraceWriter, TeeWriter)
+except ImportError:
+    # Loaded from a callback_plugins directory rather than the installed
+    # collection, as the integration tests do. Load module_utils from the
+    # files next to this plugin under private names, so that neither
+    # sys.path nor the names other packages import are changed.
+    def _load_module_utils(name):
+        module_name = 'ansible_trace_module_utils_' + name
+        module = sys.modules.get(module_name)
+        if module is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'module_utils', name + '.py')
+            spec = importlib.util.spec_from_file_location(module_name, path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[module_name] = module
+            spec.loader.exec_module(module)
+        return module
+
+    LiveTraceServer = _load_module_utils('trace_live').LiveTraceServer
+    OtlpTraceWriter = _load_module_utils('trace_otlp').OtlpTraceWriter
+    _trace_profiling = _load_module_utils('trace_profiling')
+    ControllerProfiler = _trace_profiling.ControllerProfiler
+    ControllerSampler = _trace_profiling.ControllerSampler
+    TaskStats = _load_module_utils('trace_stats').TaskStats
+    _trace_writers = _load_module_utils('trace_writers')
+    HAS_SQLITE3 = _trace_writers.HAS_SQLITE3
+    HAS_ZSTANDARD = _trace_writers.HAS_ZSTANDARD
+    JsonTraceWriter = _trace_writers.JsonTraceWriter
+    PeriodicFlusher = _trace_writers.PeriodicFlusher
+    ProtobufTraceWriter = _trace_writers.ProtobufTraceWriter
+    SqliteTraceWriter = _trace_writers.SqliteTraceWriter
+    TeeWriter = _trace_writers.TeeWriter
 
 DOCUMENTATION = '''
     name: trace
@@ -41,6 +95,243 @@ DOCUMENTATION = '''
         description: Hide the arguments for a task
         env:
           - name: HIDE_TASK_ARGUMENTS
+      flush_interval:
+        name: Flush interval
+        default: 1.0
+        description:
+          - Maximum number of seconds between flushes of trace files,
+            commits of the SQLite database and OTLP export batches, including
+            while a long task writes no events. Events are written to the
+            operating system in between only when a buffer fills up.
+        env:
+          - name: TRACE_FLUSH_INTERVAL
+      compact:
+        name: Compact output
+        default: False
+        description:
+          - Write each span as a single complete event with a duration when it
+            ends, instead of separate begin and end events, and write JSON
+            without indentation. Open spans are kept in memory until they end.
+        env:
+          - name: TRACE_COMPACT
+      format:
+        name: Output formats
+        default: json
+        description:
+          - Comma separated list of formats to write. C(json) writes Trace
+            Event Format JSON to trace-<timestamp>.json. C(protobuf) writes a
+            Perfetto protobuf trace, with names, paths and hosts interned, to
+            trace-<timestamp>.pftrace. C(sqlite) adds the run's spans to a
+            SQLite database shared by all runs, see sqlite_database. C(otlp)
+            exports spans to an OpenTelemetry collector, see otlp_endpoint.
+        env:
+          - name: TRACE_FORMAT
+      sqlite_database:
+        name: SQLite database
+        default: <output dir>/trace.db
+        description:
+          - SQLite database the C(sqlite) format adds runs to, with tables of
+            runs, plays, hosts, tasks and spans, indexed by task path, host
+            and start time, for queries across runs. Spans are inserted in
+            batched transactions, committed at most every flush_interval
+            seconds.
+        env:
+          - name: TRACE_SQLITE_DATABASE
+      otlp_endpoint:
+        name: OTLP endpoint
+        default: http://localhost:4318/v1/traces
+        description:
+          - OTLP/HTTP traces endpoint the C(otlp) format exports spans to, as
+            JSON, in batches, from a background thread. The run is one trace,
+            with spans for the run, its plays, each play on each host, tasks,
+            loop items, async jobs and remote execution.
+          - The trace id and the parent of the run's span are taken from the
+            W3C traceparent in the TRACEPARENT environment variable, if set,
+            e.g. by a CI job. The service name is OTEL_SERVICE_NAME, or
+            ansible.
+        env:
+          - name: TRACE_OTLP_ENDPOINT
+          - name: OTEL_EXPORTER_OTLP_TRACES_ENDPOINT
+      otlp_headers:
+        name: OTLP request headers
+        default: ''
+        description:
+          - Comma separated key=value headers to send to the OTLP endpoint,
+            e.g. for authentication.
+        env:
+          - name: TRACE_OTLP_HEADERS
+          - name: OTEL_EXPORTER_OTLP_HEADERS
+      otlp_spill_file:
+        name: OTLP spill file
+        default: <output dir>/trace-<timestamp>.otlp.jsonl
+        description:
+          - File the C(otlp) format appends spans to when the collector can't
+            be reached after retrying with backoff. Each line is an OTLP/JSON
+            request, which can be sent to the endpoint later. Spans written
+            while the export queue is full are dropped, with a warning.
+        env:
+          - name: TRACE_OTLP_SPILL_FILE
+      compression:
+        name: Output compression
+        default: none
+        description:
+          - Compress trace files as they are written. C(gzip) appends .gz to
+            the file names, C(zstd) appends .zst and needs the zstandard
+            Python package, falling back to gzip without it.
+          - Compressed files are flushed at most every flush_interval seconds,
+            and each flush ends a compressed block, so in-progress files can
+            be decompressed up to the last flush.
+        env:
+          - name: TRACE_COMPRESSION
+      deduplicate_task_arguments:
+        name: Deduplicate task arguments
+        default: False
+        description:
+          - Write each distinct set of arguments of a task once, as a
+            task_args metadata event, and refer to it from the task's spans
+            with an args_ref key, instead of repeating the arguments in the
+            span of every host.
+        env:
+          - name: TRACE_DEDUPLICATE_TASK_ARGUMENTS
+      counters:
+        name: Concurrency counters
+        default: False
+        description:
+          - Write counter events on a controller process, tracking the number
+            of tasks in flight, the number of hosts running a task, completed
+            tasks per second and the number of forks.
+        env:
+          - name: TRACE_COUNTERS
+      counter_interval:
+        name: Counter interval
+        default: 0.1
+        description:
+          - Minimum number of seconds between counter events.
+        env:
+          - name: TRACE_COUNTER_INTERVAL
+      sample_controller:
+        name: Sample controller resources
+        default: False
+        description:
+          - Sample the controller's CPU usage, memory and load average, and
+            those of its worker processes, from a background thread, and write
+            them as counters on the controller process. Needs /proc (Linux).
+        env:
+          - name: TRACE_SAMPLE_CONTROLLER
+      sample_interval:
+        name: Controller sample interval
+        default: 1.0
+        description:
+          - Number of seconds between samples of controller resources.
+        env:
+          - name: TRACE_SAMPLE_INTERVAL
+      profile_controller:
+        name: Profile the controller
+        default: False
+        description:
+          - Sample the Python stack of the controller's main thread from a
+            background thread, and write it as nested slices on the
+            controller process. Consecutive samples with the same frames are
+            merged into one slice.
+        env:
+          - name: TRACE_PROFILE_CONTROLLER
+      profile_interval:
+        name: Profiler sample interval
+        default: 0.01
+        description:
+          - Number of seconds between samples of the controller's stack.
+        env:
+          - name: TRACE_PROFILE_INTERVAL
+      remote_time:
+        name: Split remote execution time
+        default: False
+        description:
+          - For results with remote timing (start and end, or delta, as
+            returned by command, shell and async jobs), split the task's span
+            into nested remote execution and overhead spans, and add the
+            totals to the span. Per task totals across hosts are written as
+            task_overhead metadata events at the end of each play.
+          - Remote timestamps that don't fall within the span, e.g. because
+            of clock skew, are ignored, and the remote execution is placed at
+            the end of the span.
+        env:
+          - name: TRACE_REMOTE_TIME
+      item_spans:
+        name: Loop item spans
+        default: True
+        description:
+          - Write a span for each item of a looped task, nested in the task's
+            span, from the previous item's result (or the start of the task)
+            to the item's result.
+        env:
+          - name: TRACE_ITEM_SPANS
+      async_spans:
+        name: Async job spans
+        default: True
+        description:
+          - Write a span for each async job. Polled jobs (poll greater than
+            0) are nested in their task's span, from the start of the task to
+            its final poll, with an instant event for each poll.
+          - Jobs left running (poll 0) outlive their task, so they are async
+            events on a track of their own, from the start of the task that
+            launched them until an async_status task finds them finished,
+            with an instant event for each async_status retry.
+        env:
+          - name: TRACE_ASYNC_SPANS
+      host_sample_rate:
+        name: Fraction of hosts to trace
+        default: 1.0
+        description:
+          - Fraction of hosts whose spans are written, between 0 and 1.
+            Hosts are chosen by a hash of their name, so the same hosts are
+            traced in every run.
+          - Below 1, the duration of each task on every host, traced or not,
+            is summarised in a task_stats metadata event at the end of each
+            play, with its count, minimum, mean, maximum and percentiles, and
+            a mergeable quantile sketch.
+        env:
+          - name: TRACE_HOST_SAMPLE_RATE
+      run_id:
+        name: Run id
+        default: a random id
+        description:
+          - Id of the run, written with the shard id in the trace_info
+            metadata event at the start of the trace. Set the same run id in
+            each controller running a part of the same deployment, e.g. an
+            inventory slice or an AWX job slice, to merge their traces with
+            tools/trace_merge.py.
+        env:
+          - name: TRACE_RUN_ID
+      shard_id:
+        name: Shard id
+        default: ''
+        description:
+          - Id of this controller's part of the run. It's added to the names
+            of the trace files, so controllers can share an output
+            directory.
+        env:
+          - name: TRACE_SHARD_ID
+      live_address:
+        name: Live event server address
+        default: ''
+        description:
+          - Serve the events of the run as they are written, from a local
+            HTTP server on this address, as [host]:port (the host defaults
+            to 127.0.0.1), or on a Unix socket, as unix:PATH.
+          - GET /events streams events as server-sent events. GET /summary
+            returns the hosts and tasks in flight, the progress of each
+            play and the tasks that have been running the longest, as JSON.
+        env:
+          - name: TRACE_LIVE_ADDRESS
+      live_buffer_size:
+        name: Live event buffer per client
+        default: 10000
+        description:
+          - Number of events buffered for each client of the live server.
+            Clients that fall further behind skip the oldest events, rather
+            than slowing down the run.
+        env:
+          - name: TRACE_LIVE_BUFFER_SIZE
     requirements:
       - enable in configuration
 '''
@@ -55,6 +346,58 @@ class CallbackModule(CallbackBase):
                                      Default: ./trace
         TRACE_HIDE_TASK_ARGUMENTS (optional): Hide the arguments for a task
                                      Default: False
+        TRACE_FLUSH_INTERVAL (optional): Seconds between flushes of output
+                                     Default: 1.0
+        TRACE_COMPACT (optional): Write complete events and compact JSON
+                                     Default: False
+        TRACE_FORMAT (optional): Comma separated output formats: json,
+                                     protobuf, sqlite, otlp
+                                     Default: json
+        TRACE_SQLITE_DATABASE (optional): Database the sqlite format writes to
+                                     Default: <TRACE_OUTPUT_DIR>/trace.db
+        TRACE_OTLP_ENDPOINT (optional): OTLP/HTTP endpoint the otlp format
+                                     exports to
+                                     Default: http://localhost:4318/v1/traces
+        TRACE_OTLP_HEADERS (optional): Headers to send to the OTLP endpoint
+                                     Default: none
+        TRACE_OTLP_SPILL_FILE (optional): File spans that couldn't be exported
+                                     are appended to
+                                     Default: <TRACE_OUTPUT_DIR>/trace-<timestamp>.otlp.jsonl
+        TRACEPARENT (optional): W3C traceparent the run's OTLP span is a child of
+                                     Default: none
+        TRACE_COMPRESSION (optional): Compress output: none, gzip or zstd
+                                     Default: none
+        TRACE_DEDUPLICATE_TASK_ARGUMENTS (optional): Write task arguments once
+                                     Default: False
+        TRACE_COUNTERS (optional): Write concurrency counters
+                                     Default: False
+        TRACE_COUNTER_INTERVAL (optional): Seconds between counter events
+                                     Default: 0.1
+        TRACE_SAMPLE_CONTROLLER (optional): Sample controller CPU, RSS and load
+                                     Default: False
+        TRACE_SAMPLE_INTERVAL (optional): Seconds between controller samples
+                                     Default: 1.0
+        TRACE_PROFILE_CONTROLLER (optional): Sample the controller's Python stack
+                                     Default: False
+        TRACE_PROFILE_INTERVAL (optional): Seconds between stack samples
+                                     Default: 0.01
+        TRACE_REMOTE_TIME (optional): Split spans into remote time and overhead
+                                     Default: False
+        TRACE_ITEM_SPANS (optional): Write spans for loop items
+                                     Default: True
+        TRACE_ASYNC_SPANS (optional): Write spans for async jobs
+                                     Default: True
+        TRACE_HOST_SAMPLE_RATE (optional): Fraction of hosts to write spans of
+                                     Default: 1.0
+        TRACE_RUN_ID (optional): Id of the run this trace is a shard of
+                                     Default: a random id
+        TRACE_SHARD_ID (optional): Id of this trace's shard of the run
+                                     Default: none
+        TRACE_LIVE_ADDRESS (optional): Serve events live on [host]:port or
+                                     unix:PATH
+                                     Default: none
+        TRACE_LIVE_BUFFER_SIZE (optional): Events buffered per live client
+                                     Default: 10000
     """
 
     CALLBACK_VERSION = 2.0
@@ -69,44 +412,388 @@ class CallbackModule(CallbackBase):
             'TRACE_OUTPUT_DIR', os.path.join(os.path.expanduser('.'), 'trace'))
         self._hide_task_arguments: str = os.getenv(
             'TRACE_HIDE_TASK_ARGUMENTS', 'False').lower()
-        self._hosts: Dict[Host] = {}
+        self._flush_interval: float = float(
+            os.getenv('TRACE_FLUSH_INTERVAL', '1.0'))
+        self._compact: bool = _getenv_bool('TRACE_COMPACT')
+        self._formats: List[str] = [
+            f.strip().lower()
+            for f in os.getenv('TRACE_FORMAT', 'json').split(',') if f.strip()]
+        self._compression: str = os.getenv('TRACE_COMPRESSION', 'none').lower()
+        self._sqlite_database: str = os.getenv(
+            'TRACE_SQLITE_DATABASE', os.path.join(self._output_dir, 'trace.db'))
+        self._otlp_endpoint: str = (
+            os.getenv('TRACE_OTLP_ENDPOINT')
+            or os.getenv('OTEL_EXPORTER_OTLP_TRACES_ENDPOINT')
+            or 'http://localhost:4318/v1/traces')
+        self._otlp_headers: Dict[str, str] = {}
+        for header in os.getenv('TRACE_OTLP_HEADERS',
+                                os.getenv('OTEL_EXPORTER_OTLP_HEADERS', '')).split(','):
+            key, _, value = header.partition('=')
+            if key.strip():
+                self._otlp_headers[key.strip()] = value.strip()
+        self._otlp_writer: Optional[OtlpTraceWriter] = None
+        if self._compression not in ('none', 'gzip', 'zstd'):
+            self._display.warning(
+                'trace: unknown TRACE_COMPRESSION %s, writing uncompressed'
+                % self._compression)
+            self._compression = 'none'
+        if self._compression == 'zstd' and not HAS_ZSTANDARD:
+            self._display.warning(
+                'trace: zstandard is not installed, compressing with gzip')
+            self._compression = 'gzip'
+        self._last_flush: float = time.monotonic()
+        self._unflushed: bool = False
+        self._flusher: Optional[PeriodicFlusher] = None
+        self._deduplicate_task_arguments: bool = _getenv_bool(
+            'TRACE_DEDUPLICATE_TASK_ARGUMENTS')
+        # Keys of task_args records already written, by task uuid and then
+        # fingerprint, forgotten along with the task's name.
+        self._task_args: Dict[str, Dict[str, int]] = {}
+        self._next_task_args_ref: int = 1
+        self._counters: bool = _getenv_bool('TRACE_COUNTERS')
+        self._counter_interval: float = float(
+            os.getenv('TRACE_COUNTER_INTERVAL', '0.1'))
+        self._counters_written_at: Optional[float] = None
+        # End timestamps of the runner spans that ended in the last second.
+        self._recently_completed: Deque[float] = deque()
+        self._controller_pid: Optional[int] = None
+        self._sample_controller: bool = _getenv_bool('TRACE_SAMPLE_CONTROLLER')
+        self._sample_interval: float = float(
+            os.getenv('TRACE_SAMPLE_INTERVAL', '1.0'))
+        self._sampler: Optional[ControllerSampler] = None
+        if self._sample_controller and not os.path.exists('/proc/self/stat'):
+            self._display.warning(
+                'trace: /proc is not available, not sampling the controller')
+            self._sample_controller = False
+        self._profile_controller: bool = _getenv_bool('TRACE_PROFILE_CONTROLLER')
+        self._profile_interval: float = float(
+            os.getenv('TRACE_PROFILE_INTERVAL', '0.01'))
+        self._profiler: Optional[ControllerProfiler] = None
+        self._remote_time: bool = _getenv_bool('TRACE_REMOTE_TIME')
+        # Remote execution and overhead totals of the current play's tasks.
+        self._task_overhead: Dict[str, TaskOverhead] = {}
+        self._item_spans: bool = _getenv_bool('TRACE_ITEM_SPANS', True)
+        # Loop item and async job callbacks come from the strategy's results
+        # thread, so the state they share with the main thread is guarded
+        # by _runner_lock: they only read _runners, never _open_spans.
+        self._runner_lock = threading.Lock()
+        # The task uuid and span of each host's running task, by host uuid.
+        self._runners: Dict[str, Tuple[str, Span]] = {}
+        # Where the next loop item's span starts, and how many items have
+        # ended, by (host, task) uuid.
+        self._loop_items: Dict[Tuple[str, str], Tuple[float, int]] = {}
+        self._async_spans: bool = _getenv_bool('TRACE_ASYNC_SPANS', True)
+        # Polled async jobs, by (host uuid, job id): the poll results don't
+        # refer to the task.
+        self._async_jobs: Dict[Tuple[str, str], Span] = {}
+        # Jobs left running by tasks with poll: 0, by (host uuid, job id),
+        # until an async_status task finds them finished.
+        self._background_jobs: Dict[Tuple[str, str], Span] = {}
+        # (host, task) uuids of tasks whose async job span has ended.
+        self._async_tasks: set = set()
+        self._host_sample_rate: float = float(
+            os.getenv('TRACE_HOST_SAMPLE_RATE', '1.0'))
+        # Start, name and path of the tasks running on hosts that aren't
+        # traced, by (host, task) uuid.
+        self._unsampled_runs: Dict[Tuple[str, str], Tuple[float, str, str]] = {}
+        # Durations of the current play's tasks on all hosts, by (path, name).
+        self._task_stats: Dict[Tuple[str, str], TaskStats] = {}
+        # Events are written from the sampler and profiler threads too.
+        self._write_lock = threading.Lock()
+        # Hosts that have run a task in the current or previous play.
+        self._hosts: Dict[str, Host] = {}
+        # Pids of every host seen, by name, so hosts that sat out a play keep
+        # their process when they come back. Only a few bytes per host.
+        self._host_pids: Dict[str, int] = {}
         self._next_pid: int = 1
-        self._first: bool = True
         self._start_date: str = datetime.now().isoformat()
-        self._output_file: str = 'trace-%s.json' % self._start_date
+        self._run_id: str = os.getenv('TRACE_RUN_ID') or uuid.uuid4().hex
+        self._shard_id: str = os.getenv('TRACE_SHARD_ID', '')
+        # Shards of a run can start at the same time, so their files are
+        # told apart by the shard.
+        self._trace_name: str = 'trace-%s' % self._start_date
+        if self._shard_id:
+            self._trace_name += '-' + re.sub(r'[^\w.-]', '_', self._shard_id)
+        self._output_file: str = self._trace_name + '.json'
         self._current_play: str = ''
         self._play_id: int = 0
-        self._tasks: Dict[str] = {}
+        # Names of the most recently started tasks, by uuid. Includes in
+        # loops create new tasks for every iteration, so older names are
+        # forgotten, and templated again if their task runs again.
+        self._tasks: 'OrderedDict[str, str]' = OrderedDict()
+        # Runner spans that have started but not ended, by (host, task) uuid.
+        self._open_spans: Dict[Tuple[str, str], Span] = {}
+        # Uuids of the remembered tasks that are handlers.
+        self._handler_tasks: set = set()
+        # Handlers or topics notified by each host's task runs since its
+        # handlers last ran, by host uuid.
+        self._notifications: Dict[str, List[Tuple[str, FlowSource]]] = {}
+        # Task runs that notified each host's handlers, by (host, handler)
+        # uuid, until the handler runs.
+        self._notified: Dict[Tuple[str, str], List[FlowSource]] = {}
+        # Include task runs, by (host, task) uuid, until they're loaded.
+        self._include_runs: Dict[Tuple[str, str], FlowSource] = {}
+        # Include task runs whose tasks were loaded, by (host, task) uuid.
+        self._includes: Dict[Tuple[str, str], FlowSource] = {}
+        self._next_flow_id: int = 1
 
         if not os.path.exists(self._output_dir):
             os.makedirs(self._output_dir)
-        output_file = os.path.join(self._output_dir, self._output_file)
-        self._f: TextIO = open(output_file, 'w')
-        self._f.write("[\n")
+        writers: List = []
+        for output_format in self._formats:
+            if output_format == 'json':
+                writers.append(JsonTraceWriter(
+                    os.path.join(self._output_dir, self._output_file),
+                    compact=self._compact, compression=self._compression))
+            elif output_format == 'protobuf':
+                writers.append(ProtobufTraceWriter(
+                    os.path.join(
+                        self._output_dir, self._trace_name + '.pftrace'),
+                    compression=self._compression))
+            elif output_format == 'sqlite':
+                if not HAS_SQLITE3:
+                    self._display.warning(
+                        'trace: sqlite3 is not available, not writing TRACE_FORMAT sqlite')
+                    continue
+                writers.append(SqliteTraceWriter(
+                    self._sqlite_database, self._trace_name,
+                    started_at=self._start_date,
+                    commit_interval=self._flush_interval))
+            elif output_format == 'otlp':
+                self._otlp_writer = OtlpTraceWriter(
+                    self._otlp_endpoint,
+                    os.getenv('TRACE_OTLP_SPILL_FILE', os.path.join(
+                        self._output_dir, self._trace_name + '.otlp.jsonl')),
+                    service_name=os.getenv('OTEL_SERVICE_NAME', 'ansible'),
+                    traceparent=os.getenv('TRACEPARENT'),
+                    headers=self._otlp_headers,
+                    flush_interval=self._flush_interval)
+                writers.append(self._otlp_writer)
+            else:
+                self._display.warning(
+                    'trace: ignoring unknown TRACE_FORMAT %s' % output_format)
+        self._live_address: str = os.getenv('TRACE_LIVE_ADDRESS', '')
+        self._live_server: Optional[LiveTraceServer] = None
+        if self._live_address:
+            try:
+                self._live_server = LiveTraceServer(
+                    self._live_address, _now_us,
+                    int(os.getenv('TRACE_LIVE_BUFFER_SIZE', '10000')))
+            except (OSError, ValueError) as e:
+                self._display.warning(
+                    'trace: not serving live events on %s: %s'
+                    % (self._live_address, e))
+            else:
+                writers.append(self._live_server)
+                self._display.display(
+                    'trace: serving live events on %s' % self._live_server.url)
+        if len(writers) == 1:
+            self._writer = writers[0]
+        else:
+            self._writer = TeeWriter(writers)
+
+        self._write_event({
+            "name": "trace_info",
+            "pid": 0,
+            "cat": "trace_info",
+            "ph": "M",
+            "args": {
+                "run_id": self._run_id,
+                "shard_id": self._shard_id or None,
+                "started_at": self._start_date,
+                "controller": socket.gethostname(),
+                "controller_pid": os.getpid(),
+                "time_origin_unix_us": _CLOCK.origin_unix_us,
+            },
+        })
+
+        if self._flush_interval > 0:
+            # Otherwise every event is flushed as it is written.
+            self._flusher = PeriodicFlusher(
+                self._flush_pending, self._flush_interval)
+        if self._counters or self._sample_controller or self._profile_controller:
+            self._controller_pid = self._start_controller_process()
+        if self._sample_controller:
+            self._sampler = ControllerSampler(
+                self._write_event, self._controller_pid, self._sample_interval,
+                _now_us)
+        if self._profile_controller:
+            self._profiler = ControllerProfiler(
+                self._write_events, self._controller_pid, self._profile_interval,
+                _now_us)
 
         atexit.register(self._end)
 
      # Permits to handle interpolation in task name in linear strategy
     def v2_playbook_on_task_start(self, task, is_conditional):
-        self._tasks[task._uuid] = task.get_name().strip()
+        self._remember_task(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._remember_task(task)
+        self._handler_tasks.add(task._uuid)
+
+    def _remember_task(self, task) -> str:
+        name = task.get_name().strip()
+        self._tasks[task._uuid] = name
+        self._tasks.move_to_end(task._uuid)
+        while len(self._tasks) > TASK_CACHE_SIZE:
+            uuid, _ = self._tasks.popitem(last=False)
+            self._task_args.pop(uuid, None)
+            self._handler_tasks.discard(uuid)
+        return name
+
+    def _task_name(self, task) -> str:
+        name = self._tasks.get(task._uuid)
+        if name is None:
+            return self._remember_task(task)
+        self._tasks.move_to_end(task._uuid)
+        return name
 
     def _write_event(self, e: Dict):
-        if not self._first:
-            self._f.write(",\n")
-        self._first = False
-        # sort for reproducibility
-        json.dump(e, self._f, sort_keys=True, indent=2)
-        self._f.flush()
+        with self._write_lock:
+            self._writer.write(e)
+            self._unflushed = True
+            # Flushing every event would cost a system call per event on the
+            # main thread, and for compressed files end a compressed block
+            # each time, undoing most of the compression.
+            if self._flush_due():
+                self._flush()
+
+    def _write_events(self, events: List[Dict]):
+        # For writers on other threads with many events at once, like the
+        # profiler, so they hold up the main thread for one lock, not each.
+        with self._write_lock:
+            for e in events:
+                self._writer.write(e)
+            self._unflushed = True
+            if self._flush_due():
+                self._flush()
+
+    def _flush_due(self) -> bool:
+        return time.monotonic() - self._last_flush >= self._flush_interval
+
+    def _flush(self):
+        # Called with the write lock held.
+        self._writer.flush()
+        self._unflushed = False
+        self._last_flush = time.monotonic()
+
+    def _flush_pending(self):
+        # Events written during a long task would otherwise stay in the
+        # compressor or an uncommitted transaction until the next event.
+        with self._write_lock:
+            if self._unflushed and self._flush_due():
+                self._flush()
+
+    def _start_controller_process(self) -> int:
+        # A process for tracks about the controller itself, rather than a host.
+        pid = self._next_pid
+        self._next_pid += 1
+        self._write_event({
+            "name": "process_name",
+            "pid": pid,
+            "cat": "controller",
+            "ph": "M",
+            "args": {
+                "name": "controller",
+            },
+        })
+        return pid
+
+    def _write_counters(self, force: bool = False):
+        if not self._counters:
+            return
+        now = _now_us()
+        last = self._counters_written_at
+        if not force and last is not None and now - last < self._counter_interval * 1e6:
+            return
+        while self._recently_completed and self._recently_completed[0] <= now - 1e6:
+            self._recently_completed.popleft()
+        values = {
+            "in_flight": len(self._open_spans) + len(self._unsampled_runs),
+            "active_hosts": len({host for host, _ in self._open_spans}
+                                | {host for host, _ in self._unsampled_runs}),
+            "completed_per_second": len(self._recently_completed),
+        }
+        forks = context.CLIARGS.get('forks')
+        if forks:
+            values["forks"] = forks
+        # See "Counter Events" in:
+        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview#heading=h.msg3086636uq
+        self._write_event({
+            "name": "concurrency",
+            "cat": "counters",
+            "ph": "C",
+            "ts": now,
+            "pid": self._controller_pid,
+            "args": values,
+        })
+        self._counters_written_at = now
+
+    def _begin_span(self, span: 'Span'):
+        if self._compact:
+            # Written as a complete event by _finish_span.
+            return
+        # See "Duration Events" in:
+        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview#heading=h.nso4gcezn7n1
+        e = {
+            "name": span.name,
+            "cat": span.cat,
+            "ph": "B",  # Begin
+            "ts": span.ts,
+            "pid": span.pid,
+            "id": span.id,
+        }
+        if span.args is not None:
+            e["args"] = span.args
+        self._write_event(e)
+
+    def _finish_span(self, span: 'Span', ts: int, args: Optional[Dict] = None):
+        if self._compact:
+            # See "Complete Events" in:
+            # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview#heading=h.lpfof2aylapb
+            e = {
+                "name": span.name,
+                "cat": span.cat,
+                "ph": "X",  # Complete
+                "ts": span.ts,
+                "dur": ts - span.ts,
+                "pid": span.pid,
+                "id": span.id,
+            }
+            if span.args is not None or args is not None:
+                e["args"] = dict(span.args or {}, **(args or {}))
+            self._write_event(e)
+            return
+        e = {
+            "name": span.name,
+            "cat": span.cat,
+            "id": span.id,
+            "ph": "E",  # End
+            "ts": ts,
+            "pid": span.pid,
+        }
+        if args is not None:
+            e["args"] = args
+        self._write_event(e)
 
     def v2_playbook_on_play_start(self, play):
 
         self._end_play_span()
+        self._write_counters(force=True)
         self._current_play = play
         self._play_id += 1
 
     def v2_runner_on_start(self, host, task):
         uuid = task._uuid
-        name = self._tasks[uuid]
+        name = self._task_name(task)
+
+        if not self._host_sampled(host.name):
+            # Only timed, for the task's stats.
+            self._unsampled_runs[(host._uuid, uuid)] = (
+                _now_us(), name, task.get_path())
+            self._write_counters()
+            return
 
         args = None
         if not task.no_log and self._hide_task_arguments == 'false':
@@ -114,85 +801,518 @@ class CallbackModule(CallbackBase):
 
         host_uuid = host._uuid
         if host_uuid not in self._hosts:
-            pid = self._next_pid
-            self._hosts[host_uuid] = Host(pid=pid, name=host.name)
-            self._next_pid += 1
-            # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview#bookmark=id.iycbnb4z7i9g
+            self._add_host(host)
+
+        # If it's the first task of the host for the play, start duration event for the current play
+        if self._hosts[host_uuid].play_span is None:
+            play_span = Span(
+                name=self._current_play.get_name().strip(),
+                cat="play",
+                ts=_now_us(),
+                pid=self._hosts[host_uuid].pid,
+                id=self._play_id,
+                args={
+                    "host": host.name,
+                })
+            self._begin_span(play_span)
+            self._hosts[host_uuid].play_span = play_span
+
+        span_args = {
+            "args": args,
+            "task": name,
+            "path": task.get_path(),
+            "host": host.name,
+        }
+        if args is not None and self._deduplicate_task_arguments:
+            del span_args["args"]
+            span_args["args_ref"] = self._task_args_ref(
+                task, name, span_args["path"], args, self._hosts[host_uuid].pid)
+
+        cat = "runner"
+        flows: List[Tuple[str, FlowSource]] = []
+        if uuid in self._handler_tasks:
+            cat = "handler"
+            sources = self._notified.pop((host_uuid, uuid), [])
+            if sources:
+                span_args["notified_by"] = list(dict.fromkeys(
+                    source[2] for source in sources))
+                flows += [("notify", source) for source in sources]
+            # The host's handlers are being flushed, so notifications from
+            # now on are for the next flush.
+            self._notifications.pop(host_uuid, None)
+        include = _parent_include(task)
+        if include is not None and (host_uuid, include._uuid) in self._includes:
+            flows.append(("include", self._includes[(host_uuid, include._uuid)]))
+
+        span = Span(
+            name=name,
+            cat=cat,
+            ts=_now_us(),
+            pid=self._hosts[host_uuid].pid,
+            id=abs(hash(uuid)),
+            args=span_args)
+        self._open_spans[(host_uuid, uuid)] = span
+        with self._runner_lock:
+            self._runners[host_uuid] = (uuid, span)
+        self._begin_span(span)
+        for flow_name, source in flows:
+            self._write_flow(flow_name, source, span)
+        self._write_counters()
+
+    def _write_flow(self, name: str, source: 'FlowSource', span: 'Span'):
+        # An arrow from the span of the task run that led to span. Flow
+        # events bind to the span that encloses them on their process.
+        # See "Flow Events" in:
+        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview
+        flow_id = self._next_flow_id
+        self._next_flow_id += 1
+        pid, ts, _ = source
+        self._write_event({
+            "name": name,
+            "cat": "flow",
+            "ph": "s",  # Start
+            "ts": ts,
+            "pid": pid,
+            "id": flow_id,
+        })
+        self._write_event({
+            "name": name,
+            "cat": "flow",
+            "ph": "f",  # Finish
+            "bp": "e",  # Bound to the enclosing span, which starts at ts.
+            "ts": span.ts,
+            "pid": span.pid,
+            "id": flow_id,
+        })
+
+    def v2_playbook_on_notify(self, handler, host):
+        # Up to Ansible 2.13, every notifying task notifies its handlers
+        # before its result is processed, as running handlers still do. The
+        # span still open on the host is then the one that notified.
+        sources = [(span.pid, _now_us(), span.name)
+                   for (host_uuid, _), span in self._open_spans.items()
+                   if host_uuid == host._uuid]
+        if not sources:
+            # Later versions notify handlers when they're about to run, so the
+            # task runs that notified them were recorded as their results
+            # came in.
+            names = {handler.get_name(), getattr(handler, 'name', None)}
+            listen = getattr(handler, 'listen', None) or []
+            names.update([listen] if isinstance(listen, str) else listen)
+            sources = [source for name, source
+                       in self._notifications.get(host._uuid, [])
+                       if name in names]
+        notified = self._notified.setdefault((host._uuid, handler._uuid), [])
+        notified += [source for source in sources if source not in notified]
+
+    def v2_playbook_on_include(self, included_file):
+        task_uuid = included_file._task._uuid
+        for host in included_file._hosts:
+            source = self._include_runs.pop((host._uuid, task_uuid), None)
+            if source is not None:
+                self._includes[(host._uuid, task_uuid)] = source
+
+    def _remember_flow_sources(self, result, span: 'Span', end: int):
+        # Flows start mid-span, inside it rather than where it meets its
+        # parent or siblings.
+        source = (span.pid, span.ts + (end - span.ts) // 2, span.name)
+        key = (result._host._uuid, result._task._uuid)
+        action = getattr(result._task, 'action', None) or ''
+        if action.rsplit('.', 1)[-1] in INCLUDE_ACTIONS:
+            self._include_runs[key] = source
+        names = _notified_handlers(result._result, result._task)
+        if names:
+            self._notifications.setdefault(key[0], []).extend(
+                (name, source) for name in names)
+
+    def _host_sampled(self, name: str) -> bool:
+        if self._host_sample_rate >= 1.0:
+            return True
+        # A stable hash, unlike hash(), so runs trace the same hosts.
+        return zlib.crc32(name.encode('utf-8')) < self._host_sample_rate * 2**32
+
+    def _add_host(self, host):
+        pid = self._host_pids.get(host.name)
+        if pid is not None:
+            self._hosts[host._uuid] = Host(name=host.name, pid=pid)
+            return
+        pid = self._next_pid
+        self._hosts[host._uuid] = Host(name=host.name, pid=pid)
+        self._host_pids[host.name] = pid
+        self._next_pid += 1
+        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview#bookmark=id.iycbnb4z7i9g
+        self._write_event({
+            "name": "process_name",
+            "pid": pid,
+            "cat": "process",
+            "ph": "M",
+            "args": {
+                "name": host.name,
+            },
+        })
+
+    def _task_args_ref(self, task, name: str, path: str, args: Dict,
+                       pid: int) -> int:
+        # Arguments can be templated differently per host, so they're keyed
+        # by their content as well as the task.
+        encoded = json.dumps(args, sort_keys=True, default=str)
+        fingerprint = hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+        refs = self._task_args.setdefault(task._uuid, {})
+        ref = refs.get(fingerprint)
+        if ref is None:
+            ref = self._next_task_args_ref
+            self._next_task_args_ref += 1
+            refs[fingerprint] = ref
             self._write_event({
-                "name": "process_name",
+                "name": "task_args",
                 "pid": pid,
-                "cat": "process",
+                "cat": "task_args",
                 "ph": "M",
                 "args": {
-                    "name": host.name,
+                    "ref": ref,
+                    "task": name,
+                    "path": path,
+                    "args": args,
                 },
             })
+        return ref
 
-        # If it's the first task of the host for the play, start duration event for the current play
-        if not self._hosts[host_uuid].hasTaskInPlay:
+    def _end_play_span(self):
+        self._end_open_spans()
+        # Spawn ending play event for each play that are done and then reset flag
+        for host_uuid, host in list(self._hosts.items()):
+            if host.play_span is not None:
+                # Write end event
+                self._finish_span(host.play_span, _now_us())
+                host.play_span = None
+            else:
+                # The host sat out the play. Ephemeral hosts never come back,
+                # so only their pid is kept.
+                del self._hosts[host_uuid]
+
+        with self._runner_lock:
+            task_overhead, self._task_overhead = self._task_overhead, {}
+        for overhead in task_overhead.values():
             self._write_event({
-                "name": self._current_play.get_name().strip(),
-                "cat": "play",
-                "ph": "B",  # Begin
-                "ts": time.time_ns() / 1000 if "time_ns" in time.__dict__ else time.time() * 100000,
-                "pid": self._hosts[host_uuid].pid,
-                "id": self._play_id,
+                "name": "task_overhead",
+                "pid": 0,
+                "cat": "task_overhead",
+                "ph": "M",
                 "args": {
-                    "host": host.name,
+                    "task": overhead.name,
+                    "path": overhead.path,
+                    "hosts": overhead.hosts,
+                    "remote_us": overhead.remote,
+                    "overhead_us": overhead.overhead,
                 },
             })
-            self._hosts[host_uuid].hasTaskInPlay = True
 
-        # See "Duration Events" in:
-        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview#heading=h.nso4gcezn7n1
+        for stats in self._task_stats.values():
+            self._write_event({
+                "name": "task_stats",
+                "pid": 0,
+                "cat": "task_stats",
+                "ph": "M",
+                "args": stats.summary(
+                    self._current_play.get_name().strip(), self._host_sample_rate),
+            })
+        self._task_stats = {}
+
+    def _end_open_spans(self):
+        # Tasks whose hosts never returned a result, e.g. because the run
+        # was interrupted, end with their play so the trace stays balanced.
+        # Async job spans are nested in their runner spans, so end first.
+        end = _now_us()
+        with self._runner_lock:
+            async_jobs, self._async_jobs = self._async_jobs, {}
+            self._runners = {}
+            self._loop_items = {}
+            self._async_tasks = set()
+        for span in async_jobs.values():
+            self._finish_span(span, end, {"status": "unfinished"})
+        for span in self._open_spans.values():
+            self._finish_span(span, end, {"status": "unfinished"})
+        self._open_spans = {}
+        self._unsampled_runs = {}
+        self._notifications = {}
+        self._notified = {}
+        self._include_runs = {}
+        self._includes = {}
+
+    def _end_span(self, result, status: str):
+        key = (result._host._uuid, result._task._uuid)
+        span = self._open_spans.pop(key, None)
+        if span is None:
+            unsampled = self._unsampled_runs.pop(key, None)
+            if unsampled is not None:
+                start, name, path = unsampled
+                self._add_task_stats(name, path, _now_us() - start, status,
+                                     sampled=False)
+                if self._counters:
+                    self._recently_completed.append(_now_us())
+                self._write_counters()
+            # Otherwise the runner never started for this host, so there's
+            # nothing to end.
+            return
+        with self._runner_lock:
+            if self._runners.get(key[0], (None, None))[1] is span:
+                del self._runners[key[0]]
+            self._loop_items.pop(key, None)
+            async_ended = key in self._async_tasks
+            self._async_tasks.discard(key)
+        end = _now_us()
+        args = {
+            "status": status,
+        }
+        # An async job's remote time was split within the job's span.
+        if self._remote_time and not async_ended:
+            self._split_remote_time(result, span, span, end, args)
+        self._finish_span(span, end, args)
+        self._remember_flow_sources(result, span, end)
+        if self._async_spans:
+            self._track_background_job(result, span, end, status)
+        self._add_task_stats(span.name, span.args["path"], end - span.ts, status,
+                             sampled=True)
+        if self._counters:
+            self._recently_completed.append(_now_us())
+        self._write_counters()
+
+    def _add_task_stats(self, name: str, path: str, duration: float,
+                        status: str, sampled: bool):
+        if self._host_sample_rate >= 1.0:
+            return
+        stats = self._task_stats.get((path, name))
+        if stats is None:
+            stats = TaskStats(name=name, path=path)
+            self._task_stats[(path, name)] = stats
+        stats.add(duration, status, sampled)
+
+    def _split_remote_time(self, result, span: 'Span', runner: 'Span',
+                           end: int, args: Dict):
+        # Splits span, the runner span or an async job span within it.
+        remote = _remote_execution(result._result, span.ts, end)
+        if remote is None:
+            return
+        remote_start, remote_end = remote
+        uuid = result._task._uuid
+        children = [
+            ("overhead", "overhead", span.ts, remote_start),
+            ("remote execution", "remote", remote_start, remote_end),
+            ("overhead", "overhead", remote_end, end),
+        ]
+        for i, (name, cat, start, stop) in enumerate(children):
+            if stop <= start:
+                continue
+            child = Span(name=name, cat=cat, ts=start, pid=span.pid,
+                         id=abs(hash((uuid, i))))
+            self._begin_span(child)
+            self._finish_span(child, stop)
+
+        remote_us = remote_end - remote_start
+        overhead_us = (end - span.ts) - remote_us
+        args["remote_us"] = remote_us
+        args["overhead_us"] = overhead_us
+
+        with self._runner_lock:
+            overhead = self._task_overhead.get(uuid)
+            if overhead is None:
+                overhead = TaskOverhead(name=runner.name, path=runner.args["path"])
+                self._task_overhead[uuid] = overhead
+            overhead.hosts += 1
+            overhead.remote += remote_us
+            overhead.overhead += overhead_us
+
+    def _end_item_span(self, result, status: str):
+        if not self._item_spans:
+            return
+        key = (result._host._uuid, result._task._uuid)
+        end = _now_us()
+        with self._runner_lock:
+            task_uuid, runner = self._runners.get(key[0], (None, None))
+            if task_uuid != key[1]:
+                return
+            start, count = self._loop_items.get(key, (runner.ts, 0))
+            self._loop_items[key] = (end, count + 1)
+        if self._hide_task_arguments == 'false':
+            label = self._get_item_label(result._result)
+        else:
+            label = None
+        if label is None:
+            label = 'item %d' % count
+        elif not isinstance(label, str):
+            label = json.dumps(label, sort_keys=True, default=str)
+        item = Span(name=label[:100], cat="item", ts=start, pid=runner.pid,
+                    id=abs(hash((result._task._uuid, 'item', count))))
+        self._begin_span(item)
+        self._finish_span(item, end, {
+            "status": status,
+            "index": count,
+        })
+
+    def v2_runner_item_on_ok(self, result):
+        self._end_item_span(result, 'ok')
+
+    def v2_runner_item_on_failed(self, result):
+        self._end_item_span(result, 'failed')
+
+    def v2_runner_item_on_skipped(self, result):
+        self._end_item_span(result, 'skipped')
+
+    def _begin_async_span(self, host_uuid: str, jid: str, runner: 'Span') -> 'Span':
+        # The job was launched when its task started; polls only start after.
+        span = Span(name="async job %s" % jid, cat="async", ts=runner.ts,
+                    pid=runner.pid, id=abs(hash((host_uuid, jid))),
+                    args={"jid": jid})
+        self._begin_span(span)
+        return span
+
+    def _track_background_job(self, result, runner: 'Span', end: int, status: str):
+        # Jobs launched with poll: 0 run on after their task, so their spans
+        # would overlap the host's next tasks: they're async events, which
+        # get a track of their own.
+        # See "Async Events" in:
+        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview
+        jid = result._result.get('ansible_job_id')
+        if jid is None:
+            return
+        key = (result._host._uuid, jid)
+        action = getattr(result._task, 'action', None) or ''
+        if action.rsplit('.', 1)[-1] == 'async_status':
+            if not result._result.get('finished'):
+                return
+            with self._runner_lock:
+                job = self._background_jobs.pop(key, None)
+            if job is None:
+                return
+            args = {
+                "status": status,
+            }
+            job_end = end
+            remote = _remote_execution(result._result, job.ts, end)
+            if remote is not None:
+                # How long the finished job waited for async_status.
+                job_end = remote[1]
+                args["poll_wait_us"] = end - job_end
+            self._finish_async_event(job, job_end, args)
+        elif result._result.get('started') and not result._result.get('finished'):
+            job = Span(name="async job %s" % jid, cat="async", ts=runner.ts,
+                       pid=runner.pid, id=abs(hash(key)),
+                       args={"jid": jid, "task": runner.name})
+            self._begin_async_event(job)
+            with self._runner_lock:
+                self._background_jobs[key] = job
+
+    def _begin_async_event(self, span: 'Span'):
+        if self._compact:
+            # Written with the end, by _finish_async_event.
+            return
         self._write_event({
-            "name": name,
-            "cat": "runner",
-            "ph": "B",  # Begin
-            "ts": time.time_ns() / 1000 if "time_ns" in time.__dict__ else time.time() * 100000,
-            "pid": self._hosts[host_uuid].pid,
-            "id": abs(hash(uuid)),
-            "args": {
-                "args": args,
-                "task": name,
-                "path": task.get_path(),
-                "host": host.name,
-            },
+            "name": span.name,
+            "cat": span.cat,
+            "ph": "b",  # Async begin
+            "ts": span.ts,
+            "pid": span.pid,
+            "id": span.id,
+            "args": span.args,
         })
 
-    def _end_play_span(self):
-        # Spawn ending play event for each play that are done and then reset flag
-        for host in self._hosts.values():
-            if host.hasTaskInPlay:
-                # Write end event
-                self._write_event({
-                    "name": self._current_play.get_name().strip(),
-                    "cat": "play",
-                    "id": self._play_id,
-                    "ph": "E",  # End
-                    "ts": time.time_ns() / 1000 if "time_ns" in time.__dict__ else time.time() * 100000,
-                    "pid": host.pid,
-                })
+    def _finish_async_event(self, span: 'Span', ts: int, args: Dict):
+        if self._compact:
+            self._write_event({
+                "name": span.name,
+                "cat": span.cat,
+                "ph": "b",  # Async begin
+                "ts": span.ts,
+                "pid": span.pid,
+                "id": span.id,
+                "args": dict(span.args or {}, **args),
+            })
+        self._write_event({
+            "name": span.name,
+            "cat": span.cat,
+            "ph": "e",  # Async end
+            "ts": ts,
+            "pid": span.pid,
+            "id": span.id,
+            "args": args,
+        })
 
-                host.hasTaskInPlay = False
+    def v2_runner_retry(self, result):
+        # A retry of an async_status task checking on a background job.
+        if not self._async_spans:
+            return
+        jid = result._result.get('ansible_job_id')
+        with self._runner_lock:
+            job = self._background_jobs.get((result._host._uuid, jid))
+        if job is not None:
+            self._write_poll(job, jid)
 
-    def _end_span(self, result, status: str):
-        task = result._task
-        uuid = task._uuid
-        # See "Duration Events" in:
-        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview#heading=h.nso4gcezn7n1
+    def _write_poll(self, span: 'Span', jid: str):
         self._write_event({
-            "name": task.get_name().strip(),
-            "cat": "runner",
-            "id": abs(hash(uuid)),
-            "ph": "E",  # End
-            "ts": time.time_ns() / 1000 if "time_ns" in time.__dict__ else time.time() * 100000,
-            "pid": self._hosts[result._host._uuid].pid,
+            "name": "async poll",
+            "cat": "async",
+            "ph": "i",  # Instant
+            "s": "p",  # Process scope
+            "ts": _now_us(),
+            "pid": span.pid,
             "args": {
-                "status": status,
+                "jid": jid,
             },
         })
 
+    def v2_runner_on_async_poll(self, result):
+        if not self._async_spans:
+            return
+        # The result is for an implicit async_status task, so the job's
+        # task is found through the host's open runner span instead.
+        jid = result._result.get('ansible_job_id')
+        host_uuid = result._host._uuid
+        if jid is None:
+            return
+        with self._runner_lock:
+            span = self._async_jobs.get((host_uuid, jid))
+            if span is None:
+                if host_uuid not in self._runners:
+                    return
+                span = self._begin_async_span(
+                    host_uuid, jid, self._runners[host_uuid][1])
+                self._async_jobs[(host_uuid, jid)] = span
+        self._write_poll(span, jid)
+
+    def _end_async_span(self, result, status: str):
+        if not self._async_spans:
+            return
+        key = (result._host._uuid, result._task._uuid)
+        jid = result._result.get('ansible_job_id')
+        if jid is None:
+            return
+        with self._runner_lock:
+            task_uuid, runner = self._runners.get(key[0], (None, None))
+            if task_uuid != key[1]:
+                return
+            span = self._async_jobs.pop((key[0], jid), None)
+            self._async_tasks.add(key)
+        if span is None:
+            # The job finished by the first poll.
+            span = self._begin_async_span(key[0], jid, runner)
+        end = _now_us()
+        args = {
+            "status": status,
+        }
+        remote = _remote_execution(result._result, span.ts, end)
+        if remote is not None:
+            # How long the finished job waited for the next poll.
+            args["poll_wait_us"] = end - remote[1]
+        if self._remote_time:
+            self._split_remote_time(result, span, runner, end, args)
+        self._finish_span(span, end, args)
+
+    def v2_runner_on_async_ok(self, result):
+        self._end_async_span(result, 'ok')
+
+    def v2_runner_on_async_failed(self, result):
+        self._end_async_span(result, 'failed')
+
     def v2_runner_on_ok(self, result):
         self._end_span(result, status="ok")
 
@@ -208,12 +1328,171 @@ class CallbackModule(CallbackBase):
     def _end(self):
 
         self._end_play_span()
-        self._f.write("\n]")
-        self._f.close()
+        end = _now_us()
+        with self._runner_lock:
+            background_jobs, self._background_jobs = self._background_jobs, {}
+        for job in background_jobs.values():
+            self._finish_async_event(job, end, {"status": "unfinished"})
+        self._write_counters(force=True)
+        if self._sampler is not None:
+            self._sampler.stop()
+        if self._profiler is not None:
+            self._profiler.stop()
+        if self._flusher is not None:
+            self._flusher.stop()
+        self._writer.close()
+        if self._otlp_writer is not None and self._otlp_writer.spilled:
+            self._display.warning(
+                'trace: could not export %d spans to %s (%s), wrote them to %s'
+                % (self._otlp_writer.spilled, self._otlp_endpoint,
+                   self._otlp_writer.error, self._otlp_writer.spill_path))
+        if self._otlp_writer is not None and self._otlp_writer.dropped:
+            self._display.warning(
+                'trace: dropped %d spans for %s, faster than they could be '
+                'exported' % (self._otlp_writer.dropped, self._otlp_endpoint))
 
 
-@dataclass
 class Host:
+    # One per host in the inventory, so kept small.
+    __slots__ = ('name', 'pid', 'play_span')
+
+    def __init__(self, name: str, pid: int, play_span: Optional['Span'] = None):
+        self.name = name
+        self.pid = pid
+        # The host's span for the current play, if it has run a task in it.
+        self.play_span = play_span
+
+
+@dataclass
+class Span:
     name: str
+    cat: str
+    ts: int
     pid: int
-    hasTaskInPlay: bool = False
+    id: int
+    args: Optional[Dict] = None
+
+
+@dataclass
+class TaskOverhead:
+    name: str
+    path: str
+    hosts: int = 0
+    remote: float = 0.0
+    overhead: float = 0.0
+
+
+# Number of task names remembered, most recently started first.
+TASK_CACHE_SIZE = 1024
+
+# Actions whose tasks load more tasks, linked to them by flow events.
+INCLUDE_ACTIONS = ('include', 'include_tasks', 'include_role')
+
+# Where a flow event starts: the pid, timestamp and task name of the span
+# it leads from.
+FlowSource = Tuple[int, int, str]
+
+# Format of the start and end times returned by command, shell and async_status.
+_REMOTE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _notified_handlers(result: Dict, task) -> List[str]:
+    """The handlers or topics a task run notified, if its result changed."""
+    if not result.get('changed'):
+        return []
+    # Results carry the notifications templated for each loop item, in
+    # versions of Ansible that don't strip them before the callbacks.
+    items = [result]
+    if isinstance(result.get('results'), list):
+        items += [item for item in result['results'] if isinstance(item, dict)]
+    notify = [item['_ansible_notify'] for item in items if item.get('_ansible_notify')]
+    if not notify:
+        notify = [getattr(task, 'notify', None) or []]
+    names: List[str] = []
+    for item_notify in notify:
+        for name in [item_notify] if isinstance(item_notify, str) else item_notify:
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def _parent_include(task):
+    """The include task that loaded task, if any."""
+    get_first_parent_include = getattr(task, 'get_first_parent_include', None)
+    if get_first_parent_include is None:
+        return None
+    return get_first_parent_include()
+
+
+def _remote_execution(result: Dict, span_start: int,
+                      span_end: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the start and end of the remote execution of a task, within its
+    span from span_start to span_end, from the timing in its result.
+
+    Remote timestamps are the remote host's local time. If they don't fall
+    within the span, only the remote duration is trusted, and it is placed at
+    the end of the span: the connection and module transfer come before the
+    module runs, and only its result comes after.
+    """
+    start = result.get('start')
+    end = result.get('end')
+    duration = None
+    if isinstance(start, str) and isinstance(end, str):
+        try:
+            remote_start = _CLOCK.from_unix_us(
+                datetime.strptime(start, _REMOTE_TIME_FORMAT).timestamp() * 1e6)
+            remote_end = _CLOCK.from_unix_us(
+                datetime.strptime(end, _REMOTE_TIME_FORMAT).timestamp() * 1e6)
+        except ValueError:
+            pass
+        else:
+            if span_start <= remote_start <= remote_end <= span_end:
+                return (remote_start, remote_end)
+            duration = remote_end - remote_start
+    delta = result.get('delta')
+    if duration is None and isinstance(delta, str):
+        try:
+            hours, minutes, seconds = delta.split(':')
+            duration = int((int(hours) * 3600 + int(minutes) * 60 + float(seconds)) * 1e6)
+        except ValueError:
+            pass
+    if duration is None or duration < 0:
+        return None
+    duration = min(duration, span_end - span_start)
+    return (span_end - duration, span_end)
+
+
+class TraceClock:
+    """
+    The time of trace events: whole microseconds since the clock started,
+    from a monotonic clock, so the wall clock being stepped or slewed during
+    a run can't end a span before it began. The wall clock time it started
+    at is written in the trace_info event, as time_origin_unix_us.
+    """
+
+    def __init__(self):
+        self.origin_unix_us: int = time.time_ns() // 1000
+        self._origin_ns: int = time.perf_counter_ns()
+
+    def now_us(self) -> int:
+        return (time.perf_counter_ns() - self._origin_ns) // 1000
+
+    def from_unix_us(self, unix_us: float) -> int:
+        """The trace time of a wall clock time, in microseconds."""
+        return int(unix_us) - self.origin_unix_us
+
+
+# Starts when the plugin is loaded, as the run starts.
+_CLOCK = TraceClock()
+
+
+def _now_us() -> int:
+    return _CLOCK.now_us()
+
+
+def _getenv_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
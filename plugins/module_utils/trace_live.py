@@ -0,0 +1,267 @@
+# Copyright 2021 Google LLC
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# A server streaming the trace callback's events while the run is in progress,
+# with a summary of its progress so far.
+
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+
+# Categories of the spans of a task run on a host.
+TASK_CATEGORIES = ("runner", "handler")
+
+
+class _LiveClient:
+    """Events waiting to be sent to one client of the live server."""
+
+    def __init__(self, buffer_size: int):
+        # Full buffers drop their oldest events: a slow client skips ahead
+        # rather than holding up the callback.
+        self.events: Deque[bytes] = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.ready = threading.Event()
+
+    def push(self, data: bytes):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(data)
+        self.ready.set()
+
+
+class LiveSummary:
+    """
+    Progress of the run so far, updated as events are written: the hosts
+    running a task, each play's hosts and finished tasks, and the tasks that
+    have been running the longest.
+    """
+
+    def __init__(self, now: Callable[[], int]):
+        self._now = now
+        self.events = 0
+        self._hosts: Dict[int, str] = {}
+        # Plays by id: name, hosts, task runs started, and task runs
+        # finished by status.
+        self._plays: Dict[int, Dict] = {}
+        # Where task runs are counted. Compact traces only write a play's
+        # span once it has ended, so its task runs wait in a play with no
+        # name until then.
+        self._play: Dict = self._new_play(None, None)
+        # Begin events of the running tasks, by (pid, id).
+        self._running: Dict[Tuple[int, int], Dict] = {}
+
+    def add(self, e: Dict):
+        self.events += 1
+        ph = e.get("ph")
+        if ph == "M":
+            if e.get("name") == "process_name":
+                self._hosts[e["pid"]] = e["args"]["name"]
+            return
+        cat = e.get("cat")
+        if cat == "play" and ph in ("B", "X"):
+            play = self._plays.get(e["id"])
+            if play is None:
+                if self._play["play"] is None:
+                    play = self._play
+                    play["play"], play["start_us"] = e["name"], e["ts"]
+                else:
+                    play = self._new_play(e["name"], e["ts"])
+                self._plays[e["id"]] = play
+                self._play = play if ph == "B" else self._new_play(None, None)
+            play["hosts"] += 1
+            play["start_us"] = min(play["start_us"], e["ts"])
+        if cat not in TASK_CATEGORIES:
+            return
+        play = self._play
+        key = (e["pid"], e["id"])
+        if ph in ("B", "X"):
+            play["started"] += 1
+        if ph == "B":
+            self._running[key] = e
+            return
+        self._running.pop(key, None)
+        status = (e.get("args") or {}).get("status", "ok")
+        play["finished"][status] = play["finished"].get(status, 0) + 1
+
+    @staticmethod
+    def _new_play(name: Optional[str], start: Optional[float]) -> Dict:
+        return {"play": name, "start_us": start, "hosts": 0, "started": 0,
+                "finished": {}}
+
+    def report(self, top: int = 10) -> Dict:
+        now = self._now()
+        running = sorted(self._running.values(), key=lambda e: e["ts"])
+        plays = [dict(play, id=play_id)
+                 for play_id, play in sorted(self._plays.items())]
+        if self._play["play"] is None and self._play["started"]:
+            plays.append(dict(self._play, id=None))
+        return {
+            "events": self.events,
+            "hosts": len(self._hosts),
+            "hosts_in_flight": len({pid for pid, _ in self._running}),
+            "tasks_in_flight": len(self._running),
+            "plays": plays,
+            "slowest_running": [{
+                "task": e["name"],
+                "host": self._hosts.get(e["pid"], str(e["pid"])),
+                "path": (e.get("args") or {}).get("path"),
+                "running_us": now - e["ts"],
+            } for e in running[:top]],
+        }
+
+
+class LiveTraceServer:
+    """
+    Serves the events of a run as they are written, on a localhost HTTP
+    port or a Unix socket:
+
+    - GET /events: a stream of server-sent events, one per trace event,
+      starting with the trace_info and process names written so far. When a client falls
+      more than buffer_size events behind, its oldest events are dropped,
+      and a "dropped" event says how many.
+    - GET /summary: LiveSummary.report() as JSON.
+
+    write() only queues events for each client's thread, so it never waits
+    for the network.
+    """
+
+    KEEPALIVE_INTERVAL = 15.0
+
+    def __init__(self, address: str, now: Callable[[], int],
+                 buffer_size: int = 10000):
+        self._buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._clients: List[_LiveClient] = []
+        self._metadata: List[bytes] = []
+        self._summary = LiveSummary(now)
+        self._closed = threading.Event()
+        self._encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] == '/events':
+                    server._stream(self)
+                elif self.path.split('?')[0] == '/summary':
+                    with server._lock:
+                        body = json.dumps(server._summary.report()).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        if address.startswith('unix:'):
+            self.url = address
+            path = address[len('unix:'):]
+            if os.path.exists(path):
+                os.unlink(path)
+
+            class UnixServer(socketserver.ThreadingUnixStreamServer):
+                daemon_threads = True
+
+                def get_request(self):
+                    # BaseHTTPRequestHandler expects an (address, port).
+                    request, _ = super().get_request()
+                    return request, ('local', 0)
+
+            self._server = UnixServer(path, Handler)
+        else:
+            host, _, port = address.rpartition(':')
+            self._server = http.server.ThreadingHTTPServer(
+                (host or '127.0.0.1', int(port)), Handler)
+            self._server.daemon_threads = True
+            self.url = 'http://%s:%d' % self._server.server_address[:2]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.1},
+            name='trace-live-server', daemon=True)
+        self._thread.start()
+
+    def write(self, e: Dict):
+        data = b'data: ' + self._encoder.encode(e).encode('utf-8') + b'\n\n'
+        with self._lock:
+            self._summary.add(e)
+            if e.get("ph") == "M" and e.get("name") in ("process_name", "trace_info"):
+                self._metadata.append(data)
+            for client in self._clients:
+                client.push(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            for client in self._clients:
+                client.ready.set()
+        # Give clients a moment to receive the last events.
+        deadline = time.monotonic() + 1.0
+        while self._clients and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self._server.shutdown()
+        self._server.server_close()
+        if self.url.startswith('unix:') and os.path.exists(self.url[len('unix:'):]):
+            os.unlink(self.url[len('unix:'):])
+
+    def _stream(self, handler):
+        client = _LiveClient(self._buffer_size)
+        with self._lock:
+            for data in self._metadata:
+                client.push(data)
+            self._clients.append(client)
+        try:
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'text/event-stream')
+            handler.send_header('Cache-Control', 'no-cache')
+            handler.end_headers()
+            while True:
+                if not client.ready.wait(self.KEEPALIVE_INTERVAL):
+                    handler.wfile.write(b': keepalive\n\n')
+                    handler.wfile.flush()
+                    continue
+                client.ready.clear()
+                # Every event is queued before the server is closed.
+                closed = self._closed.is_set()
+                with self._lock:
+                    events = list(client.events)
+                    client.events.clear()
+                    dropped, client.dropped = client.dropped, 0
+                if dropped:
+                    handler.wfile.write(
+                        b'event: dropped\ndata: {"dropped":%d}\n\n' % dropped)
+                handler.wfile.write(b''.join(events))
+                if closed:
+                    handler.wfile.write(b'event: end\ndata: {}\n\n')
+                    handler.wfile.flush()
+                    return
+                handler.wfile.flush()
+        except OSError:
+            # The client went away.
+            pass
+        finally:
+            with self._lock:
+                self._clients.remove(client)
@@ -0,0 +1,352 @@
+# Copyright 2021 Google LLC
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Export of the trace callback's spans to an OpenTelemetry collector, over
+# OTLP/HTTP with JSON encoding.
+
+import json
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+
+# Sentinel telling the OTLP export thread to stop.
+_CLOSE = object()
+
+
+# OpenTelemetry status codes.
+_OTLP_STATUS_OK = 1
+_OTLP_STATUS_ERROR = 2
+
+# Attribute names of span args, other than ansible.<arg>.
+_OTLP_ATTRIBUTES = {"path": "ansible.task.path", "args": "ansible.task.args",
+                    "args_ref": "ansible.task.args_ref"}
+
+# Nesting of the spans of a host that start and end at the same time.
+_OTLP_DEPTH = {"play": 0, "runner": 1, "handler": 1, "async": 2, "item": 2,
+               "remote": 3, "overhead": 3}
+
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, str):
+        return {"stringValue": value}
+    return {"stringValue": json.dumps(value, sort_keys=True, default=str)}
+
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)}
+            for key, value in attributes.items() if value is not None]
+
+
+def _parse_traceparent(traceparent: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """The trace id and parent span id of a W3C traceparent header."""
+    parts = (traceparent or '').strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None, None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None, None
+    return parts[1].lower(), parts[2].lower()
+
+
+class OtlpTraceWriter:
+    """
+    Exports the spans of the trace as OpenTelemetry spans, in batches over
+    OTLP/HTTP with JSON encoding, from a background thread.
+
+    Spans nest as run, play, the play on a host, task, then loop items,
+    async jobs and remote execution. A host's spans are exported once its
+    play span has ended, with each span's parent the innermost span that
+    contains it, so compact traces, which end children before their
+    parents, nest the same way.
+
+    write() only queues spans: if the queue is full, they're dropped and
+    counted rather than holding up the caller. Failed exports are retried with exponential
+    backoff, then appended to the spill file, one OTLP/JSON request per
+    line, which can be sent to a collector later. While the collector is
+    down, batches go straight to the spill file until the backoff expires.
+    """
+
+    SCOPE = 'mhansen.ansible_trace.trace'
+    MAX_RETRY_DELAY = 30.0
+
+    def __init__(self, endpoint: str, spill_path: str,
+                 service_name: str = 'ansible',
+                 traceparent: Optional[str] = None,
+                 headers: Optional[Dict[str, str]] = None,
+                 queue_size: int = 10000, batch_size: int = 512,
+                 flush_interval: float = 1.0, retries: int = 5,
+                 retry_delay: float = 0.5, timeout: float = 10.0):
+        self._endpoint = endpoint
+        self.spill_path = spill_path
+        self._headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = flush_interval
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._timeout = timeout
+        self._resource = {"attributes": _otlp_attributes({"service.name": service_name})}
+
+        trace_id, parent_id = _parse_traceparent(traceparent)
+        self.trace_id: str = trace_id or os.urandom(16).hex()
+        self._run_span = {"id": os.urandom(8).hex(), "parent": parent_id,
+                          "start": None, "end": None}
+        # Host names by pid.
+        self._hosts: Dict[int, str] = {}
+        # Begin events of the open spans, by (pid, id), and the ended spans
+        # of each host waiting for its play span to end.
+        self._open: Dict[Tuple[int, int], Dict] = {}
+        self._ended: Dict[int, List[Tuple[float, float, Dict, Dict]]] = {}
+        # Begin events of open async events, by (pid, id).
+        self._open_async: Dict[Tuple[int, int], Dict] = {}
+        # The current play, spanning its hosts' play spans.
+        self._play: Optional[Dict] = None
+        # Wall clock time of the trace's timestamp 0, from its trace_info.
+        self._origin_ns: int = 0
+
+        self.exported = 0
+        self.spilled = 0
+        self.dropped = 0
+        self._closing = False
+        self.error: Optional[Exception] = None
+        self._down_until = 0.0
+        self._spill_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name='trace-otlp-exporter', daemon=True)
+        self._thread.start()
+
+    def write(self, e: Dict):
+        ph = e.get("ph")
+        pid = e.get("pid")
+        if ph == "M":
+            if e.get("name") == "process_name" and e.get("cat") == "process":
+                self._hosts[pid] = e["args"]["name"]
+            elif e.get("name") == "trace_info":
+                self._origin_ns = (e["args"].get("time_origin_unix_us") or 0) * 1000
+            return
+        if "ts" in e:
+            run = self._run_span
+            run["start"] = e["ts"] if run["start"] is None else min(run["start"], e["ts"])
+            end = e["ts"] + e.get("dur", 0)
+            run["end"] = end if run["end"] is None else max(run["end"], end)
+        if pid not in self._hosts:
+            # Controller tracks and instants aren't exported.
+            return
+        if ph == "B":
+            self._open[(pid, e["id"])] = e
+        elif ph == "E":
+            begin = self._open.pop((pid, e["id"]), None)
+            if begin is None:
+                return
+            args = dict(begin.get("args") or {}, **(e.get("args") or {}))
+            self._end(pid, begin, begin["ts"], e["ts"], args)
+        elif ph == "X":
+            self._end(pid, e, e["ts"], e["ts"] + e["dur"], e.get("args") or {})
+        elif ph == "b":
+            self._open_async[(pid, e["id"])] = e
+        elif ph == "e":
+            # Async events, e.g. background async jobs, can outlive the
+            # host's spans and play, so they're children of the run.
+            begin = self._open_async.pop((pid, e["id"]), None)
+            if begin is None:
+                return
+            args = dict(begin.get("args") or {}, **(e.get("args") or {}))
+            self._queue_span(self._span(os.urandom(8).hex(), self._run_span["id"],
+                                        begin, begin["ts"], e["ts"], args, pid))
+
+    def _end(self, pid: int, e: Dict, start: float, end: float, args: Dict):
+        self._ended.setdefault(pid, []).append((start, end, e, args))
+        if e.get("cat") == "play":
+            self._export_host(pid)
+
+    def _export_host(self, pid: int):
+        ended = self._ended.pop(pid, [])
+        ended.sort(key=lambda s: (s[0], -s[1], _OTLP_DEPTH.get(s[2].get("cat"), 4)))
+        # Spans containing the current one, with their ids.
+        stack: List[Tuple[float, str]] = []
+        spans = []
+        for start, end, e, args in ended:
+            while stack and stack[-1][0] < end:
+                stack.pop()
+            if stack:
+                parent = stack[-1][1]
+            elif e.get("cat") == "play":
+                parent = self._play_span(e, start, end)
+            else:
+                parent = self._run_span["id"]
+            span_id = os.urandom(8).hex()
+            stack.append((end, span_id))
+            spans.append(self._span(span_id, parent, e, start, end, args, pid))
+        for span in spans:
+            self._queue_span(span)
+
+    def _play_span(self, e: Dict, start: float, end: float) -> str:
+        play = self._play
+        if play is None or play["play_id"] != e.get("id"):
+            self._end_play()
+            play = self._play = {"play_id": e.get("id"), "name": e["name"],
+                                 "id": os.urandom(8).hex(), "start": start,
+                                 "end": end, "hosts": 0}
+        play["start"] = min(play["start"], start)
+        play["end"] = max(play["end"], end)
+        play["hosts"] += 1
+        return play["id"]
+
+    def _end_play(self):
+        play = self._play
+        if play is None:
+            return
+        self._play = None
+        self._queue_span(self._otlp_span(
+            play["id"], self._run_span["id"], play["name"], play["start"],
+            play["end"], {"ansible.play": play["name"],
+                          "ansible.hosts": play["hosts"]}))
+
+    def _span(self, span_id: str, parent: str, e: Dict, start: float,
+              end: float, args: Dict, pid: int) -> Dict:
+        cat = e.get("cat")
+        attributes = {"ansible.category": cat, "ansible.host": self._hosts[pid]}
+        if cat == "play":
+            attributes["ansible.play"] = e["name"]
+            name = "%s: %s" % (e["name"], self._hosts[pid])
+        else:
+            name = e["name"]
+        for key, value in args.items():
+            if key != "host":
+                attributes[_OTLP_ATTRIBUTES.get(key, "ansible." + key)] = value
+        status = args.get("status")
+        return self._otlp_span(
+            span_id, parent, name, start, end, attributes,
+            _OTLP_STATUS_ERROR if status in ("failed", "unreachable") else
+            _OTLP_STATUS_OK if status is not None else None)
+
+    def _otlp_span(self, span_id: str, parent: Optional[str], name: str,
+                   start: float, end: float, attributes: Dict,
+                   status: Optional[int] = None) -> Dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": span_id,
+            "name": name,
+            "kind": 1,  # Internal
+            "startTimeUnixNano": str(int(start * 1000) + self._origin_ns),
+            "endTimeUnixNano": str(int(end * 1000) + self._origin_ns),
+            "attributes": _otlp_attributes(attributes),
+        }
+        if parent is not None:
+            span["parentSpanId"] = parent
+        if status is not None:
+            span["status"] = {"code": status}
+        return span
+
+    def _queue_span(self, span: Dict):
+        if self._closing:
+            # The run is over, so waiting for the exporter holds up nothing.
+            self._queue.put(span)
+            return
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        # The exporter thread sends batches on its own schedule.
+        pass
+
+    def close(self):
+        self._closing = True
+        for pid in list(self._ended):
+            self._export_host(pid)
+        self._end_play()
+        run = self._run_span
+        if run["start"] is not None:
+            self._queue_span(self._otlp_span(
+                run["id"], run["parent"], "ansible-playbook", run["start"],
+                run["end"], {}))
+        self._queue.put(_CLOSE)
+        self._thread.join()
+
+    def _request(self, spans: List[Dict]) -> Dict:
+        return {"resourceSpans": [{
+            "resource": self._resource,
+            "scopeSpans": [{"scope": {"name": self.SCOPE}, "spans": spans}],
+        }]}
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch: List[Dict] = []
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                try:
+                    span = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is _CLOSE:
+                    closing = True
+                    break
+                batch.append(span)
+            if batch:
+                self._export(batch, closing)
+
+    def _export(self, spans: List[Dict], closing: bool):
+        request = self._request(spans)
+        if time.monotonic() < self._down_until:
+            self._spill(request)
+            return
+        body = json.dumps(request).encode('utf-8')
+        delay = self._retry_delay
+        # Don't hold up the end of the run retrying.
+        for attempt in range(1 if closing else self._retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+            try:
+                with urllib.request.urlopen(urllib.request.Request(
+                        self._endpoint, data=body, headers=self._headers),
+                        timeout=self._timeout):
+                    pass
+            except urllib.error.HTTPError as e:
+                self.error = e
+                if 400 <= e.code < 500 and e.code not in (408, 429):
+                    # The collector won't take it however often it's sent.
+                    break
+            except (OSError, ValueError) as e:
+                self.error = e
+            else:
+                self.exported += len(spans)
+                return
+        self._down_until = time.monotonic() + delay
+        self._spill(request)
+
+    def _spill(self, request: Dict):
+        with self._spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(request) + '\n')
+        self.spilled += len(request["resourceSpans"][0]["scopeSpans"][0]["spans"])
@@ -0,0 +1,227 @@
+# Copyright 2021 Google LLC
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Background threads sampling the controller itself, for the trace callback:
+# its resource usage from /proc, and its main thread's Python stack.
+
+import os
+import sys
+import threading
+import types
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class ControllerSampler:
+    """
+    Samples the resource usage of the controller and its worker processes
+    from /proc on a background thread, writing them as counter events.
+    """
+
+    def __init__(self, write_event, pid: int, interval: float,
+                 now: Callable[[], int]):
+        self._write_event = write_event
+        self._now = now
+        self._pid: int = pid
+        self._interval: float = interval
+        self._clock_ticks: int = os.sysconf('SC_CLK_TCK')
+        self._page_size: int = os.sysconf('SC_PAGE_SIZE')
+        self._stopped = threading.Event()
+        # CPU ticks at the previous sample: the controller, its reaped
+        # children, and each live worker by pid.
+        self._last_sample: Optional[float] = None
+        self._last_cpu: int = 0
+        self._last_children_cpu: int = 0
+        self._last_workers_cpu: Dict[int, int] = {}
+        self._thread = threading.Thread(
+            target=self._run, name='trace-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                self._sample()
+            except (OSError, ValueError, IndexError):
+                # A worker exited while being read, or /proc is unusual; try
+                # again next time rather than kill the thread.
+                pass
+            if self._stopped.wait(self._interval):
+                return
+
+    @staticmethod
+    def _read_stat(pid: str) -> List[str]:
+        with open('/proc/%s/stat' % pid) as f:
+            stat = f.read()
+        # The command name is in parentheses and may contain spaces; fields
+        # are numbered from 1 in proc(5), with state being field 3.
+        return stat[stat.rindex(')') + 2:].split()
+
+    def _worker_pids(self) -> List[int]:
+        pids: List[int] = []
+        for tid in os.listdir('/proc/self/task'):
+            try:
+                with open('/proc/self/task/%s/children' % tid) as f:
+                    pids.extend(int(pid) for pid in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def _sample(self):
+        now = self._now()
+        stat = self._read_stat('self')
+        cpu = int(stat[11]) + int(stat[12])              # utime, stime
+        children_cpu = int(stat[13]) + int(stat[14])     # cutime, cstime
+        with open('/proc/self/status') as f:
+            rss_kb = next(int(line.split()[1]) for line in f
+                          if line.startswith('VmRSS:'))
+        with open('/proc/loadavg') as f:
+            load = [float(x) for x in f.read().split()[:3]]
+
+        workers_cpu: Dict[int, int] = {}
+        workers_rss = 0
+        for pid in self._worker_pids():
+            try:
+                worker_stat = self._read_stat(str(pid))
+                with open('/proc/%d/statm' % pid) as f:
+                    workers_rss += int(f.read().split()[1]) * self._page_size
+            except OSError:
+                continue
+            workers_cpu[pid] = int(worker_stat[11]) + int(worker_stat[12])
+
+        if self._last_sample is not None:
+            elapsed = (now - self._last_sample) / 1e6 * self._clock_ticks
+            # Workers that exited since the last sample are counted by the
+            # reaped children's CPU time instead.
+            workers_delta = (children_cpu - self._last_children_cpu) + sum(
+                ticks - self._last_workers_cpu.get(pid, 0)
+                for pid, ticks in workers_cpu.items())
+            self._write_counter(now, "cpu", {
+                "controller_percent": 100.0 * (cpu - self._last_cpu) / elapsed,
+                "workers_percent": 100.0 * max(0, workers_delta) / elapsed,
+            })
+        self._write_counter(now, "memory", {
+            "controller_rss_mb": rss_kb / 1024.0,
+            "workers_rss_mb": workers_rss / (1024.0 * 1024.0),
+        })
+        self._write_counter(now, "load", {
+            "load1": load[0],
+            "load5": load[1],
+            "load15": load[2],
+        })
+        self._write_counter(now, "workers", {
+            "count": len(workers_cpu),
+        })
+
+        self._last_sample = now
+        self._last_cpu = cpu
+        self._last_children_cpu = children_cpu
+        self._last_workers_cpu = workers_cpu
+
+    def _write_counter(self, ts: int, name: str, values: Dict):
+        self._write_event({
+            "name": name,
+            "cat": "controller",
+            "ph": "C",
+            "ts": ts,
+            "pid": self._pid,
+            "args": values,
+        })
+
+
+class ControllerProfiler:
+    """
+    A sampling profiler of the controller's main thread, where Ansible runs
+    the strategy, templating and callbacks.
+
+    Samples the main thread's Python stack from a background thread. A frame
+    present in consecutive samples becomes one slice, written as a complete
+    event when a sample no longer has it, so the slices nest like the stack
+    and share the task spans' clock. The slices a sample closes are written
+    together, taking the trace's write lock once per sample.
+    """
+
+    MAX_DEPTH = 64
+    # Stands in for the outermost frames of a deeper stack, whose innermost
+    # frames are the ones worth attributing time to.
+    TRUNCATED = types.SimpleNamespace(
+        co_name='<truncated>', co_filename='', co_firstlineno=0)
+
+    def __init__(self, write_events, pid: int, interval: float,
+                 now: Callable[[], int]):
+        self._write_events = write_events
+        self._now = now
+        self._pid: int = pid
+        self._interval: float = interval
+        self._main_thread_id: int = threading.main_thread().ident
+        # Frames in the last sample, outermost first: (code, start ts, id).
+        self._open_frames: List[Tuple[object, float, int]] = []
+        self._next_id: int = 1
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='trace-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._close_frames(0, self._now())
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self._sample()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._main_thread_id)
+        now = self._now()
+        codes: List[object] = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        del frame
+        codes.reverse()
+        if len(codes) > self.MAX_DEPTH:
+            codes = [self.TRUNCATED] + codes[1 - self.MAX_DEPTH:]
+
+        common = 0
+        while (common < len(codes) and common < len(self._open_frames)
+               and self._open_frames[common][0] is codes[common]):
+            common += 1
+        self._close_frames(common, now)
+        for code in codes[common:]:
+            self._open_frames.append((code, now, self._next_id))
+            self._next_id += 1
+
+    def _close_frames(self, depth: int, ts: int):
+        # Innermost first, so children are written before their parents.
+        events: List[Dict] = []
+        while len(self._open_frames) > depth:
+            code, start, frame_id = self._open_frames.pop()
+            events.append({
+                "name": getattr(code, 'co_qualname', code.co_name),
+                "cat": "profile",
+                "ph": "X",  # Complete
+                "ts": start,
+                "dur": ts - start,
+                "pid": self._pid,
+                "id": frame_id,
+                "args": {
+                    "file": code.co_filename,
+                    "line": code.co_firstlineno,
+                },
+            })
+        if events:
+            self._write_events(events)
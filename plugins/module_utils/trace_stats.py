@@ -0,0 +1,123 @@
+# Copyright 2021 Google LLC
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Summaries of the durations of a task's runs across hosts, for the trace
+# callback's task_stats events.
+
+import math
+from dataclasses import dataclass, field
+from typing import Dict
+
+
+class QuantileSketch:
+    """
+    Quantiles of a stream of durations, within a relative error of accuracy,
+    in memory logarithmic in their range (DDSketch: https://arxiv.org/abs/1908.10693).
+
+    Durations are counted in buckets growing by a factor of gamma, so
+    sketches with the same accuracy, e.g. of different runs, are merged by
+    adding up their buckets.
+    """
+    __slots__ = ('accuracy', 'gamma', 'count', 'zeros', 'buckets')
+
+    def __init__(self, accuracy: float = 0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.count = 0
+        # Durations too small to take the log of.
+        self.zeros = 0
+        self.buckets: Dict[int, int] = {}
+
+    def add(self, value: float):
+        self.count += 1
+        if value < 1.0:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value, self.gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: 'QuantileSketch'):
+        if other.accuracy != self.accuracy:
+            raise ValueError('Can only merge sketches of the same accuracy')
+        self.count += other.count
+        self.zeros += other.zeros
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q: float) -> float:
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # The middle of the bucket, in relative terms.
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "accuracy": self.accuracy,
+            "zeros": self.zeros,
+            "buckets": sorted(self.buckets.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'QuantileSketch':
+        sketch = cls(d["accuracy"])
+        sketch.zeros = d["zeros"]
+        sketch.buckets = {index: count for index, count in d["buckets"]}
+        sketch.count = sketch.zeros + sum(sketch.buckets.values())
+        return sketch
+
+
+@dataclass
+class TaskStats:
+    name: str
+    path: str
+    hosts: int = 0
+    sampled_hosts: int = 0
+    min: float = math.inf
+    max: float = 0.0
+    total: float = 0.0
+    statuses: Dict[str, int] = field(default_factory=dict)
+    sketch: QuantileSketch = field(default_factory=QuantileSketch)
+
+    def add(self, duration: float, status: str, sampled: bool):
+        self.hosts += 1
+        self.sampled_hosts += sampled
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+        self.total += duration
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.sketch.add(duration)
+
+    def summary(self, play: str, sample_rate: float) -> Dict:
+        return {
+            "play": play,
+            "task": self.name,
+            "path": self.path,
+            "hosts": self.hosts,
+            "sampled_hosts": self.sampled_hosts,
+            "sample_rate": sample_rate,
+            "statuses": self.statuses,
+            "min_us": self.min,
+            "mean_us": self.total / self.hosts,
+            "max_us": self.max,
+            "p50_us": self.sketch.quantile(0.5),
+            "p95_us": self.sketch.quantile(0.95),
+            "p99_us": self.sketch.quantile(0.99),
+            "sketch": self.sketch.to_dict(),
+        }
@@ -0,0 +1,573 @@
+# Copyright 2021 Google LLC
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# version 3 as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Writers of the trace callback's events to files: JSON in Trace Event Format,
+# a SQLite database shared by runs, and Perfetto protobuf.
+#
+# Each writer has write(event), flush() and close(). The callback calls them
+# one event at a time, holding its write lock.
+
+import gzip
+import io
+import json
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import BinaryIO, Dict, List, Optional, TextIO, Tuple
+
+try:
+    import zstandard
+    HAS_ZSTANDARD = True
+except ImportError:
+    HAS_ZSTANDARD = False
+
+try:
+    import sqlite3
+    HAS_SQLITE3 = True
+except ImportError:
+    HAS_SQLITE3 = False
+
+
+def _open_output(path: str, compression: str) -> BinaryIO:
+    """
+    Opens path for writing, through a streaming compressor if compression is
+    gzip or zstd, adding the compressed file extension to path.
+
+    Flushing a compressed file ends the current block (a zlib sync flush, or
+    a zstd block flush), so everything written so far can be decompressed
+    while the file is still being written.
+    """
+    if compression == 'gzip':
+        return gzip.open(path + '.gz', 'wb')
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(open(path + '.zst', 'wb'))
+    return open(path, 'wb')
+
+
+class JsonTraceWriter:
+    """
+    Writes events to a file as a JSON array in Trace Event Format.
+
+    The closing bracket is only written by close(), so the file is an
+    unterminated array while the playbook runs. Trace viewers accept this,
+    which is what lets in-progress traces be opened.
+    """
+
+    def __init__(self, path: str, compact: bool = False,
+                 compression: str = 'none'):
+        self._f: TextIO = io.TextIOWrapper(
+            _open_output(path, compression), encoding='utf-8')
+        self._f.write("[\n")
+        self._first: bool = True
+        if compact:
+            self._encoder = json.JSONEncoder(
+                sort_keys=True, separators=(',', ':'))
+        else:
+            self._encoder = json.JSONEncoder(sort_keys=True, indent=2)
+
+    def write(self, e: Dict):
+        # Encode before writing, so a bad event never leaves half an object
+        # in the file. Sort for reproducibility.
+        data = self._encoder.encode(e)
+        if not self._first:
+            self._f.write(",\n")
+        self._first = False
+        self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.write("\n]")
+        self._f.close()
+
+
+_SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    started_at TEXT,
+    start_us REAL,
+    end_us REAL
+);
+CREATE TABLE IF NOT EXISTS plays (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    number INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (run_id, number)
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (path, name)
+);
+CREATE TABLE IF NOT EXISTS spans (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    play_id INTEGER REFERENCES plays (id),
+    host_id INTEGER REFERENCES hosts (id),
+    task_id INTEGER REFERENCES tasks (id),
+    cat TEXT NOT NULL,
+    name TEXT NOT NULL,
+    start_us REAL NOT NULL,
+    end_us REAL NOT NULL,
+    status TEXT,
+    args TEXT
+);
+CREATE INDEX IF NOT EXISTS spans_task_start ON spans (task_id, start_us);
+CREATE INDEX IF NOT EXISTS spans_host_start ON spans (host_id, start_us);
+CREATE INDEX IF NOT EXISTS spans_start ON spans (start_us);
+CREATE INDEX IF NOT EXISTS spans_run_host ON spans (run_id, host_id);
+'''
+
+
+class SqliteTraceWriter:
+    """
+    Adds the spans of a run to a SQLite database shared by all runs.
+
+    Begin and end events are paired, and spans are inserted in batches, in
+    transactions committed at most every commit_interval seconds (and when
+    the writer is closed), so each event costs little more than a tuple.
+    Hosts, tasks and plays are normalised into their own tables. Counter,
+    instant and metadata events other than process names are not stored.
+    Spans are stored in wall clock microseconds, so runs can be compared.
+    """
+
+    def __init__(self, path: str, run: str, started_at: Optional[str] = None,
+                 batch_size: int = 1000, commit_interval: float = 1.0):
+        # Events come from the sampler and profiler threads too, always one
+        # at a time.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SQLITE_SCHEMA)
+        self._run_id: int = self._db.execute(
+            'INSERT INTO runs (name, started_at) VALUES (?, ?)',
+            (run, started_at)).lastrowid
+        self._db.commit()
+        self._started_at: Optional[str] = started_at
+        self._batch_size: int = batch_size
+        self._commit_interval: float = commit_interval
+        self._last_commit: float = time.monotonic()
+        self._start_us: Optional[float] = None
+        self._end_us: Optional[float] = None
+        # Wall clock time of the trace's timestamp 0, from its trace_info.
+        self._origin_us: float = 0
+        # Row ids, by pid, (path, name) and play span id.
+        self._hosts: Dict[int, int] = {}
+        self._tasks: Dict[Tuple[str, str], int] = {}
+        self._plays: Dict[int, int] = {}
+        # Play row of each host's open play span.
+        self._current_plays: Dict[int, int] = {}
+        # Begin events of open spans, by (pid, id).
+        self._open: Dict[Tuple[int, int], Dict] = {}
+        self._rows: List[Tuple] = []
+
+    def write(self, e: Dict):
+        ph = e.get('ph')
+        if ph == 'M':
+            if e.get('name') == 'process_name':
+                self._hosts[e['pid']] = self._row_id(
+                    'hosts', ('name',), (e['args']['name'],))
+            elif e.get('name') == 'trace_info':
+                self._origin_us = e['args'].get('time_origin_unix_us') or 0
+            return
+        if ph in ('B', 'b'):
+            self._open[(e['pid'], e['id'])] = e
+            if e.get('cat') == 'play':
+                self._current_plays[e['pid']] = self._play_id(e)
+            return
+        if ph in ('E', 'e'):
+            begin = self._open.pop((e['pid'], e['id']), None)
+            if begin is None:
+                return
+            args = dict(begin.get('args') or {}, **(e.get('args') or {}))
+            self._add_span(begin, begin['ts'], e['ts'], args)
+        elif ph == 'X':
+            self._add_span(e, e['ts'], e['ts'] + e['dur'], e.get('args') or {})
+        if len(self._rows) >= self._batch_size:
+            self._insert()
+
+    def _row_id(self, table: str, columns: Tuple[str, ...], values: Tuple) -> int:
+        where = ' AND '.join('%s = ?' % c for c in columns)
+        row = self._db.execute(
+            'SELECT id FROM %s WHERE %s' % (table, where), values).fetchone()
+        if row is not None:
+            return row[0]
+        return self._db.execute('INSERT INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(columns), ', '.join('?' * len(columns))),
+            values).lastrowid
+
+    def _play_id(self, e: Dict) -> int:
+        play_id = self._plays.get(e['id'])
+        if play_id is None:
+            play_id = self._row_id('plays', ('run_id', 'number', 'name'),
+                                   (self._run_id, e['id'], e['name']))
+            self._plays[e['id']] = play_id
+        return play_id
+
+    def _add_span(self, e: Dict, start: float, end: float, args: Dict):
+        pid = e['pid']
+        cat = e.get('cat', '')
+        start += self._origin_us
+        end += self._origin_us
+        if self._start_us is None or start < self._start_us:
+            self._start_us = start
+        if self._end_us is None or end > self._end_us:
+            self._end_us = end
+        if cat == 'play':
+            play_id = self._current_plays.pop(pid, None) or self._play_id(e)
+            if e.get('ph') == 'X':
+                # Compact traces write play spans after the spans within.
+                self._insert()
+                self._db.execute(
+                    'UPDATE spans SET play_id = ? WHERE run_id = ? AND '
+                    'host_id = ? AND play_id IS NULL',
+                    (play_id, self._run_id, self._hosts.get(pid)))
+        else:
+            play_id = self._current_plays.get(pid)
+        task_id = None
+        if 'path' in args and 'task' in args:
+            key = (args['path'], args['task'])
+            task_id = self._tasks.get(key)
+            if task_id is None:
+                task_id = self._row_id('tasks', ('path', 'name'), key)
+                self._tasks[key] = task_id
+        extra = {k: v for k, v in args.items()
+                 if k not in ('task', 'path', 'host', 'status')}
+        self._rows.append((
+            self._run_id, play_id, self._hosts.get(pid), task_id, cat,
+            e['name'], start, end, args.get('status'),
+            json.dumps(extra, sort_keys=True, default=str) if extra else None))
+
+    def _insert(self):
+        if self._rows:
+            self._db.executemany(
+                'INSERT INTO spans (run_id, play_id, host_id, task_id, cat, '
+                'name, start_us, end_us, status, args) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self._rows)
+            self._rows = []
+
+    def _commit(self):
+        self._insert()
+        started_at = self._started_at
+        if started_at is None and self._start_us is not None:
+            started_at = datetime.fromtimestamp(self._start_us / 1e6).isoformat()
+        self._db.execute(
+            'UPDATE runs SET started_at = ?, start_us = ?, end_us = ? WHERE id = ?',
+            (started_at, self._start_us, self._end_us, self._run_id))
+        self._db.commit()
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        # Called after every event, so only commit every commit_interval.
+        if time.monotonic() - self._last_commit >= self._commit_interval:
+            self._commit()
+
+    def close(self):
+        self._commit()
+        self._db.close()
+
+
+class TeeWriter:
+    """Writes every event to each of several writers."""
+
+    def __init__(self, writers: List):
+        self._writers: List = writers
+
+    def write(self, e: Dict):
+        for writer in self._writers:
+            writer.write(e)
+
+    def flush(self):
+        for writer in self._writers:
+            writer.flush()
+
+    def close(self):
+        for writer in self._writers:
+            writer.close()
+
+
+class PeriodicFlusher:
+    """
+    Calls flush every interval on a background thread, so buffered output
+    reaches the disk even while no events are being written.
+    """
+
+    def __init__(self, flush, interval: float):
+        self._flush = flush
+        self._interval: float = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='trace-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self._flush()
+
+
+# A minimal protobuf encoder, so the protobuf output needs nothing beyond the
+# standard library. See https://protobuf.dev/programming-guides/encoding/
+
+def _pb_varint(value: int) -> bytes:
+    # Negative int64 values are encoded as their 64-bit two's complement.
+    value &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _pb_uint(field: int, value: int) -> bytes:
+    return _pb_varint(field << 3) + _pb_varint(value)
+
+
+def _pb_double(field: int, value: float) -> bytes:
+    return _pb_varint(field << 3 | 1) + struct.pack('<d', value)
+
+
+def _pb_fixed64(field: int, value: int) -> bytes:
+    return _pb_varint(field << 3 | 1) + struct.pack('<Q', value)
+
+
+def _pb_bytes(field: int, value: bytes) -> bytes:
+    return _pb_varint(field << 3 | 2) + _pb_varint(len(value)) + value
+
+
+def _pb_string(field: int, value: str) -> bytes:
+    return _pb_bytes(field, value.encode('utf-8'))
+
+
+class ProtobufTraceWriter:
+    """
+    Writes events to a file as a Perfetto protobuf trace of TrackEvents.
+
+    Each host (Trace Event Format pid) becomes a process track. Event names,
+    categories, argument names and string argument values are interned: the
+    first packet using a string defines it in the sequence's interned data,
+    and later packets refer to it by id.
+
+    See https://perfetto.dev/docs/reference/trace-packet-proto
+    """
+
+    # Field numbers, from perfetto/protos/perfetto/trace/.
+    TRACE_PACKET = 1                            # Trace
+    PACKET_TIMESTAMP = 8                        # TracePacket
+    PACKET_SEQUENCE_ID = 10
+    PACKET_TRACK_EVENT = 11
+    PACKET_INTERNED_DATA = 12
+    PACKET_SEQUENCE_FLAGS = 13
+    PACKET_TRACK_DESCRIPTOR = 60
+    SEQ_INCREMENTAL_STATE_CLEARED = 1
+    SEQ_NEEDS_INCREMENTAL_STATE = 2
+    TRACK_UUID = 1                              # TrackDescriptor
+    TRACK_NAME = 2
+    TRACK_PROCESS = 3
+    TRACK_PARENT_UUID = 5
+    TRACK_COUNTER = 8
+    PROCESS_PID = 1                             # ProcessDescriptor
+    PROCESS_NAME = 6
+    EVENT_CATEGORY_IIDS = 3                     # TrackEvent
+    EVENT_DEBUG_ANNOTATIONS = 4
+    EVENT_TYPE = 9
+    EVENT_NAME_IID = 10
+    EVENT_TRACK_UUID = 11
+    TYPE_SLICE_BEGIN = 1
+    TYPE_SLICE_END = 2
+    TYPE_INSTANT = 3
+    TYPE_COUNTER = 4
+    EVENT_DOUBLE_COUNTER_VALUE = 44
+    EVENT_FLOW_IDS = 47
+    EVENT_TERMINATING_FLOW_IDS = 48
+    ANNOTATION_NAME_IID = 1                     # DebugAnnotation
+    ANNOTATION_BOOL = 2
+    ANNOTATION_INT = 4
+    ANNOTATION_DOUBLE = 5
+    ANNOTATION_STRING_IID = 17
+    INTERNED_CATEGORIES = 1                     # InternedData
+    INTERNED_EVENT_NAMES = 2
+    INTERNED_ANNOTATION_NAMES = 3
+    INTERNED_STRING_VALUES = 29
+    INTERNED_IID = 1                            # EventCategory, EventName, ...
+    INTERNED_NAME = 2
+
+    SEQUENCE_ID = 1
+
+    def __init__(self, path: str, compression: str = 'none'):
+        self._f: BinaryIO = _open_output(path, compression)
+        # Interning tables, by InternedData field: string -> iid.
+        self._interned: Dict[int, Dict[str, int]] = {
+            self.INTERNED_CATEGORIES: {},
+            self.INTERNED_EVENT_NAMES: {},
+            self.INTERNED_ANNOTATION_NAMES: {},
+            self.INTERNED_STRING_VALUES: {},
+        }
+        # Newly interned entries, written with the next packet.
+        self._new_interned: bytes = b''
+        # Deduplicated task arguments, by args_ref.
+        self._task_args: Dict[int, str] = {}
+        # Counter track uuids, by (pid, counter name). Allocated above the
+        # pids, which are the process track uuids.
+        self._counter_tracks: Dict[Tuple[int, str], int] = {}
+        # Tracks of open async events, by (pid, id), and the next one's uuid.
+        self._async_tracks: Dict[Tuple[int, int], int] = {}
+        self._next_async_track: int = 2 << 32
+        self._write_packet(
+            _pb_uint(self.PACKET_SEQUENCE_FLAGS, self.SEQ_INCREMENTAL_STATE_CLEARED))
+
+    def write(self, e: Dict):
+        ph = e.get('ph')
+        if ph == 'M' and e.get('name') == 'process_name':
+            self._write_packet(_pb_bytes(
+                self.PACKET_TRACK_DESCRIPTOR,
+                _pb_uint(self.TRACK_UUID, e['pid'])
+                + _pb_bytes(self.TRACK_PROCESS,
+                            _pb_uint(self.PROCESS_PID, e['pid'])
+                            + _pb_string(self.PROCESS_NAME, e['args']['name']))))
+        elif ph == 'M' and e.get('name') == 'task_args':
+            # Interning already stores each distinct set of arguments once, so
+            # spans get their arguments back instead of a reference.
+            self._task_args[e['args']['ref']] = json.dumps(
+                e['args']['args'], sort_keys=True)
+        elif ph == 'B':
+            self._write_slice(self.TYPE_SLICE_BEGIN, e['ts'], e, e.get('args'))
+        elif ph == 'E':
+            self._write_slice(self.TYPE_SLICE_END, e['ts'], e, e.get('args'))
+        elif ph == 'X':
+            self._write_slice(self.TYPE_SLICE_BEGIN, e['ts'], e, e.get('args'))
+            self._write_slice(self.TYPE_SLICE_END, e['ts'] + e['dur'], e, None)
+        elif ph == 'i':
+            self._write_slice(self.TYPE_INSTANT, e['ts'], e, e.get('args'))
+        elif ph == 'b':
+            # Async events overlap the process's other slices, so each gets
+            # a track of its own within the process.
+            track = self._next_async_track
+            self._next_async_track += 1
+            self._async_tracks[(e['pid'], e['id'])] = track
+            self._write_packet(_pb_bytes(
+                self.PACKET_TRACK_DESCRIPTOR,
+                _pb_uint(self.TRACK_UUID, track)
+                + _pb_string(self.TRACK_NAME, e['name'])
+                + _pb_uint(self.TRACK_PARENT_UUID, e['pid'])))
+            self._write_slice(self.TYPE_SLICE_BEGIN, e['ts'], e, e.get('args'),
+                              track=track)
+        elif ph == 'e':
+            self._write_slice(self.TYPE_SLICE_END, e['ts'], e, e.get('args'),
+                              track=self._async_tracks.pop((e['pid'], e['id'])))
+        elif ph in ('s', 'f'):
+            # Flows link track events, rather than binding to the span at a
+            # time, so each end of a flow is an instant within its span.
+            self._write_slice(self.TYPE_INSTANT, e['ts'], e, None, _pb_fixed64(
+                self.EVENT_FLOW_IDS if ph == 's' else self.EVENT_TERMINATING_FLOW_IDS,
+                e['id']))
+        elif ph == 'C':
+            for key, value in sorted(e['args'].items()):
+                self._write_counter(e['pid'], '%s %s' % (e['name'], key),
+                                    e['ts'], value)
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def _write_packet(self, payload: bytes):
+        packet = _pb_uint(self.PACKET_SEQUENCE_ID, self.SEQUENCE_ID) + payload
+        self._f.write(_pb_bytes(self.TRACE_PACKET, packet))
+
+    def _intern(self, table: int, value: str) -> int:
+        interned = self._interned[table]
+        iid = interned.get(value)
+        if iid is None:
+            iid = len(interned) + 1
+            interned[value] = iid
+            self._new_interned += _pb_bytes(
+                table,
+                _pb_uint(self.INTERNED_IID, iid)
+                + _pb_string(self.INTERNED_NAME, value))
+        return iid
+
+    def _annotation(self, name: str, value) -> bytes:
+        out = _pb_uint(self.ANNOTATION_NAME_IID,
+                       self._intern(self.INTERNED_ANNOTATION_NAMES, name))
+        if isinstance(value, bool):
+            return out + _pb_uint(self.ANNOTATION_BOOL, value)
+        if isinstance(value, int):
+            return out + _pb_uint(self.ANNOTATION_INT, value)
+        if isinstance(value, float):
+            return out + _pb_double(self.ANNOTATION_DOUBLE, value)
+        if not isinstance(value, str):
+            # Task arguments etc. are repeated across hosts, so intern them too.
+            value = json.dumps(value, sort_keys=True)
+        return out + _pb_uint(self.ANNOTATION_STRING_IID,
+                              self._intern(self.INTERNED_STRING_VALUES, value))
+
+    def _write_counter(self, pid: int, name: str, ts: float, value: float):
+        track = self._counter_tracks.get((pid, name))
+        if track is None:
+            track = (1 << 32) + len(self._counter_tracks)
+            self._counter_tracks[(pid, name)] = track
+            self._write_packet(_pb_bytes(
+                self.PACKET_TRACK_DESCRIPTOR,
+                _pb_uint(self.TRACK_UUID, track)
+                + _pb_string(self.TRACK_NAME, name)
+                + _pb_uint(self.TRACK_PARENT_UUID, pid)
+                + _pb_bytes(self.TRACK_COUNTER, b'')))
+        event = _pb_uint(self.EVENT_TYPE, self.TYPE_COUNTER)
+        event += _pb_uint(self.EVENT_TRACK_UUID, track)
+        event += _pb_double(self.EVENT_DOUBLE_COUNTER_VALUE, float(value))
+        packet = _pb_uint(self.PACKET_TIMESTAMP, int(round(ts * 1000)))
+        packet += _pb_bytes(self.PACKET_TRACK_EVENT, event)
+        packet += _pb_uint(self.PACKET_SEQUENCE_FLAGS, self.SEQ_NEEDS_INCREMENTAL_STATE)
+        self._write_packet(packet)
+
+    def _write_slice(self, slice_type: int, ts: float, e: Dict,
+                     args: Optional[Dict], flow: bytes = b'',
+                     track: Optional[int] = None):
+        event = _pb_uint(self.EVENT_TYPE, slice_type) + flow
+        event += _pb_uint(self.EVENT_TRACK_UUID, e['pid'] if track is None else track)
+        if slice_type != self.TYPE_SLICE_END:
+            event += _pb_uint(self.EVENT_NAME_IID,
+                              self._intern(self.INTERNED_EVENT_NAMES, e['name']))
+            event += _pb_uint(self.EVENT_CATEGORY_IIDS,
+                              self._intern(self.INTERNED_CATEGORIES, e['cat']))
+        if args is not None and 'args_ref' in args:
+            args = dict(args)
+            args['args'] = self._task_args[args.pop('args_ref')]
+        for name, value in sorted((args or {}).items()):
+            if value is not None:
+                event += _pb_bytes(self.EVENT_DEBUG_ANNOTATIONS,
+                                   self._annotation(name, value))
+
+        packet = _pb_uint(self.PACKET_TIMESTAMP, int(round(ts * 1000)))
+        packet += _pb_bytes(self.PACKET_TRACK_EVENT, event)
+        if self._new_interned:
+            packet += _pb_bytes(self.PACKET_INTERNED_DATA, self._new_interned)
+            self._new_interned = b''
+        packet += _pb_uint(self.PACKET_SEQUENCE_FLAGS, self.SEQ_NEEDS_INCREMENTAL_STATE)
+        self._write_packet(packet)
@@ -0,0 +1,201 @@
+"""
+Measure what the trace callback costs per event, without running Ansible.
+
+    python tests/benchmark/callback_overhead.py [--scenario 1000x100] \\
+        [--env TRACE_COMPACT=true] [--output results.json] \\
+        [--baseline previous.json] [--budget-ns 20000]
+
+Drives CallbackModule directly with fake objects, for a play of HOSTSxTASKS
+task runs, in two interleavings: linear, where each task starts on every
+host before any host's result arrives, as with `strategy: linear`, and free,
+where hosts go through the tasks at their own pace, as with `strategy:
+free`. Each scenario runs in its own process, so its peak RSS is its own.
+
+Reports the trace events written per second, the nanoseconds per callback
+(including writing the trace when the callback ends), the peak RSS and the
+bytes written. --output saves the results as JSON, --baseline compares them
+with saved results, and --budget-ns exits with status 1 if any scenario
+spends more than that per callback.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from fakes import FakeHost, FakePlay, FakeResult, FakeTask, load_callback
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'tools'))
+from trace_reader import iter_events  # noqa: E402
+
+# Hosts x tasks. The larger ones take minutes, so they only run when asked.
+SCENARIOS = ['10x100', '100x100', '1000x100', '1000x1000', '5000x1000']
+DEFAULT_SCENARIOS = SCENARIOS[:3]
+STRATEGIES = ['linear', 'free']
+
+
+def linear(hosts: List[FakeHost], tasks: List[FakeTask]) -> Iterator[Tuple[str, Any]]:
+    for task in tasks:
+        yield 'task', task
+        for host in hosts:
+            yield 'start', (host, task)
+        for host in hosts:
+            yield 'ok', (host, task)
+
+
+def free(hosts: List[FakeHost], tasks: List[FakeTask]) -> Iterator[Tuple[str, Any]]:
+    # Host i takes (i % 4) + 1 rounds per task, so fast hosts run ahead and
+    # several tasks are in flight at once.
+    started = 0
+    position = [0] * len(hosts)
+    running = [0] * len(hosts)
+    round_number = 0
+    while started < len(tasks) or any(running):
+        round_number += 1
+        for i, host in enumerate(hosts):
+            t = position[i]
+            if running[i] and round_number >= running[i]:
+                yield 'ok', (host, tasks[t])
+                running[i] = 0
+                position[i] = t = t + 1
+            if not running[i] and t < len(tasks):
+                if t == started:
+                    yield 'task', tasks[t]
+                    started += 1
+                yield 'start', (host, tasks[t])
+                running[i] = round_number + (i % 4) + 1
+
+
+def run_scenario(scenario: str, strategy: str, env: Dict[str, str]) -> Dict[str, Any]:
+    host_count, task_count = (int(n) for n in scenario.split('x'))
+    hosts = [FakeHost('host-%d' % h) for h in range(host_count)]
+    tasks = [FakeTask('task %d' % t, 'site.yml:%d' % (t + 1),
+                      {'_raw_params': 'echo %d' % t}) for t in range(task_count)]
+    interleaving = {'linear': linear, 'free': free}[strategy]
+    with tempfile.TemporaryDirectory() as output_dir:
+        callback = load_callback(output_dir, **env)
+        callbacks = 1
+        start = time.perf_counter_ns()
+        callback.v2_playbook_on_play_start(FakePlay('benchmark'))
+        for kind, arg in interleaving(hosts, tasks):
+            if kind == 'task':
+                callback.v2_playbook_on_task_start(arg, False)
+            elif kind == 'start':
+                callback.v2_runner_on_start(*arg)
+            else:
+                callback.v2_runner_on_ok(FakeResult(*arg))
+            callbacks += 1
+        callback._end()
+        elapsed_ns = time.perf_counter_ns() - start
+
+        bytes_written = 0
+        for name in os.listdir(output_dir):
+            bytes_written += os.path.getsize(os.path.join(output_dir, name))
+        json_trace = os.path.join(output_dir, callback._output_file)
+        events = None
+        if os.path.exists(json_trace):
+            events = sum(1 for _ in iter_events(json_trace))
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return {
+        'scenario': scenario,
+        'strategy': strategy,
+        'hosts': host_count,
+        'tasks': task_count,
+        'callbacks': callbacks,
+        'events': events,
+        'seconds': elapsed_ns / 1e9,
+        'events_per_second': events / (elapsed_ns / 1e9) if events else None,
+        'ns_per_callback': elapsed_ns / callbacks,
+        'peak_rss_bytes': peak_rss,
+        'bytes_written': bytes_written,
+    }
+
+
+def run_in_child(scenario: str, strategy: str, env: Dict[str, str]) -> Dict[str, Any]:
+    args = [sys.executable, os.path.abspath(__file__), '--child',
+            '--scenario', scenario, '--strategy', strategy]
+    for name, value in env.items():
+        args += ['--env', '%s=%s' % (name, value)]
+    output = subprocess.run(args, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def baseline_results(path: str) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    with open(path) as f:
+        saved = json.load(f)
+    return {(r['scenario'], r['strategy']): r for r in saved['results']}
+
+
+def print_result(r: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    line = '{scenario:>10} {strategy:6} {callbacks:10d} {ns_per_callback:10.0f} ' \
+           '{events_per_second:12.0f} {peak_rss_mb:8.1f} {written_mb:10.1f}'.format(
+               peak_rss_mb=r['peak_rss_bytes'] / 2**20,
+               written_mb=r['bytes_written'] / 2**20,
+               **dict(r, events_per_second=r['events_per_second'] or 0))
+    if baseline:
+        line += ' {:+7.1%}'.format(
+            r['ns_per_callback'] / baseline['ns_per_callback'] - 1)
+    print(line, flush=True)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='hosts x tasks, default: %s' % ', '.join(DEFAULT_SCENARIOS))
+    parser.add_argument('--all', action='store_true', help='run every scenario')
+    parser.add_argument('--strategy', action='append', choices=STRATEGIES)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='callback option, e.g. TRACE_COMPACT=true')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='compare with results saved by --output')
+    parser.add_argument('--budget-ns', type=float,
+                        help='fail if a scenario spends more per callback')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    env = dict(e.split('=', 1) for e in args.env)
+    scenarios = SCENARIOS if args.all else args.scenario or DEFAULT_SCENARIOS
+    strategies = args.strategy or STRATEGIES
+    if args.child:
+        print(json.dumps(run_scenario(scenarios[0], strategies[0], env)))
+        return 0
+
+    baseline = baseline_results(args.baseline) if args.baseline else {}
+    print('%10s %6s %10s %10s %12s %8s %10s%s' % (
+        'scenario', '', 'callbacks', 'ns/call', 'events/s', 'rss MB', 'written MB',
+        ' vs base' if baseline else ''))
+    results = []
+    for scenario in scenarios:
+        for strategy in strategies:
+            r = run_in_child(scenario, strategy, env)
+            print_result(r, baseline.get((scenario, strategy)))
+            results.append(r)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'env': env,
+                'results': results,
+            }, f, indent=2)
+    over_budget = [r for r in results
+                   if args.budget_ns and r['ns_per_callback'] > args.budget_ns]
+    for r in over_budget:
+        print('%s %s: %.0f ns per callback, over the budget of %.0f ns' % (
+            r['scenario'], r['strategy'], r['ns_per_callback'], args.budget_ns),
+            file=sys.stderr)
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+"""
+Compare the size and encoding throughput of the default trace format with the
+compact (TRACE_COMPACT) format, on the events of an existing trace.
+
+    python tests/benchmark/compact_format.py [example-trace.json]
+
+The compact trace is derived from the input by pairing each B event with its
+E event into a single X event, the same way the callback does in compact mode.
+"""
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+REPEAT = 20
+
+
+def to_complete_events(trace: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    complete: List[Dict[str, Any]] = []
+    open_events: Dict[Tuple[int, Any], Dict[str, Any]] = {}
+    for event in trace:
+        if event['ph'] == 'B':
+            open_events[(event['pid'], event['id'])] = event
+        elif event['ph'] == 'E':
+            begin = open_events.pop((event['pid'], event['id']))
+            x = {k: v for k, v in begin.items() if k != 'ph'}
+            x['ph'] = 'X'
+            x['dur'] = event['ts'] - begin['ts']
+            if 'args' in event:
+                x['args'] = dict(begin.get('args') or {}, **event['args'])
+            complete.append(x)
+        else:
+            complete.append(event)
+    return complete
+
+
+def encode(trace: List[Dict[str, Any]], **kwargs) -> str:
+    # Same framing as JsonTraceWriter.
+    encoder = json.JSONEncoder(sort_keys=True, **kwargs)
+    return "[\n" + ",\n".join(encoder.encode(e) for e in trace) + "\n]"
+
+
+def measure(name: str, trace: List[Dict[str, Any]], **kwargs) -> Dict[str, Any]:
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        data = encode(trace, **kwargs)
+    encode_seconds = (time.perf_counter() - start) / REPEAT
+
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        json.loads(data)
+    decode_seconds = (time.perf_counter() - start) / REPEAT
+
+    return {
+        'format': name,
+        'events': len(trace),
+        'bytes': len(data.encode('utf-8')),
+        'encode_events_per_second': len(trace) / encode_seconds,
+        'decode_seconds': decode_seconds,
+    }
+
+
+def main(argv: List[str]) -> None:
+    path = argv[1] if len(argv) > 1 else os.path.join(
+        os.path.dirname(__file__), '..', '..', 'example-trace.json')
+    with open(path, encoding='utf-8') as f:
+        trace = json.load(f)
+
+    results = [
+        measure('default', trace, indent=2),
+        measure('compact', to_complete_events(trace), separators=(',', ':')),
+    ]
+    for r in results:
+        print('{format:8} {events:6d} events {bytes:9d} bytes '
+              '{encode_events_per_second:10.0f} events/s encoded '
+              '{decode_seconds:8.4f} s to decode'.format(**r))
+    default, compact = results
+    print('compact: {:.0%} of the events, {:.0%} of the bytes'.format(
+        compact['events'] / default['events'],
+        compact['bytes'] / default['bytes']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,101 @@
+"""
+Stand-ins for the Ansible objects the trace callback is called with, to drive
+CallbackModule directly without running a playbook.
+
+    callback = load_callback(output_dir)
+    play = FakePlay('site')
+    callback.v2_playbook_on_play_start(play)
+    ...
+    callback._end()
+
+Only the attributes the callback reads are provided.
+"""
+import atexit
+import importlib.util
+import itertools
+import os
+from typing import Any, Dict, List, Optional
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', '..', 'plugins', 'callback', 'trace.py')
+
+_uuids = itertools.count(1)
+
+
+def _uuid() -> str:
+    return '%012x' % next(_uuids)
+
+
+def load_plugin():
+    spec = importlib.util.spec_from_file_location('ansible_trace_callback', PLUGIN)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_callback(output_dir: str, **env: str):
+    """A CallbackModule writing to output_dir, configured by TRACE_* env.
+
+    The callback is not ended at exit: call its _end.
+    """
+    env = dict(env, TRACE_OUTPUT_DIR=output_dir)
+    saved_env = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        callback = load_plugin().CallbackModule()
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+    atexit.unregister(callback._end)
+    return callback
+
+
+class FakePlay:
+
+    def __init__(self, name: str):
+        self._uuid = _uuid()
+        self.name = name
+
+    def get_name(self) -> str:
+        return self.name
+
+
+class FakeTask:
+
+    def __init__(self, name: str, path: str = 'site.yml:1',
+                 args: Optional[Dict[str, Any]] = None, no_log: bool = False,
+                 notify: Optional[List[str]] = None):
+        self._uuid = _uuid()
+        self.name = name
+        self.path = path
+        self.args = args if args is not None else {}
+        self.no_log = no_log
+        self.notify = notify
+
+    def get_name(self) -> str:
+        return self.name
+
+    def get_path(self) -> str:
+        return self.path
+
+
+class FakeHost:
+
+    def __init__(self, name: str):
+        self._uuid = _uuid()
+        self.name = name
+
+    def get_name(self) -> str:
+        return self.name
+
+
+class FakeResult:
+
+    def __init__(self, host: FakeHost, task: FakeTask,
+                 result: Optional[Dict[str, Any]] = None):
+        self._host = host
+        self._task = task
+        self._result = result if result is not None else {}
@@ -0,0 +1,81 @@
+"""
+Show that the callback's memory stays flat over a long run with ephemeral
+hosts and included tasks.
+
+    python tests/benchmark/state_memory.py [--plays 2000]
+
+Drives CallbackModule directly with fake objects: every play runs freshly
+included tasks (new task uuids, as include_tasks in a loop creates) on a
+fresh batch of hosts, with some hosts never returning a result. Prints the
+memory allocated by Python (tracemalloc) and the process RSS every few
+hundred plays, and checks the trace stays balanced with
+tools/trace_validate.py.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import tracemalloc
+from typing import List
+
+from fakes import FakeHost, FakePlay, FakeResult, FakeTask, load_callback
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'tools'))
+from trace_reader import iter_events  # noqa: E402
+from trace_validate import validate  # noqa: E402
+
+HOSTS = 20
+TASKS = 10
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+
+def run(output_dir: str, plays: int, report_every: int) -> str:
+    callback = load_callback(output_dir, TRACE_COMPACT='true',
+                             TRACE_DEDUPLICATE_TASK_ARGUMENTS='true')
+    tracemalloc.start()
+    print('%8s %12s %12s %14s %12s' % (
+        'plays', 'tasks', 'hosts', 'traced bytes', 'rss bytes'))
+    for play_number in range(1, plays + 1):
+        play = FakePlay('play %d' % play_number)
+        callback.v2_playbook_on_play_start(play)
+        hosts = [FakeHost('host-%d-%d' % (play_number, h)) for h in range(HOSTS)]
+        for t in range(TASKS):
+            task = FakeTask('task %d' % t, 'included.yml:%d' % t,
+                            {'_raw_params': 'echo %d' % t})
+            callback.v2_playbook_on_task_start(task, False)
+            for host in hosts:
+                callback.v2_runner_on_start(host, task)
+            for i, host in enumerate(hosts):
+                # The last host vanishes in the last task of each play.
+                if t < TASKS - 1 or i < HOSTS - 1:
+                    callback.v2_runner_on_ok(FakeResult(host, task))
+        if play_number % report_every == 0:
+            current, _ = tracemalloc.get_traced_memory()
+            print('%8d %12d %12d %14d %12d' % (
+                play_number, play_number * TASKS, play_number * HOSTS,
+                current, rss_bytes()))
+    tracemalloc.stop()
+    callback._end()
+    return os.path.join(output_dir, callback._output_file)
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--plays', type=int, default=2000)
+    parser.add_argument('--report-every', type=int, default=250)
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = run(tmp, args.plays, args.report_every)
+        print('%s: %d events ok' % (os.path.basename(path),
+                                    validate(iter_events(path))))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+"""
+Show that the streaming validator's memory stays flat as traces grow, where
+loading the trace with json.load grows with it.
+
+    python tests/benchmark/validate_memory.py [--compact]
+
+Writes synthetic traces of longer and longer runs of linear plays of 10
+tasks over 100 hosts, in the same layout as JsonTraceWriter, and measures
+the peak memory allocated while validating each with
+tools/trace_validate.py, and while json.load-ing it, with tracemalloc.
+Compact traces keep the complete events of a play until the play's own
+complete event arrives, so their peak follows the size of a play, plus a
+few bytes per host for each play.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, Iterator, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'tools'))
+from trace_reader import iter_events  # noqa: E402
+from trace_validate import validate  # noqa: E402
+
+HOSTS = 100
+TASKS = 10
+PLAYS = (1, 10, 100)
+
+
+def synthetic_events(hosts: int, tasks: int, plays: int,
+                     compact: bool) -> Iterator[Dict[str, Any]]:
+    for pid in range(1, hosts + 1):
+        yield {"name": "process_name", "pid": pid, "cat": "process", "ph": "M",
+               "args": {"name": "host%d" % pid}}
+    ts = 0.0
+    for play in range(1, plays + 1):
+        yield from synthetic_play(hosts, tasks, play, ts, compact)
+        ts += tasks * (1000 + 11 * hosts) + 1000
+
+
+def synthetic_play(hosts: int, tasks: int, play: int, ts: float,
+                   compact: bool) -> Iterator[Dict[str, Any]]:
+    play_start = ts
+    if not compact:
+        for pid in range(1, hosts + 1):
+            yield {"name": "play", "cat": "play", "ph": "B", "ts": ts,
+                   "pid": pid, "id": play, "args": {"host": "host%d" % pid}}
+    for task in range(tasks):
+        args = {"args": {"_raw_params": "echo %d" % task},
+                "task": "task %d" % task, "path": "site.yml:%d" % task}
+        for pid in range(1, hosts + 1):
+            ts += 10
+            start, end = ts, ts + 1000 + pid
+            span_args = dict(args, host="host%d" % pid)
+            if compact:
+                yield {"name": "task %d" % task, "cat": "runner", "ph": "X",
+                       "ts": start, "dur": end - start, "pid": pid,
+                       "id": play * tasks + task + 100,
+                       "args": dict(span_args, status="ok")}
+            else:
+                yield {"name": "task %d" % task, "cat": "runner", "ph": "B",
+                       "ts": start, "pid": pid, "id": play * tasks + task + 100,
+                       "args": span_args}
+                yield {"name": "task %d" % task, "cat": "runner", "ph": "E",
+                       "ts": end, "pid": pid, "id": play * tasks + task + 100,
+                       "args": {"status": "ok"}}
+        ts += 1000 + hosts
+    for pid in range(1, hosts + 1):
+        if compact:
+            yield {"name": "play", "cat": "play", "ph": "X", "ts": play_start,
+                   "dur": ts - play_start, "pid": pid, "id": play,
+                   "args": {"host": "host%d" % pid}}
+        else:
+            yield {"name": "play", "cat": "play", "ph": "E", "ts": ts,
+                   "pid": pid, "id": play}
+
+
+def write_trace(path: str, events: Iterator[Dict[str, Any]], compact: bool):
+    # Same framing as JsonTraceWriter.
+    if compact:
+        encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+    else:
+        encoder = json.JSONEncoder(sort_keys=True, indent=2)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("[\n")
+        for i, event in enumerate(events):
+            if i:
+                f.write(",\n")
+            f.write(encoder.encode(event))
+        f.write("\n]")
+
+
+def peak_memory(fn) -> Dict[str, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'peak_bytes': peak, 'seconds': seconds}
+
+
+def main(argv: List[str]) -> None:
+    compact = '--compact' in argv
+    print('%8s %10s %12s %14s %10s %14s' % (
+        'plays', 'events', 'trace bytes', 'validate peak', 'seconds',
+        'json.load peak'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for plays in PLAYS:
+            path = os.path.join(tmp, 'trace-%d.json' % plays)
+            write_trace(path, synthetic_events(HOSTS, TASKS, plays, compact),
+                        compact)
+            counted: List[int] = []
+            streamed = peak_memory(
+                lambda: counted.append(validate(iter_events(path))))
+
+            def load():
+                with open(path, encoding='utf-8') as f:
+                    json.load(f)
+            loaded = peak_memory(load)
+            print('%8d %10d %12d %14d %10.2f %14d' % (
+                plays, counted[0], os.path.getsize(path),
+                streamed['peak_bytes'], streamed['seconds'],
+                loaded['peak_bytes']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,75 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, get_last_trace_file, run_tool
+import json
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+def test_analyze_multiple_linear(ansible_play, tmp_path):
+    trace_json: JSONTYPE = get_last_trace()
+    report = json.loads(run_tool('trace_analyze', '--json', get_last_trace_file()))
+
+    runners = [e for e in trace_json if e['ph'] == 'B' and e['cat'] == 'runner']
+    hosts = {e['args']['host'] for e in runners}
+    assert len(report['plays']) == 1
+    play = report['plays'][0]
+    assert play['hosts'] == len(hosts)
+    assert play['lockstep']
+    assert [t['task'] for t in play['tasks']] == [
+        'Gathering Facts', 'Ping self', 'Hello world']
+    for task in play['tasks']:
+        assert task['hosts'] == len(hosts)
+        assert task['min_us'] <= task['p50_us'] <= task['p95_us'] \
+            <= task['p99_us'] <= task['max_us']
+        assert task['wait_us'] >= 0
+    assert play['wait_us'] == pytest.approx(
+        sum(t['wait_us'] for t in play['tasks']))
+
+    # The critical path runs through every task, ending with the run that
+    # ended last, and its steps and gaps add up to the play.
+    path = play['critical_path']
+    assert path[0]['task'] == 'Gathering Facts'
+    assert path[-1]['task'] == 'Hello world'
+    assert all(step['gap_us'] >= 0 for step in path)
+    assert play['critical_path_task_us'] + play['critical_path_gap_us'] \
+        == pytest.approx(play['duration_us'])
+
+    assert sorted(h['host'] for h in report['hosts']) == sorted(hosts)
+    busy = [h['busy_us'] for h in report['hosts']]
+    assert busy == sorted(busy, reverse=True)
+
+    # An in-progress trace is read up to its last complete event.
+    with open(get_last_trace_file(), encoding='utf-8') as f:
+        data = f.read()
+    partial = tmp_path / 'partial.json'
+    partial.write_text(data[:len(data) * 2 // 3])
+    report = json.loads(run_tool('trace_analyze', '--json', str(partial)))
+    assert report['plays'][0]['tasks'][0]['task'] == 'Gathering Facts'
+    assert 'Slowest hosts' in run_tool('trace_analyze', str(partial))
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_COMPACT': 'True', 'TRACE_COMPRESSION': 'gzip'})
+def test_analyze_compact_gzip_multiple_free(ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    report = json.loads(run_tool('trace_analyze', '--json', get_last_trace_file()))
+
+    plays = [e for e in trace_json if e['ph'] == 'X' and e['cat'] == 'play']
+    assert [p['play'] for p in report['plays']] == list(
+        {e['id']: e['name'] for e in plays}.values())
+    runners = [e for e in trace_json if e['ph'] == 'X' and e['cat'] == 'runner']
+    assert sum(t['hosts'] for p in report['plays'] for t in p['tasks']) \
+        == len(runners)
+    for play in report['plays']:
+        path = play['critical_path']
+        assert path
+        assert all(step['gap_us'] >= 0 for step in path)
+        assert play['critical_path_task_us'] + play['critical_path_gap_us'] \
+            == pytest.approx(play['duration_us'])
@@ -2,6 +2,7 @@
 from typing import Union, Dict, List, Any
 from utils import get_last_trace, parse_and_validate_trace
 from event import HostEvent
+import time
 import pytest
 
 JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
@@ -26,6 +27,15 @@ def test_basic_multiple_linear(ansible_play):
     trace_json: JSONTYPE = get_last_trace()
     trace_hosts, trace_events = parse_and_validate_trace(trace_json)
 
+    # Timestamps are whole microseconds since the run started, at the wall
+    # clock time in the trace info.
+    origin = trace_json[0]['args']['time_origin_unix_us']
+    assert 0 < time.time() * 1e6 - origin < 600e6
+    timed = [e for e in trace_json if 'ts' in e]
+    assert all(isinstance(e['ts'], int) and isinstance(e.get('dur', 0), int)
+               for e in timed)
+    assert 0 <= min(e['ts'] for e in timed) < 600e6
+
 
 @pytest.mark.ansible_playbook('basic/basic.yml')
 @pytest.mark.ansible_inventory('inventories/one_host.ini')
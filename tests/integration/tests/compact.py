@@ -0,0 +1,34 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, parse_and_validate_trace
+from event import HostEvent
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_COMPACT': 'True'})
+def test_compact_multiple_free(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+    assert all(event['ph'] in ('M', 'X') for event in trace_json)
+
+
+@pytest.mark.ansible_playbook('include_task/playbook_templating.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_COMPACT': 'True'})
+def test_compact_include_task_templating_multiple_linear(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+    for host_events in trace_events.values():
+        for event in host_events.values():
+            if event['X'].name != 'all':
+                assert 'parent_id' in event
@@ -0,0 +1,84 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, get_last_trace_file, parse_and_validate_trace
+from event import HostEvent
+from fakes import FakeHost, FakePlay, FakeResult, FakeTask, load_callback
+import importlib.util
+import time
+import zlib
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_COMPRESSION': 'gzip'})
+def test_gzip_multiple_free(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    assert get_last_trace_file().endswith('.json.gz')
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_COMPRESSION': 'gzip',
+                          'TRACE_FLUSH_INTERVAL': '0'})
+def test_gzip_flush_points_multiple_linear(ansible_play):
+    # Every event is flushed, so the file without its final block and
+    # trailer, as it was before the atexit hook ran, still decompresses.
+    with open(get_last_trace_file(), 'rb') as f:
+        data = f.read()
+    partial = zlib.decompressobj(wbits=31).decompress(data[:-10])
+    assert partial.startswith(b'[\n{')
+    assert len(partial) > len(data)
+
+
+def test_gzip_flushed_during_long_task(tmp_path):
+    callback = load_callback(str(tmp_path), TRACE_COMPRESSION='gzip',
+                             TRACE_FLUSH_INTERVAL='0.1')
+    host, task = FakeHost('web'), FakeTask('Long task')
+    callback.v2_playbook_on_play_start(FakePlay('site'))
+    callback.v2_playbook_on_task_start(task, False)
+    callback.v2_runner_on_start(host, task)
+    # No more events are written while the task runs, yet its start reaches
+    # the file within the flush interval.
+    time.sleep(0.5)
+    with open(tmp_path / (callback._output_file + '.gz'), 'rb') as f:
+        partial = zlib.decompressobj(wbits=31).decompress(f.read())
+    callback._end()
+    assert b'"Long task"' in partial
+
+
+def test_uncompressed_not_flushed_per_event(tmp_path):
+    callback = load_callback(str(tmp_path), TRACE_FLUSH_INTERVAL='60')
+    host = FakeHost('web')
+    callback.v2_playbook_on_play_start(FakePlay('site'))
+    for i in range(3):
+        task = FakeTask('Task %d' % i)
+        callback.v2_playbook_on_task_start(task, False)
+        callback.v2_runner_on_start(host, task)
+        callback.v2_runner_on_ok(FakeResult(host, task))
+    # Events wait in the buffer until the interval passes or the run ends.
+    path = tmp_path / callback._output_file
+    assert b'"Task 0"' not in path.read_bytes()
+    callback._end()
+    assert b'"Task 2"' in path.read_bytes()
+
+
+@pytest.mark.skipif(importlib.util.find_spec('zstandard') is None,
+                    reason='zstandard is not installed')
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_COMPRESSION': 'zstd'})
+def test_zstd_multiple_linear(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    assert get_last_trace_file().endswith('.json.zst')
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
@@ -0,0 +1,54 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import (get_last_trace, get_last_trace_file, open_trace_file,
+                   parse_and_validate_trace, parse_perfetto_trace)
+from event import HostEvent
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_COUNTERS': 'True',
+                          'TRACE_COUNTER_INTERVAL': '0',
+                          'TRACE_FORMAT': 'json,protobuf'})
+def test_counters_multiple_free(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    controller = [pid for pid, host in trace_hosts.items()
+                  if host.name == 'controller']
+    assert len(controller) == 1
+    counters = [e for e in trace_json if e['ph'] == 'C']
+    assert all(e['pid'] == controller[0] for e in counters)
+    in_flight = [e['args']['in_flight'] for e in counters]
+    assert max(in_flight) >= 1
+    assert in_flight[-1] == 0
+    assert all(e['args']['active_hosts'] <= e['args']['in_flight']
+               for e in counters)
+    assert max(e['args']['completed_per_second'] for e in counters) >= 1
+
+    with open_trace_file(get_last_trace_file('trace/*.pftrace*')) as f:
+        parse_perfetto_trace(f.read())
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_COUNTERS': 'True',
+                          'TRACE_COUNTER_INTERVAL': '3600'})
+def test_counters_rate_limited_multiple_linear(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    # Only the counter events forced at the start of the play and the end of
+    # the playbook.
+    counters = [e for e in trace_json if e['ph'] == 'C']
+    assert len(counters) == 2
+    assert counters[-1]['args']['in_flight'] == 0
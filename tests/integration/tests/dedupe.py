@@ -0,0 +1,51 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import (get_last_trace, get_last_trace_file, open_trace_file,
+                   parse_and_validate_trace, parse_perfetto_trace)
+from event import HostEvent
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_DEDUPLICATE_TASK_ARGUMENTS': 'True'})
+def test_deduplicate_task_arguments_multiple_linear(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    task_args = {e['args']['ref']: e['args'] for e in trace_json
+                 if e['ph'] == 'M' and e['name'] == 'task_args'}
+    runners = [e for e in trace_json if e['ph'] == 'B' and e['cat'] == 'runner']
+    # One record per task (including fact gathering), shared by every host.
+    assert len(task_args) == 3
+    assert len(runners) == 3 * len(trace_hosts)
+    for runner in runners:
+        assert 'args' not in runner['args']
+        assert task_args[runner['args']['args_ref']]['path'] == runner['args']['path']
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_DEDUPLICATE_TASK_ARGUMENTS': 'True',
+                          'TRACE_COMPACT': 'True',
+                          'TRACE_FORMAT': 'json,protobuf'})
+def test_deduplicate_task_arguments_protobuf_multiple_free(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    with open_trace_file(get_last_trace_file('trace/*.pftrace*')) as f:
+        tracks, slices = parse_perfetto_trace(f.read())
+    # The protobuf trace interns arguments itself, so it gets them back.
+    for track_slices in slices.values():
+        for s in track_slices:
+            if s['cat'] == 'runner':
+                assert 'args_ref' not in s['args']
+                assert s['args']['args'].startswith('{')
@@ -0,0 +1,73 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, get_last_trace_file, run_tool
+import json
+import subprocess
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+def slow_down(trace: JSONTYPE, task: str, us: float) -> JSONTYPE:
+    # Make the task take us longer on every host, and later events later.
+    delayed: set = set()
+    slowed = []
+    for e in trace:
+        e = dict(e)
+        if e['ph'] in ('B', 'E') and e['pid'] in delayed:
+            e['ts'] += us
+        elif e['ph'] == 'E' and e['name'] == task:
+            e['ts'] += us
+            delayed.add(e['pid'])
+        slowed.append(e)
+    return slowed
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+def test_diff_multiple_linear(ansible_play, tmp_path):
+    trace_json: JSONTYPE = get_last_trace()
+    path = get_last_trace_file()
+
+    # A run doesn't regress against itself.
+    report = json.loads(run_tool('trace_diff', '--json', path, path))
+    assert report['regressions'] == 0
+    assert {t['task'] for t in report['tasks']} == {
+        'Gathering Facts', 'Ping self', 'Hello world'}
+    assert all(t['delta_us'] == 0 for t in report['tasks'])
+    assert [p['play'] for p in report['plays']] == ['all']
+    assert not report['added'] and not report['removed']
+
+    slower = tmp_path / 'slower.json'
+    slower.write_text(json.dumps(slow_down(trace_json, 'Hello world', 2e6)))
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        run_tool('trace_diff', path, path, str(slower))
+    assert 'task "Hello world"' in e.value.output
+    report = json.loads(run_tool('trace_diff', '--json', '--top', '3',
+                                 path, path, str(slower), check=False))
+    assert report['regressions'] >= 1
+    regressed = [t for t in report['tasks'] if t['regressed']]
+    assert [t['task'] for t in regressed] == ['Hello world']
+    assert regressed[0]['delta_us'] == pytest.approx(2e6)
+    assert len(regressed[0]['slowest_hosts']) == 3
+    assert all(h['delta_us'] == pytest.approx(2e6)
+               for h in regressed[0]['slowest_hosts'])
+
+    # Under the threshold, and the other way round, it's not a regression.
+    report = json.loads(run_tool('trace_diff', '--json', '--min-delta', '3',
+                                 path, str(slower)))
+    assert report['regressions'] == 0
+    report = json.loads(run_tool('trace_diff', '--json', str(slower), path))
+    assert report['regressions'] == 0
+    assert [t['task'] for t in report['tasks'] if t['improved']] == ['Hello world']
+
+    # Tasks are matched by path as well as name.
+    moved = [dict(e, args=dict(e['args'], path='elsewhere.yml:1'))
+             if e['ph'] == 'B' and e['name'] == 'Ping self' else e
+             for e in trace_json]
+    moved_path = tmp_path / 'moved.json'
+    moved_path.write_text(json.dumps(moved))
+    report = json.loads(run_tool('trace_diff', '--json', path, str(moved_path)))
+    assert [t['path'] for t in report['added']] == ['elsewhere.yml:1']
+    assert [t['task'] for t in report['removed']] == ['Ping self']
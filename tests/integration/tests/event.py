@@ -32,6 +32,30 @@ class DurationEvent(Event):
 
         super().__init__(dict)
 
+class CompleteEvent(Event):
+
+    id: int
+    ts: float
+    dur: float
+
+    def __init__(self, dict):
+        if not 'id' in dict:
+            raise ValueError('Complete event needs to have id')
+        self.id = dict['id']
+        if not 'ts' in dict:
+            raise ValueError('Complete event {} needs to have a timestamp'.format(self.id))
+        if not 'dur' in dict or dict['dur'] < 0:
+            raise ValueError('Complete event {} needs to have a positive duration'.format(self.id))
+        if not 'name' in dict:
+            raise ValueError('Complete event {} needs to have a name'.format(self.id))
+        if not 'ph' in dict or dict['ph'] != 'X':
+            raise ValueError('Complete event {} needs to have a ph set to X'.format(self.id))
+        self.ts = dict['ts']
+        self.dur = dict['dur']
+        self.name = dict['name']
+
+        super().__init__(dict)
+
 class HostEvent(Event):
 
     def __init__(self, dict):
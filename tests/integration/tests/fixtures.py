@@ -18,6 +18,19 @@ def ansible_play(request):
     # Assign strategy
     os.environ["ANSIBLE_STRATEGY"] = strategy
 
+    # Assign optional environment, e.g. trace plugin options
+    env_marker = request.node.get_closest_marker('ansible_env')
+    env = env_marker.args[0] if env_marker else {}
+    saved_env = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+
     # Test required playbook
-    with runner(request, [playbook]):
-        yield
+    try:
+        with runner(request, [playbook]):
+            yield
+    finally:
+        for key, value in saved_env.items():
+            if value is None:
+                del os.environ[key]
+            else:
+                os.environ[key] = value
@@ -0,0 +1,97 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import (get_last_trace, get_last_trace_file, parse_and_validate_trace,
+                   run_tool)
+from trace_reader import iter_spans
+from fakes import FakeHost, FakePlay, FakeResult, FakeTask, load_callback
+import json
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+def check_flows(trace_json: JSONTYPE) -> None:
+    hosts, _ = parse_and_validate_trace(trace_json)
+    spans = list(iter_spans(trace_json))
+    handlers = [s for s in spans if s.cat == 'handler']
+    assert sorted({s.name for s in handlers}) == ['Reload service', 'Restart service']
+    assert len(handlers) == 2 * len(hosts)
+    for s in handlers:
+        assert s.args['notified_by'] == (
+            ['Change config'] if s.name == 'Restart service' else ['Change unit'])
+    assert all(s.cat == 'runner' for s in spans
+               if s.name in ('Change config', 'Included first'))
+
+    starts = {e['id']: e for e in trace_json if e['ph'] == 's'}
+    finishes = {e['id']: e for e in trace_json if e['ph'] == 'f'}
+    assert starts.keys() == finishes.keys()
+    flows: Dict[str, List[str]] = {}
+    for flow_id, start in starts.items():
+        finish = finishes[flow_id]
+        assert finish['bp'] == 'e'
+        # Each end of the flow is within the span it binds to.
+        source = [s for s in spans if s.pid == start['pid']
+                  and s.cat == 'runner' and s.ts < start['ts'] < s.end]
+        target = [s for s in spans if s.pid == finish['pid']
+                  and s.cat in ('runner', 'handler') and s.ts == finish['ts']]
+        assert start['pid'] == finish['pid']
+        assert len(source) == 1 and len(target) == 1
+        flows.setdefault(start['name'], []).append(
+            '%s -> %s' % (source[0].name, target[0].name))
+    assert sorted(set(flows['notify'])) == [
+        'Change config -> Restart service', 'Change unit -> Reload service']
+    assert sorted(set(flows['include'])) == [
+        'Include tasks -> Included first', 'Include tasks -> Included second']
+    assert len(flows['notify']) == len(flows['include']) == 2 * len(hosts)
+
+    report = json.loads(run_tool('trace_analyze', '--json', get_last_trace_file()))
+    notified = {(n['task'], n['handler']): n['runs']
+                for n in report['notified_handlers']}
+    assert notified == {('Change config', 'Restart service'): len(hosts),
+                        ('Change unit', 'Reload service'): len(hosts)}
+
+
+@pytest.mark.ansible_playbook('handlers/handlers.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+def test_handlers_multiple_linear(ansible_play):
+    check_flows(get_last_trace())
+
+
+@pytest.mark.ansible_playbook('handlers/handlers.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_COMPACT': 'True'})
+def test_handlers_multiple_free(ansible_play):
+    check_flows(get_last_trace())
+
+
+def test_handlers_notified_before_result(tmp_path):
+    # Up to Ansible 2.13, handlers are notified while the notifying task
+    # still runs, before its result.
+    callback = load_callback(str(tmp_path))
+    host = FakeHost('web')
+    handler = FakeTask('Restart service')
+    callback.v2_playbook_on_play_start(FakePlay('site'))
+    for name in ['Change config', 'Change unit']:
+        task = FakeTask(name, notify=['Restart service'])
+        callback.v2_playbook_on_task_start(task, False)
+        callback.v2_runner_on_start(host, task)
+        callback.v2_playbook_on_notify(handler, host)
+        callback.v2_runner_on_ok(FakeResult(host, task, {'changed': True}))
+    callback.v2_playbook_on_handler_task_start(handler)
+    callback.v2_runner_on_start(host, handler)
+    callback.v2_runner_on_ok(FakeResult(host, handler))
+    callback._end()
+
+    with open(tmp_path / callback._output_file) as f:
+        trace_json: JSONTYPE = json.load(f)
+    parse_and_validate_trace(trace_json)
+    spans = {s.name: s for s in iter_spans(trace_json)}
+    assert spans['Restart service'].args['notified_by'] == [
+        'Change config', 'Change unit']
+    # Each flow starts within the span of the task that notified.
+    starts = sorted(e['ts'] for e in trace_json if e['ph'] == 's')
+    assert len(starts) == 2
+    for ts, name in zip(starts, ['Change config', 'Change unit']):
+        assert spans[name].ts <= ts <= spans[name].end
@@ -0,0 +1,146 @@
+# Handle integration tests
+from typing import Dict, List, Any, Tuple
+from utils import parse_and_validate_trace
+from fakes import FakeHost, FakePlay, FakeResult, FakeTask, load_callback
+import json
+import socket
+import threading
+import time
+
+
+def connect(url: str) -> socket.socket:
+    if url.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(url[len('unix:'):])
+        return sock
+    host, port = url[len('http://'):].rsplit(':', 1)
+    return socket.create_connection((host, int(port)))
+
+
+def request(url: str, path: str) -> Tuple[socket.socket, bytes]:
+    """Sends a GET request, returning the socket and the response headers."""
+    sock = connect(url)
+    sock.sendall(b'GET %s HTTP/1.0\r\n\r\n' % path.encode())
+    data = b''
+    while b'\r\n\r\n' not in data:
+        data += sock.recv(1)
+    return sock, data
+
+
+def get_summary(url: str) -> Dict[str, Any]:
+    sock, headers = request(url, '/summary')
+    assert headers.startswith(b'HTTP/1.0 200')
+    body = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        body += chunk
+    sock.close()
+    return json.loads(body)
+
+
+def read_stream(sock: socket.socket) -> List[Tuple[str, Any]]:
+    """The (event type, data) of each server-sent event, until the end."""
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+    events = []
+    for message in data.decode('utf-8').split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in message.split('\n')
+                      if ': ' in line and not line.startswith(':'))
+        if 'data' in fields:
+            events.append((fields.get('event', 'message'), json.loads(fields['data'])))
+    return events
+
+
+def test_live_events_and_summary(tmp_path):
+    callback = load_callback(str(tmp_path), TRACE_LIVE_ADDRESS='127.0.0.1:0')
+    url = callback._live_server.url
+    hosts = [FakeHost('web1'), FakeHost('web2')]
+    task = FakeTask('Install packages', 'site.yml:3')
+    callback.v2_playbook_on_play_start(FakePlay('Deploy'))
+    callback.v2_playbook_on_task_start(task, False)
+    callback.v2_runner_on_start(hosts[0], task)
+
+    # A client joining mid-run gets the trace's metadata and the hosts seen
+    # so far, then new events.
+    sock, headers = request(url, '/events')
+    assert b'text/event-stream' in headers
+    received: List[Tuple[str, Any]] = []
+    reader = threading.Thread(target=lambda: received.extend(read_stream(sock)))
+    reader.start()
+    callback.v2_runner_on_start(hosts[1], task)
+
+    summary = get_summary(url)
+    assert summary['hosts'] == 2
+    assert summary['hosts_in_flight'] == 2
+    assert summary['tasks_in_flight'] == 2
+    assert summary['plays'] == [{
+        'id': 1, 'play': 'Deploy', 'start_us': summary['plays'][0]['start_us'],
+        'hosts': 2, 'started': 2, 'finished': {}}]
+    assert [r['host'] for r in summary['slowest_running']] == ['web1', 'web2']
+    assert summary['slowest_running'][0]['path'] == 'site.yml:3'
+
+    callback.v2_runner_on_ok(FakeResult(hosts[0], task))
+    callback.v2_runner_on_failed(FakeResult(hosts[1], task))
+    summary = get_summary(url)
+    assert summary['tasks_in_flight'] == 0
+    assert summary['plays'][0]['finished'] == {'ok': 1, 'failed': 1}
+    callback._end()
+    reader.join(5)
+
+    assert received[-1] == ('end', {})
+    events = [data for kind, data in received if kind == 'message']
+    with open(tmp_path / callback._output_file) as f:
+        trace_json = json.load(f)
+    parse_and_validate_trace(trace_json)
+    # The trace info and web1's process name, then everything written after
+    # the client joined.
+    assert [(e['ph'], e['cat']) for e in trace_json[:4]] == [
+        ('M', 'trace_info'), ('M', 'process'), ('B', 'play'), ('B', 'runner')]
+    assert events == trace_json[:2] + trace_json[4:]
+
+
+def test_live_slow_client_skips_ahead(tmp_path):
+    socket_path = str(tmp_path / 'live.sock')
+    callback = load_callback(str(tmp_path / 'trace'), TRACE_COMPACT='True',
+                             TRACE_LIVE_ADDRESS='unix:' + socket_path,
+                             TRACE_LIVE_BUFFER_SIZE='100')
+    assert callback._live_server.url == 'unix:' + socket_path
+    sock, _ = request(callback._live_server.url, '/events')
+
+    # The client doesn't read while the run goes on.
+    host = FakeHost('web1')
+    callback.v2_playbook_on_play_start(FakePlay('Deploy'))
+    start = time.monotonic()
+    for i in range(5000):
+        task = FakeTask('Task %d' % i, 'site.yml:%d' % i, {'msg': 'x' * 1000})
+        callback.v2_playbook_on_task_start(task, False)
+        callback.v2_runner_on_start(host, task)
+        callback.v2_runner_on_ok(FakeResult(host, task))
+    assert time.monotonic() - start < 30
+
+    summary = get_summary(callback._live_server.url)
+    # Compact traces only write the play's span when it ends.
+    assert summary['plays'] == [{
+        'id': None, 'play': None, 'start_us': None, 'hosts': 0,
+        'started': 5000, 'finished': {'ok': 5000}}]
+
+    received: List[Tuple[str, Any]] = []
+    reader = threading.Thread(target=lambda: received.extend(read_stream(sock)))
+    reader.start()
+    callback._end()
+    reader.join(5)
+    dropped = sum(data['dropped'] for kind, data in received if kind == 'dropped')
+    events = [data for kind, data in received if kind == 'message']
+    assert dropped > 0
+    assert received[-1] == ('end', {})
+    # The client skipped ahead to the end of the run.
+    assert events[-1]['cat'] == 'play'
+    assert len(events) + dropped == 5000 + 3
+    assert not (tmp_path / 'live.sock').exists()
@@ -0,0 +1,183 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, parse_and_validate_trace
+from event import HostEvent
+from fakes import FakeHost, FakePlay, FakeResult, FakeTask, load_callback
+import sys
+import threading
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('loops/loops.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+def test_loops_multiple_linear(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    items = [e for e in trace_json if e['ph'] == 'B' and e['cat'] == 'item']
+    assert len(items) == 3 * len(trace_hosts)
+    for pid, host_events in trace_events.items():
+        host_items = sorted((host_events[e['id']] for e in items
+                             if e['pid'] == pid),
+                            key=lambda e: e['B'].ts)
+        assert [e['B'].name for e in host_items] == ['1', '3', '2']
+        assert all(e['E'].ts - e['B'].ts >= 100000 for e in host_items)
+        # Each item starts where the previous one ended, within the task.
+        for previous, item in zip(host_items, host_items[1:]):
+            assert item['B'].ts == previous['E'].ts
+        parents = {e['parent_id'] for e in host_items}
+        assert len(parents) == 1
+        assert host_events[parents.pop()]['B'].name == 'Loop over items'
+
+    jobs = [e for e in trace_json if e['ph'] == 'E' and e['cat'] == 'async']
+    assert len(jobs) == len(trace_hosts)
+    assert all(e['args']['status'] == 'ok' for e in jobs)
+    # Polls are instants within their job's span.
+    for poll in (e for e in trace_json if e['ph'] == 'i'):
+        job = next(e for e in trace_json if e['ph'] == 'B' and e['cat'] == 'async'
+                   and e['args']['jid'] == poll['args']['jid'])
+        job_events = trace_events[job['pid']][job['id']]
+        assert poll['pid'] == job['pid']
+        assert job_events['B'].ts <= poll['ts'] <= job_events['E'].ts
+
+
+@pytest.mark.ansible_playbook('loops/loops.yml')
+@pytest.mark.ansible_inventory('inventories/one_host.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_COMPACT': 'True', 'TRACE_REMOTE_TIME': 'True',
+                          'TRACE_HIDE_TASK_ARGUMENTS': 'True'})
+def test_loops_compact_remote_time_single_free(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    # Item values are hidden along with task arguments.
+    for pid in trace_hosts:
+        items = [e for e in trace_json
+                 if e['ph'] == 'X' and e['cat'] == 'item' and e['pid'] == pid]
+        assert [e['name'] for e in items] == ['item 0', 'item 1', 'item 2']
+
+    # The async job's remote time is split within the job's span.
+    jobs = [e for e in trace_json if e['ph'] == 'X' and e['cat'] == 'async']
+    assert len(jobs) == len(trace_hosts)
+    for job in jobs:
+        remote = next(e for e in trace_json if e['ph'] == 'X'
+                      and e['cat'] == 'remote' and e['pid'] == job['pid'])
+        host_events = trace_events[job['pid']]
+        assert host_events[remote['id']]['parent_id'] == job['id']
+        assert remote['dur'] >= 2000000
+        assert 0 <= job['args']['poll_wait_us'] <= 1500000
+
+
+@pytest.mark.ansible_playbook('loops/background.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_ITEM_SPANS': 'False'})
+def test_loops_background_job_multiple_linear(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    # A job left running with poll: 0 runs from its task's start, over the
+    # task in between, until it finishes.
+    begins = [e for e in trace_json if e['ph'] == 'b']
+    ends = {(e['pid'], e['id']): e for e in trace_json if e['ph'] == 'e'}
+    assert len(begins) == len(ends) == len(trace_hosts)
+    for begin in begins:
+        end = ends[(begin['pid'], begin['id'])]
+        assert begin['cat'] == end['cat'] == 'async'
+        assert begin['args']['task'] == 'Start job'
+        assert end['args']['status'] == 'ok'
+        assert end['ts'] - begin['ts'] >= 2000000
+        runners = {e['name']: trace_events[e['pid']][e['id']] for e in trace_json
+                   if e['ph'] == 'B' and e['cat'] == 'runner'
+                   and e['pid'] == begin['pid']}
+        assert begin['ts'] == runners['Start job']['B'].ts
+        # The job ends when it finished remotely, before async_status saw it.
+        assert runners['Start job']['E'].ts < end['ts'] <= \
+            runners['Wait for job']['E'].ts
+        assert end['args']['poll_wait_us'] >= 0
+    polls = [e for e in trace_json if e['ph'] == 'i' and e['name'] == 'async poll']
+    assert {p['args']['jid'] for p in polls} <= {b['args']['jid'] for b in begins}
+
+
+@pytest.mark.ansible_playbook('loops/background.yml')
+@pytest.mark.ansible_inventory('inventories/one_host.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_COMPACT': 'True', 'TRACE_FORMAT': 'json,protobuf'})
+def test_loops_background_job_compact_single_free(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+    # Compact traces write both ends of a job when it ends.
+    for pid in trace_hosts:
+        jobs = [e for e in trace_json if e['ph'] in ('b', 'e') and e['pid'] == pid]
+        assert [e['ph'] for e in jobs] == ['b', 'e']
+        assert jobs[1]['args']['status'] == 'ok'
+        # The job is still running when async_status first checks on it, and
+        # each retry is a poll of the job.
+        polls = [e for e in trace_json if e['ph'] == 'i' and e['pid'] == pid]
+        assert polls
+        assert all(jobs[0]['ts'] <= e['ts'] <= jobs[1]['ts'] + jobs[1]['args']['poll_wait_us']
+                   for e in polls)
+
+
+@pytest.mark.ansible_playbook('loops/background.yml')
+@pytest.mark.ansible_inventory('inventories/one_host.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_ASYNC_SPANS': 'False'})
+def test_loops_no_async_spans_single_linear(ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    parse_and_validate_trace(trace_json)
+    assert not [e for e in trace_json if e['cat'] == 'async']
+
+def test_loops_results_thread(tmp_path):
+    # Ansible sends item and async poll callbacks from its results thread,
+    # while the main thread starts and ends tasks on other hosts.
+    callback = load_callback(str(tmp_path))
+    hosts = [FakeHost('host%d' % i) for i in range(50)]
+    task = FakeTask('Loop over items', 'site.yml:1')
+    status = FakeTask('async_status', 'site.yml:1')
+    callback.v2_playbook_on_play_start(FakePlay('Deploy'))
+    callback.v2_playbook_on_task_start(task, False)
+    errors: List[Exception] = []
+    stop = threading.Event()
+
+    def results_thread():
+        try:
+            jobs = 0
+            while not stop.is_set():
+                for host in hosts:
+                    callback.v2_runner_item_on_ok(FakeResult(host, task))
+                    # A new job each time, so the job's task is looked up.
+                    jobs += 1
+                    callback.v2_runner_on_async_poll(FakeResult(
+                        host, status, {'ansible_job_id': 'j%d' % jobs}))
+        except Exception as e:
+            errors.append(e)
+
+    # Switch threads as often as possible, to interleave them.
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    thread = threading.Thread(target=results_thread)
+    thread.start()
+    try:
+        for _ in range(200):
+            for host in hosts:
+                callback.v2_runner_on_start(host, task)
+            for host in hosts:
+                callback.v2_runner_on_ok(FakeResult(host, task))
+    finally:
+        stop.set()
+        thread.join()
+        sys.setswitchinterval(switch_interval)
+    callback._end()
+    assert errors == []
@@ -0,0 +1,145 @@
+# Handle integration tests
+from typing import List
+from utils import parse_and_validate_trace, run_tool
+from fakes import FakeHost, FakePlay, FakeResult, FakeTask, load_callback
+import gzip
+import json
+import subprocess
+import pytest
+
+
+def run_shard(output_dir: str, hosts: List[FakeHost], **env: str) -> str:
+    callback = load_callback(output_dir, TRACE_DEDUPLICATE_TASK_ARGUMENTS='True',
+                             **env)
+    callback.v2_playbook_on_play_start(FakePlay('Deploy'))
+    for name in ['Install', 'Configure']:
+        task = FakeTask(name, 'site.yml:1', {'name': name.lower()},
+                        notify=['Restart'])
+        callback.v2_playbook_on_task_start(task, False)
+        for host in hosts:
+            callback.v2_runner_on_start(host, task)
+        for host in hosts:
+            callback.v2_runner_on_ok(FakeResult(host, task, {'changed': True}))
+    handler = FakeTask('Restart', 'site.yml:9', {'name': 'restart'})
+    callback.v2_playbook_on_handler_task_start(handler)
+    for host in hosts:
+        callback.v2_playbook_on_notify(handler, host)
+    for host in hosts:
+        callback.v2_runner_on_start(host, handler)
+        callback.v2_runner_on_ok(FakeResult(host, handler))
+    callback._end()
+    return '%s/%s' % (output_dir, callback._output_file)
+
+
+@pytest.mark.parametrize('compact', ['False', 'True'])
+def test_merge_shards(tmp_path, compact):
+    shards = [
+        run_shard(str(tmp_path), [FakeHost('web1'), FakeHost('web2')],
+                  TRACE_RUN_ID='deploy-42', TRACE_SHARD_ID='a', TRACE_COMPACT=compact,
+                  TRACE_COUNTERS='True'),
+        run_shard(str(tmp_path), [FakeHost('web3'), FakeHost('web1')],
+                  TRACE_RUN_ID='deploy-42', TRACE_SHARD_ID='b/2', TRACE_COMPACT=compact,
+                  TRACE_COUNTERS='True'),
+    ]
+    assert shards[1].endswith('-b_2.json')
+    merged = str(tmp_path / 'merged.json.gz')
+    output = run_tool('trace_merge', '-o', merged, *shards, ansible=False)
+    assert '3 hosts from 2 shards' in output
+
+    with gzip.open(merged) as f:
+        trace_json = json.load(f)
+    parse_and_validate_trace(trace_json)
+
+    info = trace_json[0]
+    assert info['name'] == 'trace_info'
+    assert info['args']['run_id'] == 'deploy-42'
+    # Timestamps count from the first shard's start.
+    origins = [s['time_origin_unix_us'] for s in info['args']['shards']]
+    assert info['args']['time_origin_unix_us'] == origins[0] <= origins[1]
+    with open(shards[1]) as f:
+        web3_first = [e for e in json.load(f) if e.get('cat') == 'runner'][0]
+    assert web3_first['ts'] + origins[1] - origins[0] in {
+        e['ts'] for e in trace_json if e.get('cat') == 'runner'}
+    assert [s['shard_id'] for s in info['args']['shards']] == ['a', 'b/2']
+    assert sum(e['name'] == 'trace_info' for e in trace_json) == 1
+
+    processes = {e['pid']: e['args']['name'] for e in trace_json
+                 if e['ph'] == 'M' and e['name'] == 'process_name'}
+    assert sorted(processes.values()) == [
+        'controller (a)', 'controller (b/2)', 'web1', 'web1', 'web2', 'web3']
+    # Each shard's play keeps its own id.
+    plays = {(e['args']['host'], e['id']) for e in trace_json
+             if e.get('cat') == 'play' and e['ph'] in ('B', 'X')}
+    assert sorted(plays) == [('web1', 1), ('web1', 2), ('web2', 1), ('web3', 2)]
+    # Task argument refs are unique, and the events point at their own.
+    task_args = {e['args']['ref']: e['args']['args'] for e in trace_json
+                 if e['ph'] == 'M' and e['name'] == 'task_args'}
+    assert len(task_args) == 6
+    # Flow ids are unique, from each notifying task to its handler.
+    starts = [e for e in trace_json if e['ph'] == 's']
+    finishes = {e['id']: e for e in trace_json if e['ph'] == 'f'}
+    assert len(starts) == len({e['id'] for e in starts}) == len(finishes) == 8
+    assert all(finishes[e['id']]['pid'] == e['pid'] for e in starts)
+    for e in trace_json:
+        if 'args_ref' in e.get('args', {}):
+            assert task_args[e['args']['args_ref']] == \
+                {'name': e['args']['task'].lower()}
+    handlers = [e for e in trace_json if e.get('cat') == 'handler'
+                and e['ph'] in ('B', 'X')]
+    assert len(handlers) == 4
+    assert all(e['args']['notified_by'] == ['Install', 'Configure'] for e in handlers)
+    # web1 ran in both shards, on a track for each.
+    web1 = [pid for pid, name in processes.items() if name == 'web1']
+    assert len(web1) == 2
+    for pid in web1:
+        runners = [e for e in trace_json if e.get('cat') == 'runner'
+                   and e['pid'] == pid and e['ph'] in ('B', 'X')]
+        assert len(runners) == 2
+
+
+@pytest.mark.parametrize('compact', ['False', 'True'])
+def test_merge_overlapping_shards(tmp_path, compact):
+    # Two controllers running the same host at the same time.
+    callbacks = [load_callback(str(tmp_path), TRACE_RUN_ID='deploy-42',
+                               TRACE_SHARD_ID=shard, TRACE_COMPACT=compact)
+                 for shard in ['a', 'b']]
+    host = FakeHost('web1')
+    tasks = [FakeTask('Install'), FakeTask('Configure')]
+    for callback, task in zip(callbacks, tasks):
+        callback.v2_playbook_on_play_start(FakePlay('Deploy'))
+        callback.v2_playbook_on_task_start(task, False)
+        callback.v2_runner_on_start(host, task)
+    for callback, task in zip(callbacks, tasks):
+        callback.v2_runner_on_ok(FakeResult(host, task))
+    for callback in callbacks:
+        callback._end()
+    shards = ['%s/%s' % (tmp_path, c._output_file) for c in callbacks]
+
+    merged = str(tmp_path / 'merged.json')
+    output = run_tool('trace_merge', '-o', merged, *shards, ansible=False)
+    assert '1 hosts from 2 shards' in output
+    run_tool('trace_validate', merged, ansible=False)
+    with open(merged) as f:
+        trace_json = json.load(f)
+    parse_and_validate_trace(trace_json)
+    web1 = {e['pid'] for e in trace_json if e['ph'] == 'M'
+            and e['name'] == 'process_name' and e['args']['name'] == 'web1'}
+    assert len(web1) == 2
+    runners = {(e['pid'], e['name']) for e in trace_json
+               if e.get('cat') == 'runner'}
+    assert len(runners) == 2 and {pid for pid, _ in runners} == web1
+
+
+def test_merge_refuses_different_runs(tmp_path):
+    shards = [
+        run_shard(str(tmp_path), [FakeHost('web1')], TRACE_SHARD_ID='a'),
+        run_shard(str(tmp_path), [FakeHost('web2')], TRACE_SHARD_ID='b'),
+    ]
+    merged = str(tmp_path / 'merged.json')
+    with pytest.raises(subprocess.CalledProcessError):
+        run_tool('trace_merge', '-o', merged, *shards)
+    run_tool('trace_merge', '--force', '-o', merged, *shards)
+    with open(merged) as f:
+        trace_json = json.load(f)
+    parse_and_validate_trace(trace_json)
+    assert trace_json[0]['args']['run_id'] is None
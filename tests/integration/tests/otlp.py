@@ -0,0 +1,262 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any, Optional
+from utils import get_last_trace
+from fakes import FakeHost, FakePlay, FakeResult, FakeTask, load_callback
+from trace_otlp import OtlpTraceWriter
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.request
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+class Collector:
+    """
+    A stub OTLP/HTTP collector, failing the first `failures` requests, and
+    answering none until `hold` is set, if given.
+    """
+
+    def __init__(self, failures: int = 0,
+                 hold: Optional[threading.Event] = None):
+        self.requests: List[Dict[str, Any]] = []
+        self.failures = failures
+        collector = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if hold is not None:
+                    hold.wait()
+                if collector.failures:
+                    collector.failures -= 1
+                    self.send_error(503)
+                    return
+                assert self.headers['Content-Type'] == 'application/json'
+                collector.requests.append(json.loads(body))
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.endpoint = 'http://127.0.0.1:%d/v1/traces' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def spans(self) -> List[Dict[str, Any]]:
+        return [span for request in self.requests
+                for resource in request['resourceSpans']
+                for scope in resource['scopeSpans']
+                for span in scope['spans']]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def attributes(span: Dict[str, Any]) -> Dict[str, Any]:
+    return {a['key']: list(a['value'].values())[0] for a in span['attributes']}
+
+
+@pytest.fixture
+def collector():
+    collector = Collector()
+    env = {'TRACE_OTLP_ENDPOINT': collector.endpoint,
+           'TRACEPARENT': '00-%s-%s-01' % (TRACE_ID, PARENT_ID)}
+    os.environ.update(env)
+    try:
+        yield collector
+    finally:
+        for key in env:
+            del os.environ[key]
+        collector.close()
+
+
+@pytest.mark.ansible_playbook('loops/loops.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_FORMAT': 'json,otlp', 'TRACE_COMPACT': 'True'})
+def test_otlp_loops_multiple_free(collector, ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    spans = collector.spans
+    by_id = {span['spanId']: span for span in spans}
+    assert len(by_id) == len(spans)
+    assert {span['traceId'] for span in spans} == {TRACE_ID}
+
+    # run -> play -> play on a host -> task -> loop item
+    roots = [span for span in spans if span.get('parentSpanId') not in by_id]
+    assert [(r['name'], r['parentSpanId']) for r in roots] == [
+        ('ansible-playbook', PARENT_ID)]
+    resource = collector.requests[0]['resourceSpans'][0]['resource']
+    assert attributes(resource) == {'service.name': 'ansible'}
+
+    def parent(span):
+        return by_id[span['parentSpanId']]
+
+    x_events = [e for e in trace_json if e['ph'] == 'X']
+    assert len(spans) == len(x_events) + 1 + 1
+    hosts = {e['args']['name'] for e in trace_json if e['name'] == 'process_name'}
+    origin_ns = trace_json[0]['args']['time_origin_unix_us'] * 1000
+    for span in spans:
+        attrs = attributes(span)
+        start, end = int(span['startTimeUnixNano']), int(span['endTimeUnixNano'])
+        assert origin_ns <= start <= end
+        if span['name'] != 'ansible-playbook':
+            assert int(parent(span)['startTimeUnixNano']) <= start
+            assert end <= int(parent(span)['endTimeUnixNano'])
+        category = attrs.get('ansible.category')
+        if category == 'play':
+            assert parent(span)['name'] == attrs['ansible.play']
+            assert parent(parent(span))['name'] == 'ansible-playbook'
+            assert attrs['ansible.host'] in hosts
+        elif category == 'runner':
+            assert attributes(parent(span))['ansible.category'] == 'play'
+            assert attributes(parent(span))['ansible.host'] == attrs['ansible.host']
+            assert attrs['ansible.task'] == span['name']
+            assert 'loops.yml:' in attrs['ansible.task.path']
+            assert span['status']['code'] == 1
+        elif category == 'item':
+            assert attributes(parent(span))['ansible.category'] == 'runner'
+    items = [s for s in spans if attributes(s).get('ansible.category') == 'item']
+    assert len(items) == 3 * len(hosts)
+    plays = [s for s in spans if 'ansible.hosts' in attributes(s)]
+    # OTLP/JSON encodes 64 bit integers as strings.
+    assert [attributes(p)['ansible.hosts'] for p in plays] == [str(len(hosts))]
+
+
+def test_otlp_retries_with_backoff(tmp_path):
+    collector = Collector(failures=2)
+    writer = OtlpTraceWriter(
+        collector.endpoint, str(tmp_path / 'spill.jsonl'), retry_delay=0.01,
+        flush_interval=0.05)
+    writer.write({"name": "process_name", "pid": 1, "cat": "process", "ph": "M",
+                  "args": {"name": "web1"}})
+    writer.write({"name": "play", "cat": "play", "ph": "X", "ts": 1000.0,
+                  "dur": 10.0, "pid": 1, "id": 1, "args": {"host": "web1"}})
+    # The host's span is exported while the run goes on, after two failures.
+    deadline = time.monotonic() + 5
+    while not writer.exported and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.close()
+    collector.close()
+    assert collector.failures == 0
+    assert writer.exported == 3 and writer.spilled == 0
+    assert [s['name'] for s in collector.spans] == ['play: web1', 'play', 'ansible-playbook']
+    # A new trace, without TRACEPARENT.
+    assert len(writer.trace_id) == 32
+    assert 'parentSpanId' not in collector.spans[-1]
+    assert not (tmp_path / 'spill.jsonl').exists()
+
+
+def test_otlp_matches_end_events_by_id(tmp_path):
+    collector = Collector()
+    writer = OtlpTraceWriter(collector.endpoint, str(tmp_path / 'spill.jsonl'))
+    writer.write({"name": "process_name", "pid": 1, "cat": "process", "ph": "M",
+                  "args": {"name": "web1"}})
+    writer.write({"name": "play", "cat": "play", "ph": "B", "ts": 0.0,
+                  "pid": 1, "id": 1, "args": {"host": "web1"}})
+    writer.write({"name": "Install", "cat": "runner", "ph": "B", "ts": 1.0,
+                  "pid": 1, "id": 2, "args": {"path": "site.yml:1"}})
+    writer.write({"name": "Restart", "cat": "handler", "ph": "B", "ts": 2.0,
+                  "pid": 1, "id": 3, "args": {"path": "site.yml:9"}})
+    # Ended out of order: each end still closes its own span.
+    writer.write({"name": "Install", "cat": "runner", "ph": "E", "ts": 3.0,
+                  "pid": 1, "id": 2, "args": {"status": "ok"}})
+    writer.write({"name": "Restart", "cat": "handler", "ph": "E", "ts": 4.0,
+                  "pid": 1, "id": 3, "args": {"status": "failed"}})
+    writer.write({"name": "play", "cat": "play", "ph": "E", "ts": 5.0,
+                  "pid": 1, "id": 1})
+    writer.close()
+    collector.close()
+
+    spans = {s['name']: s for s in collector.spans}
+    assert attributes(spans['Install'])['ansible.task.path'] == 'site.yml:1'
+    assert spans['Install']['status'] == {'code': 1}
+    assert spans['Install']['endTimeUnixNano'] == '3000'
+    assert attributes(spans['Restart'])['ansible.task.path'] == 'site.yml:9'
+    assert spans['Restart']['status'] == {'code': 2}
+    assert spans['Restart']['endTimeUnixNano'] == '4000'
+
+
+def test_otlp_drops_spans_when_queue_is_full(tmp_path):
+    hold = threading.Event()
+    collector = Collector(hold=hold)
+    writer = OtlpTraceWriter(
+        collector.endpoint, str(tmp_path / 'spill.jsonl'), queue_size=1,
+        batch_size=1, flush_interval=0.01)
+    for pid in (1, 2, 3):
+        writer.write({"name": "process_name", "pid": pid, "cat": "process",
+                      "ph": "M", "args": {"name": "web%d" % pid}})
+    writer.write({"name": "play", "cat": "play", "ph": "X", "ts": 0.0,
+                  "dur": 10.0, "pid": 1, "id": 1})
+    # The exporter takes the first span and waits on the collector.
+    deadline = time.monotonic() + 5
+    while not writer._queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    start = time.monotonic()
+    for pid in (2, 3):
+        writer.write({"name": "play", "cat": "play", "ph": "X", "ts": 0.0,
+                      "dur": 10.0, "pid": pid, "id": 1})
+    # Without waiting for the collector.
+    assert time.monotonic() - start < 1
+    hold.set()
+    writer.close()
+    collector.close()
+
+    assert writer.dropped == 1 and writer.spilled == 0
+    # The play and run spans, queued at the end, aren't dropped.
+    assert sorted(s['name'] for s in collector.spans) == [
+        'ansible-playbook', 'play', 'play: web1', 'play: web2']
+    assert not (tmp_path / 'spill.jsonl').exists()
+
+
+def test_otlp_spills_when_collector_is_down(tmp_path):
+    collector = Collector()
+    endpoint = collector.endpoint
+    collector.close()
+    callback = load_callback(str(tmp_path), TRACE_FORMAT='otlp',
+                             TRACE_OTLP_ENDPOINT=endpoint,
+                             TRACE_FLUSH_INTERVAL='60', TRACEPARENT='invalid')
+    hosts = [FakeHost('web1'), FakeHost('web2')]
+    callback.v2_playbook_on_play_start(FakePlay('Deploy'))
+    task = FakeTask('Restart', args={'name': 'nginx'})
+    callback.v2_playbook_on_task_start(task, False)
+    for host in hosts:
+        callback.v2_runner_on_start(host, task)
+    callback.v2_runner_on_ok(FakeResult(hosts[0], task))
+    callback.v2_runner_on_unreachable(FakeResult(hosts[1], task))
+    callback._end()
+
+    assert callback._otlp_writer.exported == 0
+    assert callback._otlp_writer.spilled == 6
+    with open(callback._otlp_writer.spill_path) as f:
+        requests = [json.loads(line) for line in f]
+    spans = [span for request in requests
+             for span in request['resourceSpans'][0]['scopeSpans'][0]['spans']]
+    assert len(spans) == 6
+    runners = {attributes(s)['ansible.host']: s for s in spans
+               if attributes(s).get('ansible.category') == 'runner'}
+    assert runners['web1']['status'] == {'code': 1}
+    assert runners['web2']['status'] == {'code': 2}
+    assert attributes(runners['web1'])['ansible.task.args'] == '{"name": "nginx"}'
+
+    # The spill file can be replayed to a collector.
+    collector = Collector()
+    for request in requests:
+        body = json.dumps(request).encode('utf-8')
+        urllib.request.urlopen(urllib.request.Request(
+            collector.endpoint, data=body,
+            headers={'Content-Type': 'application/json'})).close()
+    collector.close()
+    assert collector.spans == spans
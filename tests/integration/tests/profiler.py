@@ -0,0 +1,88 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, parse_and_validate_trace
+from event import HostEvent
+from trace_profiling import ControllerProfiler
+import time
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_PROFILE_CONTROLLER': 'True',
+                          'TRACE_PROFILE_INTERVAL': '0.001'})
+def test_profile_controller_multiple_linear(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    controller = [pid for pid, host in trace_hosts.items()
+                  if host.name == 'controller']
+    assert len(controller) == 1
+    frames = [e for e in trace_json if e['ph'] == 'X' and e['cat'] == 'profile']
+    assert frames
+    assert all(frame['pid'] == controller[0] for frame in frames)
+    assert all(frame['dur'] > 0 for frame in frames)
+    # The strategy's run loop is sampled, nested under the playbook executor.
+    strategy = [frame for frame in frames
+                if frame['name'].endswith('run')
+                and '/strategy/' in frame['args']['file']]
+    assert strategy
+    assert all('parent_id' in trace_events[controller[0]][frame['id']]
+               for frame in strategy)
+
+
+def test_profile_keeps_innermost_frames():
+    events: List[Dict[str, Any]] = []
+
+    def leaf():
+        time.sleep(0.2)
+
+    def recurse(depth: int):
+        if depth:
+            recurse(depth - 1)
+        else:
+            leaf()
+
+    profiler = ControllerProfiler(events.extend, 1, 0.001,
+                                  lambda: time.monotonic_ns() // 1000)
+    recurse(ControllerProfiler.MAX_DEPTH * 2)
+    profiler.stop()
+
+    # Qualified names on Python 3.11 and later.
+    names = [e['name'].rsplit('.', 1)[-1] for e in events]
+    assert 'leaf' in names
+    assert '<truncated>' in names
+    # Outermost frames, like pytest's, were dropped instead.
+    assert not any(e['args']['file'].endswith('_pytest/python.py')
+                   for e in events)
+
+
+def test_profile_writes_each_sample_at_once():
+    batches: List[List[Dict[str, Any]]] = []
+
+    def leaf():
+        time.sleep(0.2)
+
+    def recurse(depth: int):
+        if depth:
+            recurse(depth - 1)
+        else:
+            leaf()
+
+    profiler = ControllerProfiler(batches.append, 1, 0.001,
+                                  lambda: time.monotonic_ns() // 1000)
+    recurse(10)
+    time.sleep(0.1)
+    profiler.stop()
+
+    # Returning from the recursion closes all its frames in one sample,
+    # written as one batch rather than an event at a time.
+    batch = next(batch for batch in batches
+                 if any(e['name'].rsplit('.', 1)[-1] == 'leaf' for e in batch))
+    names = [e['name'].rsplit('.', 1)[-1] for e in batch]
+    assert names.count('recurse') == 11
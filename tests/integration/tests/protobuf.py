@@ -0,0 +1,104 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import (decode_protobuf, get_last_trace, get_last_trace_file,
+                   open_trace_file, parse_and_validate_trace, parse_perfetto_trace)
+from event import HostEvent
+import struct
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+def assert_protobuf_matches_json(trace_json: JSONTYPE) -> None:
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    with open_trace_file(get_last_trace_file('trace/*.pftrace*')) as f:
+        tracks, slices = parse_perfetto_trace(f.read())
+
+    assert tracks == {pid: host.name for pid, host in trace_hosts.items()}
+    for pid, host_events in trace_events.items():
+        expected = sorted(
+            (e['B'].ts, e['E'].ts, e['B'].name)
+            for e in host_events.values())
+        actual = sorted((s['ts'], s['end'], s['name']) for s in slices[pid]
+                        if not s.get('async'))
+        assert len(actual) == len(expected)
+        for (ts, end, name), (expected_ts, expected_end, expected_name) in zip(
+                actual, expected):
+            assert name == expected_name
+            assert ts == pytest.approx(expected_ts, abs=1)
+            assert end == pytest.approx(expected_end, abs=1)
+
+    # Arguments are resolved from the interning tables.
+    for event in trace_json:
+        if event['ph'] == 'B' and event['cat'] == 'runner':
+            matching = [s for s in slices[event['pid']]
+                        if s['ts'] == pytest.approx(event['ts'], abs=1)
+                        and s['cat'] == 'runner']
+            assert matching[0]['args']['path'] == event['args']['path']
+            assert matching[0]['args']['host'] == event['args']['host']
+
+    # Async events are slices of their own tracks within their host's.
+    ends = {(e['pid'], e['id']): e for e in trace_json if e['ph'] == 'e'}
+    for pid in trace_hosts:
+        expected = sorted(
+            (e['ts'], ends[(pid, e['id'])]['ts'], e['name'])
+            for e in trace_json if e['ph'] == 'b' and e['pid'] == pid)
+        actual = sorted((s['ts'], s['end'], s['name'])
+                        for s in slices.get(pid, []) if s.get('async'))
+        assert len(actual) == len(expected)
+        for (ts, end, name), (expected_ts, expected_end, expected_name) in zip(
+                actual, expected):
+            assert name == expected_name
+            assert ts == pytest.approx(expected_ts, abs=1)
+            assert end == pytest.approx(expected_end, abs=1)
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_FORMAT': 'json,protobuf'})
+def test_protobuf_multiple_free(ansible_play):
+    assert_protobuf_matches_json(get_last_trace())
+
+
+@pytest.mark.ansible_playbook('include_task/playbook_templating.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_FORMAT': 'json,protobuf'})
+def test_protobuf_include_task_templating_multiple_linear(ansible_play):
+    assert_protobuf_matches_json(get_last_trace())
+
+
+@pytest.mark.ansible_playbook('loops/background.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_FORMAT': 'json,protobuf'})
+def test_protobuf_background_job_multiple_linear(ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    assert [e for e in trace_json if e['ph'] == 'b']
+    assert_protobuf_matches_json(trace_json)
+
+
+@pytest.mark.ansible_playbook('handlers/handlers.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_FORMAT': 'json,protobuf'})
+def test_protobuf_handlers_multiple_linear(ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    assert_protobuf_matches_json(trace_json)
+
+    # Flows link an instant in the notifying span to one in the handler's.
+    with open_trace_file(get_last_trace_file('trace/*.pftrace*')) as f:
+        data = f.read()
+    flow_ids: Dict[int, List[int]] = {47: [], 48: []}
+    for packet_bytes in decode_protobuf(data).get(1, []):
+        for event_bytes in decode_protobuf(packet_bytes).get(11, []):
+            event = decode_protobuf(event_bytes)
+            for field, ids in flow_ids.items():
+                ids += [struct.unpack('<Q', v)[0] for v in event.get(field, [])]
+    expected = sorted(e['id'] for e in trace_json if e['ph'] == 's')
+    assert expected
+    assert sorted(flow_ids[47]) == sorted(flow_ids[48]) == expected
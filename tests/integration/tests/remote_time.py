@@ -0,0 +1,57 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, parse_and_validate_trace
+from event import HostEvent
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_REMOTE_TIME': 'True'})
+def test_remote_time_multiple_linear(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    # The shell task returns its remote start and end; ping doesn't.
+    ends = [e for e in trace_json if e['ph'] == 'E' and e['cat'] == 'runner']
+    shell_ends = [e for e in ends if e['name'] == 'Hello world']
+    assert len(shell_ends) == len(trace_hosts)
+    for e in shell_ends:
+        assert e['args']['remote_us'] > 0
+        assert e['args']['overhead_us'] > 0
+    assert all('remote_us' not in e['args'] for e in ends
+               if e['name'] != 'Hello world')
+
+    remote = [e for e in trace_json if e['ph'] == 'B' and e['cat'] == 'remote']
+    assert len(remote) == len(trace_hosts)
+
+    overhead = [e['args'] for e in trace_json
+                if e['ph'] == 'M' and e['name'] == 'task_overhead']
+    assert len(overhead) == 1
+    assert overhead[0]['task'] == 'Hello world'
+    assert overhead[0]['hosts'] == len(trace_hosts)
+    assert overhead[0]['remote_us'] == pytest.approx(
+        sum(e['args']['remote_us'] for e in shell_ends))
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_REMOTE_TIME': 'True', 'TRACE_COMPACT': 'True'})
+def test_remote_time_compact_multiple_free(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    remote = [e for e in trace_json if e['ph'] == 'X' and e['cat'] == 'remote']
+    assert remote
+    for e in remote:
+        parent = trace_events[e['pid']][trace_events[e['pid']][e['id']]['parent_id']]
+        assert parent['X'].ts <= e['ts']
+        assert e['ts'] + e['dur'] <= parent['X'].ts + parent['X'].dur
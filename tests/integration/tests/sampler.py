@@ -0,0 +1,35 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, parse_and_validate_trace
+from event import HostEvent
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_SAMPLE_CONTROLLER': 'True',
+                          'TRACE_SAMPLE_INTERVAL': '0.05'})
+def test_sample_controller_multiple_free(ansible_play):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    controller = [pid for pid, host in trace_hosts.items()
+                  if host.name == 'controller']
+    assert len(controller) == 1
+    samples: Dict[str, List[Dict[str, float]]] = {}
+    for event in trace_json:
+        if event['ph'] == 'C':
+            assert event['pid'] == controller[0]
+            samples.setdefault(event['name'], []).append(event['args'])
+
+    assert set(samples) == {'cpu', 'memory', 'load', 'workers'}
+    assert all(s['controller_rss_mb'] > 0 for s in samples['memory'])
+    assert all(s['controller_percent'] >= 0 for s in samples['cpu'])
+    # The playbook runs on forked workers, some of which are sampled.
+    assert max(s['count'] for s in samples['workers']) >= 1
+    assert max(s['workers_rss_mb'] for s in samples['memory']) > 0
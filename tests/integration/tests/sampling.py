@@ -0,0 +1,67 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import (get_last_trace, get_last_trace_file, parse_and_validate_trace,
+                   run_tool)
+from trace_stats import QuantileSketch
+import json
+import zlib
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+HOSTS = ['127.0.0.%d' % i for i in range(1, 12)]
+
+
+def sampled(rate: float) -> List[str]:
+    return [h for h in HOSTS if zlib.crc32(h.encode('utf-8')) < rate * 2**32]
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_HOST_SAMPLE_RATE': '0.5'})
+def test_sampling_multiple_linear(ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    hosts, _ = parse_and_validate_trace(trace_json)
+
+    # Only the sampled hosts are traced, and the same ones in every run.
+    expected = sampled(0.5)
+    assert 0 < len(expected) < len(HOSTS)
+    assert sorted(h.name for h in hosts.values()) == sorted(expected)
+
+    # The stats of each task cover every host.
+    stats = [e['args'] for e in trace_json
+             if e['ph'] == 'M' and e['name'] == 'task_stats']
+    assert [s['task'] for s in stats] == ['Gathering Facts', 'Ping self', 'Hello world']
+    for s in stats:
+        assert s['play'] == 'all'
+        assert s['hosts'] == len(HOSTS)
+        assert s['sampled_hosts'] == len(expected)
+        assert s['statuses'] == {'ok': len(HOSTS)}
+        assert s['min_us'] <= s['mean_us'] <= s['max_us']
+        # Within the sketch's accuracy of the extremes.
+        assert s['min_us'] * 0.98 <= s['p50_us'] <= s['p95_us'] \
+            <= s['p99_us'] <= s['max_us'] * 1.02
+        sketch = QuantileSketch.from_dict(s['sketch'])
+        assert sketch.count == len(HOSTS)
+        assert sketch.quantile(0.5) == s['p50_us']
+
+    report = json.loads(run_tool('trace_analyze', '--json', get_last_trace_file()))
+    assert [t['hosts'] for t in report['fleet_tasks']] == [len(HOSTS)] * 3
+    assert report['plays'][0]['hosts'] == len(expected)
+    assert 'across all hosts' in run_tool('trace_analyze', get_last_trace_file())
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_HOST_SAMPLE_RATE': '0', 'TRACE_COMPACT': 'True'})
+def test_sampling_none_free(ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    hosts, _ = parse_and_validate_trace(trace_json)
+    assert hosts == {}
+    stats = [e['args'] for e in trace_json
+             if e['ph'] == 'M' and e['name'] == 'task_stats']
+    assert len(stats) == 3
+    assert all(s['hosts'] == len(HOSTS) and s['sampled_hosts'] == 0
+               for s in stats)
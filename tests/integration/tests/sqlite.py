@@ -0,0 +1,93 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, get_last_trace_file, parse_and_validate_trace, run_tool
+from event import HostEvent
+import json
+import os
+import sqlite3
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+DATABASE = 'trace/trace.db'
+
+SPANS = ('SELECT h.name, t.path, t.name, p.number, s.cat, s.name, s.start_us, '
+         's.end_us, s.status, s.args FROM spans s '
+         'JOIN runs r ON r.id = s.run_id LEFT JOIN hosts h ON h.id = s.host_id '
+         'LEFT JOIN tasks t ON t.id = s.task_id '
+         'LEFT JOIN plays p ON p.id = s.play_id '
+         'WHERE r.name = ? ORDER BY s.start_us, s.cat, h.name')
+
+
+def run_name() -> str:
+    return os.path.basename(get_last_trace_file()).split('.json')[0]
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_FORMAT': 'json,sqlite'})
+def test_sqlite_multiple_linear(ansible_play, tmp_path):
+    trace_hosts: Dict[int, HostEvent]
+    trace_events: Dict[int, Any]
+    trace_json: JSONTYPE = get_last_trace()
+    trace_hosts, trace_events = parse_and_validate_trace(trace_json)
+
+    db = sqlite3.connect(DATABASE)
+    spans = db.execute(SPANS, (run_name(),)).fetchall()
+    begins = [e for e in trace_json if e['ph'] == 'B']
+    assert len(spans) == len(begins)
+    runners = [s for s in spans if s[4] == 'runner']
+    assert {s[0] for s in runners} == {h.name for h in trace_hosts.values()}
+    assert {s[2] for s in runners} == {'Gathering Facts', 'Ping self', 'Hello world'}
+    assert all(s[3] == 1 and s[8] == 'ok' for s in runners)
+    # Spans are stored in wall clock time.
+    origin = trace_json[0]['args']['time_origin_unix_us']
+    for e in begins:
+        host_events = trace_events[e['pid']][e['id']]
+        assert (trace_hosts[e['pid']].name, e['name'], origin + e['ts'],
+                origin + host_events['E'].ts) in {(s[0], s[5], s[6], s[7]) for s in spans}
+
+    # Importing the JSON trace gives the same spans.
+    imported = str(tmp_path / 'imported.db')
+    assert 'imported' in run_tool('trace_db', imported, 'import',
+                                  get_last_trace_file(), ansible=False)
+    assert 'already imported' in run_tool('trace_db', imported, 'import',
+                                          get_last_trace_file())
+    assert sqlite3.connect(imported).execute(SPANS, (run_name(),)).fetchall() \
+        == spans
+
+    report = json.loads(run_tool('trace_db', imported, 'tasks', '--json',
+                                 '--days', '1'))
+    assert {t['task'] for t in report} == {
+        'Gathering Facts', 'Ping self', 'Hello world'}
+    for task in report:
+        assert task['runs'] == 1
+        assert task['count'] == len(trace_hosts)
+        assert task['p50_us'] <= task['p95_us'] <= task['max_us']
+    report = json.loads(run_tool('trace_db', imported, 'history', '--json',
+                                 '--path', '%basic.yml:12'))
+    assert [r['task'] for r in report] == ['Hello world']
+    assert report[0]['hosts'] == len(trace_hosts)
+    report = json.loads(run_tool('trace_db', imported, 'hosts', '--json'))
+    assert len(report) == len(trace_hosts)
+
+
+@pytest.mark.ansible_playbook('plays/base.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+@pytest.mark.ansible_env({'TRACE_FORMAT': 'sqlite,json', 'TRACE_COMPACT': 'True'})
+def test_sqlite_compact_multiple_free(ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    parse_and_validate_trace(trace_json)
+
+    db = sqlite3.connect(DATABASE)
+    spans = db.execute(SPANS, (run_name(),)).fetchall()
+    assert len(spans) == len([e for e in trace_json if e['ph'] == 'X'])
+    # Play spans are written after their tasks, which still get their play.
+    plays = {e['id']: e['name'] for e in trace_json if e['cat'] == 'play'}
+    assert db.execute('SELECT p.number, p.name FROM plays p JOIN runs r '
+                      'ON r.id = p.run_id WHERE r.name = ? ORDER BY p.number',
+                      (run_name(),)).fetchall() == sorted(plays.items())
+    assert all(s[3] is not None for s in spans)
+    assert run_name() in run_tool('trace_db', DATABASE, 'runs')
@@ -0,0 +1,119 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import parse_and_validate_trace
+from fakes import (FakeHost, FakePlay, FakeResult, FakeTask, load_callback,
+                   load_plugin)
+import json
+import os
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+def load_trace(callback) -> JSONTYPE:
+    with open(os.path.join(callback._output_dir, callback._output_file)) as f:
+        return json.load(f)
+
+
+def test_unfinished_tasks_end_with_their_play(tmp_path):
+    callback = load_callback(str(tmp_path))
+    hosts = [FakeHost('web1'), FakeHost('web2')]
+    task = FakeTask('Slow task', args={'_raw_params': 'sleep 1000'})
+    callback.v2_playbook_on_play_start(FakePlay('First play'))
+    callback.v2_playbook_on_task_start(task, False)
+    for host in hosts:
+        callback.v2_runner_on_start(host, task)
+    # An async job polled once, then web2 never returns a result.
+    callback.v2_runner_on_async_poll(
+        FakeResult(hosts[1], FakeTask('async_status'), {'ansible_job_id': '1.2'}))
+    callback.v2_runner_on_ok(FakeResult(hosts[0], task))
+
+    callback.v2_playbook_on_play_start(FakePlay('Second play'))
+    next_task = FakeTask('Next task')
+    callback.v2_playbook_on_task_start(next_task, False)
+    callback.v2_runner_on_start(hosts[0], next_task)
+    callback._end()
+
+    trace_json: JSONTYPE = load_trace(callback)
+    hosts_events, _ = parse_and_validate_trace(trace_json)
+    assert len(hosts_events) == 2
+    ends = [e for e in trace_json if e['ph'] == 'E']
+    unfinished = [e for e in ends if e.get('args') == {'status': 'unfinished'}]
+    # web2's async job and task in the first play, web1's task in the second.
+    assert len(unfinished) == 3
+    # The late result of a task that already ended is ignored.
+    callback_events = len(trace_json)
+    callback.v2_runner_on_ok(FakeResult(hosts[1], task))
+    assert len(load_trace(callback)) == callback_events
+
+
+def test_idle_hosts_keep_their_pid(tmp_path):
+    callback = load_callback(str(tmp_path))
+    web, db = FakeHost('web'), FakeHost('db')
+    for play, hosts in (('web', [web]), ('db', [db]), ('both', [web, db])):
+        callback.v2_playbook_on_play_start(FakePlay(play))
+        task = FakeTask('Task of %s' % play)
+        callback.v2_playbook_on_task_start(task, False)
+        for host in hosts:
+            callback.v2_runner_on_start(host, task)
+            callback.v2_runner_on_ok(FakeResult(host, task))
+    # web sat out the db play, so its state was dropped until it came back.
+    assert len(callback._hosts) == 2
+    callback._end()
+
+    trace_json: JSONTYPE = load_trace(callback)
+    parse_and_validate_trace(trace_json)
+    processes = [e['args']['name'] for e in trace_json
+                 if e['ph'] == 'M' and e['name'] == 'process_name']
+    assert processes == ['web', 'db']
+    web_plays = [e['name'] for e in trace_json
+                 if e['ph'] == 'B' and e['cat'] == 'play' and e['pid'] == 1]
+    assert web_plays == ['web', 'both']
+
+
+def test_many_idle_hosts_keep_their_pid(tmp_path):
+    # More hosts sit out a play than any cache of idle hosts would hold.
+    callback = load_callback(str(tmp_path), TRACE_COMPACT='True')
+    hosts = [FakeHost('host%d' % i) for i in range(5000)]
+    other = FakeHost('other')
+    for play, play_hosts in (('all', hosts), ('other', [other]), ('again', hosts)):
+        callback.v2_playbook_on_play_start(FakePlay(play))
+        task = FakeTask('Task of %s' % play)
+        callback.v2_playbook_on_task_start(task, False)
+        for host in play_hosts:
+            callback.v2_runner_on_start(host, task)
+            callback.v2_runner_on_ok(FakeResult(host, task))
+    callback._end()
+
+    trace_json: JSONTYPE = load_trace(callback)
+    processes = [e['args']['name'] for e in trace_json
+                 if e['ph'] == 'M' and e['name'] == 'process_name']
+    assert len(processes) == len(set(processes)) == len(hosts) + 1
+
+
+def test_task_names_are_bounded(tmp_path):
+    callback = load_callback(str(tmp_path), TRACE_DEDUPLICATE_TASK_ARGUMENTS='true')
+    cache_size = load_plugin().TASK_CACHE_SIZE
+    host = FakeHost('web')
+    callback.v2_playbook_on_play_start(FakePlay('Includes'))
+    first = FakeTask('Included task 0', args={'msg': 'hello'})
+    tasks = [first] + [FakeTask('Included task %d' % i, args={'msg': 'hello'})
+                       for i in range(1, cache_size + 10)]
+    for task in tasks:
+        callback.v2_playbook_on_task_start(task, False)
+        callback.v2_runner_on_start(host, task)
+        callback.v2_runner_on_ok(FakeResult(host, task))
+    assert len(callback._tasks) == cache_size
+    assert len(callback._task_args) == cache_size
+    # A forgotten task is named again when it runs on another host.
+    late_host = FakeHost('db')
+    callback.v2_runner_on_start(late_host, first)
+    callback.v2_runner_on_ok(FakeResult(late_host, first))
+    callback._end()
+
+    trace_json: JSONTYPE = load_trace(callback)
+    parse_and_validate_trace(trace_json)
+    begins = [e for e in trace_json if e['ph'] == 'B' and e['cat'] == 'runner']
+    assert begins[-1]['name'] == 'Included task 0'
+    refs = [e['args']['ref'] for e in trace_json
+            if e['ph'] == 'M' and e['name'] == 'task_args']
+    assert len(refs) == len(set(refs)) == len(tasks) + 1
@@ -1,41 +1,143 @@
 import os
+import gzip
 import json
 import glob
 import re
+import struct
+import subprocess
+import sys
 from collections import deque
-from typing import Union, Dict, List, Any, TextIO, Deque, Tuple
-from event import HostEvent, DurationEvent
+from typing import Union, Dict, List, Any, BinaryIO, Deque, Tuple
+from event import HostEvent, DurationEvent, CompleteEvent
 
 JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
 
+TOOLS_DIR: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'tools')
+sys.path.insert(0, TOOLS_DIR)
+from trace_validate import TraceValidator  # noqa: E402
+
+# Fakes of Ansible's objects, to drive the callback without a playbook.
+BENCHMARK_DIR: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'benchmark')
+sys.path.insert(0, BENCHMARK_DIR)
+
+# The plugin's writers and profilers, to test on their own.
+MODULE_UTILS_DIR: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'plugins',
+    'module_utils')
+sys.path.insert(0, MODULE_UTILS_DIR)
+
+
+def get_last_trace_file(pattern: str = 'trace/*.json*') -> str:
+    list_of_files: List[str] = glob.glob(pattern)
+    return max(list_of_files, key=os.path.getctime)
+
+
+def open_trace_file(path: str) -> BinaryIO:
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
 
 def get_last_trace() -> JSONTYPE:
-    list_of_files: List[str] = glob.glob('trace/*')
-    latest_file: str = max(list_of_files, key=os.path.getctime)
+    latest_file: str = get_last_trace_file()
 
-    file: TextIO = open(latest_file, encoding="utf-8")
+    file: BinaryIO = open_trace_file(latest_file)
     trace_json: JSONTYPE = json.load(file)
     file.close()
     return trace_json
 
 
+# Runs the tool given as the first argument with Ansible unimportable, as on
+# a machine without it.
+WITHOUT_ANSIBLE = (
+    "import os, runpy, sys; sys.modules['ansible'] = None; sys.argv.pop(0); "
+    "sys.path.insert(0, os.path.dirname(sys.argv[0])); "
+    "runpy.run_path(sys.argv[0], run_name='__main__')")
+
+
+def run_tool(tool: str, *args: str, check: bool = True,
+             ansible: bool = True) -> str:
+    """Run one of the trace tools, returning its output."""
+    command = [sys.executable] if ansible else [sys.executable, '-c', WITHOUT_ANSIBLE]
+    return subprocess.run(
+        command + [os.path.join(TOOLS_DIR, tool + '.py'), *args],
+        check=check, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
 def parse_and_validate_trace(trace: JSONTYPE) -> Tuple[Dict[int, HostEvent],
                                                        Dict[int, Any]]:
     hosts: Dict[int, HostEvent] = {}
     duration_events: Dict[int, Any] = {}
     duration_stacks: Dict[int, Deque] = {}
+    async_events: Dict[Tuple[int, int], Any] = {}
+    task_args_refs: set = set()
 
     # Parse events in trace
     for event in trace:
-        if 'ph' in event and event['ph'] == 'M':
+        if 'ph' in event and event['ph'] == 'M' and event.get('name') == 'task_args':
+            if event['args']['ref'] in task_args_refs:
+                raise ValueError(f'Task args {event["args"]["ref"]} already registered')
+            task_args_refs.add(event['args']['ref'])
+        elif 'ph' in event and event['ph'] == 'M' and event.get('name') == 'process_name':
             hosts, duration_events, duration_stacks = add_hosts(
                 hosts, duration_events, duration_stacks, event)
+        elif 'ph' in event and event['ph'] == 'M':
+            # Other metadata, e.g. task_overhead summaries.
+            pass
+        elif 'ph' in event and re.search("^(B|E|X)$", event['ph']) \
+                and 'args_ref' in event.get('args', {}) \
+                and event['args']['args_ref'] not in task_args_refs:
+            raise ValueError(f'Task args {event["args"]["args_ref"]} '
+                             'used before being registered')
         elif 'ph' in event and re.search("^(B|E)$", event['ph']):
             duration_events, duration_stacks = add_duration_event(
                 hosts, duration_events, duration_stacks, event)
+        elif 'ph' in event and event['ph'] == 'X':
+            duration_events = add_complete_event(
+                hosts, duration_events, event)
+        elif 'ph' in event and event['ph'] == 'C':
+            validate_counter_event(hosts, event)
+        elif 'ph' in event and event['ph'] == 'i':
+            if event.get('pid') not in hosts or 'ts' not in event:
+                raise ValueError(f'Instant event {event.get("name")} needs a '
+                                 'registered pid and a timestamp')
+        elif 'ph' in event and event['ph'] == 'b':
+            if event.get('pid') not in hosts or 'ts' not in event \
+                    or (event['pid'], event.get('id')) in async_events:
+                raise ValueError(f'Async event {event.get("id")} needs a '
+                                 'registered pid, a new id and a timestamp')
+            async_events[(event['pid'], event['id'])] = event
+        elif 'ph' in event and event['ph'] == 'e':
+            begin = async_events.pop((event.get('pid'), event.get('id')), None)
+            if begin is None or begin['ts'] > event['ts']:
+                raise ValueError(f'Async event {event.get("id")} ends before '
+                                 'it begins')
+        elif 'ph' in event and re.search("^(s|f)$", event['ph']):
+            if event.get('pid') not in hosts or 'ts' not in event \
+                    or 'id' not in event:
+                raise ValueError(f'Flow event {event.get("name")} needs a '
+                                 'registered pid, an id and a timestamp')
         else:
             raise ValueError('Event cannot be handled')
 
+    for pid, stack in duration_stacks.items():
+        if stack:
+            raise ValueError(f'Events {list(stack)} of pid {pid} never ended')
+    if async_events:
+        raise ValueError(f'Async events {list(async_events)} never ended')
+    validate_nesting(duration_events)
+
+    # The streaming validator must agree.
+    validator = TraceValidator()
+    for event in trace:
+        validator.feed(event)
+    validator.finish()
+
     return (hosts, duration_events)
 
 
@@ -131,3 +233,186 @@ def add_duration_event(
         curr_stacks[event.pid].pop()
 
     return (events, curr_stacks)
+
+
+def add_complete_event(
+        hosts: Dict[int, HostEvent],
+        events: Dict[int, Any],
+        event_hash: Any) -> Dict[int, Any]:
+
+    event = CompleteEvent(event_hash)
+
+    if event.pid not in hosts:
+        raise ValueError(
+            f'Complete event {event.id} host with pid {event.pid}'
+            'does not match any registered host')
+
+    if event.id in events[event.pid]:
+        raise ValueError(f'Event {event.id} already registered')
+
+    # Complete events are written when they end, after their children, so
+    # their nesting is checked once the whole trace is read.
+    events[event.pid][event.id] = {'X': event, 'children_ids': []}
+    return events
+
+
+def validate_counter_event(hosts: Dict[int, HostEvent], event: Any) -> None:
+    if event.get('pid') not in hosts:
+        raise ValueError(f'Counter event {event.get("name")} pid '
+                         'does not match any registered process')
+    if 'ts' not in event or 'name' not in event:
+        raise ValueError('Counter event needs a name and a timestamp')
+    for key, value in event.get('args', {}).items():
+        if not isinstance(value, (int, float)):
+            raise ValueError(f'Counter {event["name"]} {key} is not a number')
+
+
+def validate_nesting(events: Dict[int, Any]) -> None:
+    # Every pair of spans of a host must either be disjoint or nested.
+    for pid, host_events in events.items():
+        intervals: List[Tuple[float, float, Any]] = []
+        for event_id, event in host_events.items():
+            if 'X' in event:
+                intervals.append((event['X'].ts,
+                                  event['X'].ts + event['X'].dur, event_id))
+            elif 'E' in event:
+                intervals.append((event['B'].ts, event['E'].ts, event_id))
+        intervals.sort(key=lambda interval: (interval[0], -interval[1]))
+
+        stack: List[Tuple[float, float, Any]] = []
+        for start, end, event_id in intervals:
+            while stack and stack[-1][1] <= start:
+                stack.pop()
+            if stack:
+                parent_end = stack[-1][1]
+                if end > parent_end:
+                    raise ValueError(f'Event id {event_id} of pid {pid}'
+                                     f' ends at {end} after its parent'
+                                     f' {stack[-1][2]} ending at {parent_end}')
+                if 'X' in host_events[event_id]:
+                    host_events[event_id]['parent_id'] = stack[-1][2]
+                    host_events[stack[-1][2]]['children_ids'].append(event_id)
+            stack.append((start, end, event_id))
+
+
+def decode_protobuf(data: bytes) -> Dict[int, List[Any]]:
+    # Minimal protobuf decoder: field number -> list of values. Varints are
+    # ints, fixed64 are bytes and length-delimited fields are left as bytes
+    # for the caller to decode as a string or nested message.
+    fields: Dict[int, List[Any]] = {}
+    pos = 0
+
+    def varint() -> int:
+        nonlocal pos
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return result
+
+    while pos < len(data):
+        key = varint()
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value: Any = varint()
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            length = varint()
+            value = data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError(f'Unsupported wire type {wire_type}')
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def parse_perfetto_trace(data: bytes) -> Tuple[Dict[int, str],
+                                                Dict[int, List[Dict[str, Any]]]]:
+    """Decode the track events of a protobuf trace, resolving interned data.
+
+    Returns the process name of each track, and the slices of each track
+    as dicts with name, cat, ts and end in microseconds, and args. Slices of
+    async tracks are returned with their process's, marked async.
+    """
+    tracks: Dict[int, str] = {}
+    slices: Dict[int, List[Dict[str, Any]]] = {}
+    stacks: Dict[int, List[Dict[str, Any]]] = {}
+    interned: Dict[int, Dict[int, str]] = {}
+    counter_tracks: set = set()
+    # The process track of each async track.
+    async_tracks: Dict[int, int] = {}
+
+    for packet_bytes in decode_protobuf(data).get(1, []):
+        packet = decode_protobuf(packet_bytes)
+        flags = packet.get(13, [0])[0]
+        if flags & 1:
+            interned = {}
+        for interned_bytes in packet.get(12, []):
+            for table, entries in decode_protobuf(interned_bytes).items():
+                for entry_bytes in entries:
+                    entry = decode_protobuf(entry_bytes)
+                    interned.setdefault(table, {})[entry[1][0]] = \
+                        entry[2][0].decode('utf-8')
+        for descriptor_bytes in packet.get(60, []):
+            descriptor = decode_protobuf(descriptor_bytes)
+            if 3 in descriptor:
+                process = decode_protobuf(descriptor[3][0])
+                tracks[descriptor[1][0]] = process[6][0].decode('utf-8')
+            elif 8 in descriptor:
+                if descriptor[5][0] not in tracks:
+                    raise ValueError('Counter track parent has no descriptor')
+                counter_tracks.add(descriptor[1][0])
+            elif 5 in descriptor:
+                if descriptor[5][0] not in tracks:
+                    raise ValueError('Async track parent has no descriptor')
+                async_tracks[descriptor[1][0]] = descriptor[5][0]
+        for event_bytes in packet.get(11, []):
+            event = decode_protobuf(event_bytes)
+            if not flags & 2:
+                raise ValueError('Track event packet must need incremental state')
+            track = event[11][0]
+            if event[9][0] == 4:
+                if track not in counter_tracks:
+                    raise ValueError(f'Counter track {track} has no descriptor')
+                continue
+            ts = packet[8][0] / 1000
+            args = {}
+            for annotation_bytes in event.get(4, []):
+                annotation = decode_protobuf(annotation_bytes)
+                name = interned[3][annotation[1][0]]
+                if 17 in annotation:
+                    args[name] = interned[29][annotation[17][0]]
+                elif 2 in annotation:
+                    args[name] = bool(annotation[2][0])
+                elif 4 in annotation:
+                    args[name] = annotation[4][0]
+                elif 5 in annotation:
+                    args[name] = struct.unpack('<d', annotation[5][0])[0]
+            process = async_tracks.get(track, track)
+            if process not in tracks:
+                raise ValueError(f'Track {track} has no descriptor')
+            if event[9][0] == 1:
+                this_slice = {
+                    'name': interned[2][event[10][0]],
+                    'cat': interned[1][event[3][0]],
+                    'ts': ts,
+                    'args': args,
+                }
+                if track in async_tracks:
+                    this_slice['async'] = True
+                slices.setdefault(process, []).append(this_slice)
+                stacks.setdefault(track, []).append(this_slice)
+            elif event[9][0] == 2:
+                this_slice = stacks[track].pop()
+                this_slice['end'] = ts
+                this_slice['args'].update(args)
+
+    for track, stack in stacks.items():
+        if stack:
+            raise ValueError(f'Slices {stack} of track {track} never ended')
+    return (tracks, slices)
@@ -0,0 +1,76 @@
+# Handle integration tests
+from typing import Union, Dict, List, Any
+from utils import get_last_trace, get_last_trace_file, run_tool
+from trace_reader import TraceError
+from trace_validate import TraceValidator
+import copy
+import subprocess
+import pytest
+
+JSONTYPE = Union[None, int, str, bool, List[Any], Dict[str, Any]]
+
+
+def validate(trace: JSONTYPE, in_progress: bool = False):
+    validator = TraceValidator()
+    for event in trace:
+        validator.feed(event)
+    validator.finish(in_progress)
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/multiple_hosts.ini')
+@pytest.mark.ansible_strategy('free')
+def test_validate_multiple_free(ansible_play, tmp_path):
+    trace_json: JSONTYPE = get_last_trace()
+    path = get_last_trace_file()
+    assert run_tool('trace_validate', path).strip() == \
+        f'{path}: {len(trace_json)} events ok'
+
+    # An in-progress trace only validates as such.
+    with open(path, encoding='utf-8') as f:
+        data = f.read()
+    partial = tmp_path / 'partial.json'
+    partial.write_text(data[:len(data) // 2])
+    run_tool('trace_validate', '--in-progress', str(partial))
+    with pytest.raises(subprocess.CalledProcessError):
+        run_tool('trace_validate', str(partial))
+
+    # Broken traces are rejected.
+    ends = [i for i, e in enumerate(trace_json) if e['ph'] == 'E']
+    begins = [i for i, e in enumerate(trace_json) if e['ph'] == 'B']
+
+    renamed = copy.deepcopy(trace_json)
+    renamed[ends[0]]['name'] += ' renamed'
+    with pytest.raises(TraceError, match='same name'):
+        validate(renamed)
+
+    early = copy.deepcopy(trace_json)
+    early[ends[0]]['ts'] = 0
+    with pytest.raises(TraceError, match='lower than its begin'):
+        validate(early)
+
+    unended = [e for i, e in enumerate(trace_json) if i != ends[-1]]
+    with pytest.raises(TraceError, match='never ended'):
+        validate(unended)
+    validate(unended, in_progress=True)
+
+    unknown_pid = copy.deepcopy(trace_json)
+    unknown_pid[begins[0]]['pid'] = 1000
+    with pytest.raises(TraceError, match='registered process'):
+        validate(unknown_pid)
+
+
+@pytest.mark.ansible_playbook('basic/basic.yml')
+@pytest.mark.ansible_inventory('inventories/one_host.ini')
+@pytest.mark.ansible_strategy('linear')
+@pytest.mark.ansible_env({'TRACE_COMPACT': 'True', 'TRACE_COMPRESSION': 'gzip'})
+def test_validate_compact_gzip_single_linear(ansible_play):
+    trace_json: JSONTYPE = get_last_trace()
+    run_tool('trace_validate', get_last_trace_file())
+
+    # A child that outlives its parent overlaps it.
+    runner = next(i for i, e in enumerate(trace_json) if e['cat'] == 'runner')
+    overlapping = copy.deepcopy(trace_json)
+    overlapping[runner]['dur'] *= 1000
+    with pytest.raises(TraceError, match='overlaps'):
+        validate(overlapping)
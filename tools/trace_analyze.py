@@ -0,0 +1,362 @@
+"""
+Report where the time went in a trace written by the trace callback plugin.
+
+    python tools/trace_analyze.py [--top N] [--json] trace/trace-<timestamp>.json
+
+For each play, reports:
+
+-  the duration percentiles of each task across hosts,
+-  the critical path: the chain of task runs that determined how long the
+   play took, from the run that ended last back through the run that ended
+   last before each one started. In a lock-step play (strategy: linear)
+   that's the slowest host of each task, or the run that freed a fork.
+-  for lock-step plays, the time hosts spent waiting for the slowest host of
+   each task before the next task could start.
+
+and across the whole trace, the hosts that spent the most time in tasks,
+and the time handlers ran for, by the task that notified them. A handler
+run notified by several tasks counts in full for each.
+
+Traces of a sample of hosts (TRACE_HOST_SAMPLE_RATE) also carry the
+duration statistics of each task across all hosts, which are reported as
+the fleet-wide task durations.
+
+The trace is streamed, and the spans of each play are summarised once it
+has ended, so memory grows with the hosts and tasks of a play rather than
+with the size of the trace. Compressed and in-progress traces can be read.
+"""
+import argparse
+import bisect
+import json
+import sys
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from trace_reader import PlayGrouper, Span, SpanReader, TraceError, iter_events
+
+# Categories of the spans of a task run on a host.
+TASK_CATEGORIES = ('runner', 'handler')
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """The p-th percentile of sorted values, interpolating between ranks."""
+    if len(values) == 1:
+        return values[0]
+    rank = (len(values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+@dataclass
+class TaskStats:
+    name: str
+    path: str
+    start: float
+    end: float
+    durations: array = field(default_factory=lambda: array('d'))
+    end_sum: float = 0.0
+    slowest_pid: int = 0
+
+    def add(self, span: Span):
+        self.durations.append(span.dur)
+        self.end_sum += span.end
+        self.start = min(self.start, span.ts)
+        if span.end >= self.end or len(self.durations) == 1:
+            self.end = span.end
+            self.slowest_pid = span.pid
+
+
+@dataclass
+class PlayStats:
+    name: str
+    id: Any
+    start: Optional[float] = None
+    end: Optional[float] = None
+    tasks: Dict[Tuple[str, str], TaskStats] = field(default_factory=dict)
+    # (start, end, task key) of each task run, by host pid.
+    runs: Dict[int, List[Tuple[float, float, Tuple[str, str]]]] = field(
+        default_factory=dict)
+
+    def add_play_span(self, span: Span):
+        self.start = span.ts if self.start is None else min(self.start, span.ts)
+        self.end = span.end if self.end is None else max(self.end, span.end)
+
+    def add_task_span(self, span: Span):
+        if self.start is None or span.ts < self.start:
+            self.start = span.ts
+        if self.end is None or span.end > self.end:
+            self.end = span.end
+        key = (span.args.get('path', ''), span.name)
+        stats = self.tasks.get(key)
+        if stats is None:
+            stats = TaskStats(name=span.name, path=key[0],
+                              start=span.ts, end=span.end)
+            self.tasks[key] = stats
+        stats.add(span)
+        self.runs.setdefault(span.pid, []).append((span.ts, span.end, key))
+
+
+@dataclass
+class HostStats:
+    name: str
+    busy: float = 0.0
+    tasks: int = 0
+    failed: int = 0
+
+
+class Analyzer:
+    """Summarises the spans of a trace, one play at a time."""
+
+    def __init__(self):
+        self.reader = SpanReader()
+        self.plays: List[Dict[str, Any]] = []
+        self.hosts: Dict[int, HostStats] = {}
+        # Statistics of each task across all hosts, from task_stats events.
+        self.fleet_tasks: List[Dict[str, Any]] = []
+        # Runs and total duration of handlers, by (notifying task, handler).
+        self.notifications: Dict[Tuple[str, str], List[float]] = {}
+        self._grouper = PlayGrouper(TASK_CATEGORIES)
+        self._play: Optional[PlayStats] = None
+        self._last_ts: float = 0.0
+
+    def feed(self, event: Dict[str, Any]):
+        if 'ts' in event:
+            self._last_ts = max(self._last_ts, event['ts'] + event.get('dur', 0))
+        if event.get('ph') == 'M' and event.get('name') == 'task_stats':
+            stats = dict(event['args'])
+            del stats['sketch']
+            self.fleet_tasks.append(stats)
+            return
+        span = self.reader.feed(event)
+        if span is None:
+            return
+        if span.cat in TASK_CATEGORIES:
+            host = self.hosts.setdefault(span.pid, HostStats(self._host_name(span.pid)))
+            host.busy += span.dur
+            host.tasks += 1
+            if span.args.get('status') in ('failed', 'unreachable'):
+                host.failed += 1
+        for task in span.args.get('notified_by') or []:
+            runs = self.notifications.setdefault((task, span.name), [0, 0.0])
+            runs[0] += 1
+            runs[1] += span.dur
+        group = self._grouper.feed(span)
+        if group is not None:
+            self._add(*group)
+
+    def finish(self):
+        for group in self._grouper.finish(self.reader, self._last_ts):
+            self._add(*group)
+        if self._play is not None:
+            self.plays.append(self._summarise(self._play))
+            self._play = None
+
+    def _add(self, play_span: Optional[Span], task_spans: List[Span]):
+        # Plays run one after another, so a play is summarised once a host
+        # ends the next one. Traces of older versions of the callback have
+        # no play spans.
+        play_id = play_span.id if play_span is not None else None
+        if self._play is None or self._play.id != play_id:
+            if self._play is not None:
+                self.plays.append(self._summarise(self._play))
+            self._play = PlayStats(
+                name=play_span.name if play_span is not None else '',
+                id=play_id)
+        if play_span is not None:
+            self._play.add_play_span(play_span)
+        for span in task_spans:
+            self._play.add_task_span(span)
+
+    def _host_name(self, pid: int) -> str:
+        return self.reader.processes.get(pid, str(pid))
+
+    @staticmethod
+    def _critical_path(play: PlayStats) -> List[Tuple[float, float, int,
+                                                      Tuple[str, str]]]:
+        # Walk back from the run that ended last. Each run waited for the
+        # run that ended last before it started: the same host's previous
+        # task, the slowest host of the previous task in a lock-step play,
+        # or the run that freed a fork.
+        runs = sorted((end, start, pid, key)
+                      for pid, host_runs in play.runs.items()
+                      for start, end, key in host_runs)
+        ends = [run[0] for run in runs]
+        path = []
+        i = len(runs) - 1
+        while i >= 0:
+            end, start, pid, key = runs[i]
+            path.append((start, end, pid, key))
+            i = bisect.bisect_right(ends, start, 0, i) - 1
+        path.reverse()
+        return path
+
+    def _summarise(self, play: PlayStats) -> Dict[str, Any]:
+        tasks = sorted(play.tasks.values(), key=lambda t: t.start)
+        # Lock-step: no task starts on any host until the previous task has
+        # ended on every host.
+        lockstep = all(later.start >= earlier.end
+                       for earlier, later in zip(tasks, tasks[1:]))
+
+        task_reports = []
+        for task in tasks:
+            durations = sorted(task.durations)
+            report = {
+                'task': task.name,
+                'path': task.path,
+                'hosts': len(durations),
+                'min_us': durations[0],
+                'mean_us': sum(durations) / len(durations),
+                'max_us': durations[-1],
+                'slowest_host': self._host_name(task.slowest_pid),
+            }
+            for p in PERCENTILES:
+                report['p%d_us' % p] = percentile(durations, p)
+            if lockstep:
+                # Each host waits from the end of its run for the slowest.
+                report['wait_us'] = len(durations) * task.end - task.end_sum
+            task_reports.append(report)
+
+        path = self._critical_path(play)
+        critical_path = []
+        previous_end = play.start
+        for start, end, pid, (task_path, name) in path:
+            critical_path.append({
+                'task': name,
+                'path': task_path,
+                'host': self._host_name(pid),
+                'start_us': start - play.start,
+                'duration_us': end - start,
+                'gap_us': start - previous_end,
+            })
+            previous_end = end
+
+        duration = play.end - play.start
+        in_tasks = sum(step['duration_us'] for step in critical_path)
+        return {
+            'play': play.name,
+            'hosts': len({pid for pid in play.runs}),
+            'duration_us': duration,
+            'lockstep': lockstep,
+            'wait_us': sum(t.get('wait_us', 0) for t in task_reports),
+            'critical_path_task_us': in_tasks,
+            'critical_path_gap_us': duration - in_tasks,
+            'tasks': task_reports,
+            'critical_path': critical_path,
+        }
+
+    def report(self) -> Dict[str, Any]:
+        hosts = sorted(self.hosts.values(), key=lambda h: -h.busy)
+        return {
+            'plays': self.plays,
+            'hosts': [{'host': h.name, 'busy_us': h.busy, 'tasks': h.tasks,
+                       'failed': h.failed} for h in hosts],
+            'fleet_tasks': self.fleet_tasks,
+            'notified_handlers': [
+                {'task': task, 'handler': handler, 'runs': int(runs),
+                 'total_us': total}
+                for (task, handler), (runs, total) in sorted(
+                    self.notifications.items(), key=lambda n: -n[1][1])],
+        }
+
+
+def analyze(events: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    analyzer = Analyzer()
+    for event in events:
+        analyzer.feed(event)
+    analyzer.finish()
+    return analyzer.report()
+
+
+def _s(us: float) -> str:
+    return '%.3f' % (us / 1e6)
+
+
+def print_report(report: Dict[str, Any], top: int, out=sys.stdout):
+    for play in report['plays']:
+        print('Play "%s": %s s, %d hosts, %d tasks%s' % (
+            play['play'], _s(play['duration_us']), play['hosts'],
+            len(play['tasks']), ', lock-step' if play['lockstep'] else ''),
+            file=out)
+        print('  Critical path: %s s in %d task runs, %s s between them' % (
+            _s(play['critical_path_task_us']), len(play['critical_path']),
+            _s(play['critical_path_gap_us'])), file=out)
+        if play['lockstep']:
+            print('  Waiting for the slowest host: %s s across hosts' % (
+                _s(play['wait_us'])), file=out)
+
+        print('  Slowest tasks (seconds):', file=out)
+        print('  %9s %9s %9s %9s %9s  %s' % (
+            'p50', 'p95', 'p99', 'max', 'waiting', 'task'), file=out)
+        for task in sorted(play['tasks'], key=lambda t: -t['p95_us'])[:top]:
+            print('  %9s %9s %9s %9s %9s  %s (%s, slowest: %s)' % (
+                _s(task['p50_us']), _s(task['p95_us']), _s(task['p99_us']),
+                _s(task['max_us']),
+                _s(task['wait_us']) if 'wait_us' in task else '-',
+                task['task'], task['path'], task['slowest_host']), file=out)
+
+        print('  Longest steps of the critical path (seconds):', file=out)
+        print('  %9s %9s %9s  %s' % ('start', 'duration', 'gap', 'task'),
+              file=out)
+        steps = sorted(play['critical_path'], key=lambda s: -s['duration_us'])
+        for step in steps[:top]:
+            print('  %9s %9s %9s  %s on %s' % (
+                _s(step['start_us']), _s(step['duration_us']),
+                _s(step['gap_us']), step['task'], step['host']), file=out)
+        print(file=out)
+
+    if report['fleet_tasks']:
+        print('Slowest tasks across all hosts, traced or not (seconds):',
+              file=out)
+        print('  %9s %9s %9s %9s %7s  %s' % (
+            'p50', 'p95', 'p99', 'max', 'hosts', 'task'), file=out)
+        for task in sorted(report['fleet_tasks'],
+                           key=lambda t: -t['p95_us'])[:top]:
+            print('  %9s %9s %9s %9s %7d  %s (%s, play "%s")' % (
+                _s(task['p50_us']), _s(task['p95_us']), _s(task['p99_us']),
+                _s(task['max_us']), task['hosts'], task['task'], task['path'],
+                task['play']), file=out)
+        print(file=out)
+
+    if report['notified_handlers']:
+        print('Handler time by the task that notified it (seconds):', file=out)
+        print('  %9s %7s  %s' % ('total', 'runs', 'task -> handler'), file=out)
+        for n in report['notified_handlers'][:top]:
+            print('  %9s %7d  %s -> %s' % (
+                _s(n['total_us']), n['runs'], n['task'], n['handler']), file=out)
+        print(file=out)
+
+    print('Slowest hosts (seconds in tasks):', file=out)
+    for host in report['hosts'][:top]:
+        print('  %9s  %s (%d tasks, %d failed)' % (
+            _s(host['busy_us']), host['host'], host['tasks'], host['failed']),
+            file=out)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('trace', help='JSON trace, optionally gzip or zstd compressed')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of tasks, steps and hosts to list')
+    parser.add_argument('--json', action='store_true',
+                        help='write the full report as JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        report = analyze(iter_events(args.trace))
+    except TraceError as e:
+        print('%s: %s' % (args.trace, e), file=sys.stderr)
+        return 1
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report, args.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
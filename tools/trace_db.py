@@ -0,0 +1,255 @@
+"""
+Import traces into the SQLite database of the trace callback's sqlite
+format, and report task and host latency across runs.
+
+    python tools/trace_db.py DATABASE import trace/*.json*
+    python tools/trace_db.py DATABASE runs
+    python tools/trace_db.py DATABASE tasks [--days 30] [--task NAME] [--path PATH]
+    python tools/trace_db.py DATABASE hosts [--days 30]
+    python tools/trace_db.py DATABASE history --path PATH [--task NAME]
+
+Traces are imported with the same writer as TRACE_FORMAT=sqlite, from
+plugins/module_utils/trace_writers.py, so the database can mix runs written
+live and imported later. Each trace file is a run, named after the file,
+and is only imported once. Only the standard library is needed, not
+Ansible, and the database can also be queried directly: see the schema in
+trace_writers.py.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from trace_reader import TraceError, iter_events
+
+# The plugin's writers need only the standard library.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plugins', 'module_utils'))
+from trace_writers import SqliteTraceWriter  # noqa: E402
+
+# Categories of the spans of a task run on a host.
+TASK_CATEGORIES = ('runner', 'handler')
+
+
+def run_name(path: str) -> str:
+    name = os.path.basename(path)
+    for extension in ('.gz', '.zst', '.json'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name
+
+
+def import_traces(database: str, paths: List[str], out=sys.stdout) -> int:
+    status = 0
+    for path in paths:
+        name = run_name(path)
+        with sqlite3.connect(database) as db:
+            try:
+                exists = db.execute('SELECT 1 FROM runs WHERE name = ?',
+                                    (name,)).fetchone()
+            except sqlite3.OperationalError:
+                exists = None
+        if exists:
+            print('%s: already imported as run %s' % (path, name), file=out)
+            continue
+        writer = SqliteTraceWriter(database, name, batch_size=10000,
+                                   commit_interval=float('inf'))
+        events = 0
+        try:
+            for event in iter_events(path):
+                writer.write(event)
+                events += 1
+        except TraceError as e:
+            print('%s: %s' % (path, e), file=sys.stderr)
+            status = 1
+        finally:
+            writer.close()
+        print('%s: imported %d events as run %s' % (path, events, name), file=out)
+    return status
+
+
+def percentile(values: List[float], p: float) -> float:
+    """The p-th percentile of sorted values, interpolating between ranks."""
+    rank = (len(values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def _since(days: Optional[float]) -> float:
+    return (time.time() - days * 86400) * 1e6 if days else float('-inf')
+
+
+def _task_filter(args) -> Tuple[str, List[Any]]:
+    where = ['s.cat IN (%s)' % ', '.join('?' * len(TASK_CATEGORIES)),
+             's.start_us >= ?']
+    params: List[Any] = list(TASK_CATEGORIES) + [_since(args.days)]
+    if getattr(args, 'task', None):
+        where.append('t.name LIKE ?')
+        params.append(args.task)
+    if getattr(args, 'path', None):
+        where.append('t.path LIKE ?')
+        params.append(args.path)
+    return ' AND '.join(where), params
+
+
+def report_runs(db: sqlite3.Connection, args) -> List[Dict[str, Any]]:
+    rows = db.execute(
+        'SELECT r.name, r.started_at, r.end_us - r.start_us, '
+        '(SELECT COUNT(DISTINCT host_id) FROM spans WHERE run_id = r.id), '
+        '(SELECT COUNT(*) FROM spans WHERE run_id = r.id) '
+        'FROM runs r ORDER BY r.start_us')
+    return [{'run': name, 'started_at': started_at, 'duration_us': duration,
+             'hosts': hosts, 'spans': spans}
+            for name, started_at, duration, hosts, spans in rows]
+
+
+def report_tasks(db: sqlite3.Connection, args) -> List[Dict[str, Any]]:
+    where, params = _task_filter(args)
+    rows = db.execute(
+        'SELECT t.path, t.name, s.run_id, s.end_us - s.start_us '
+        'FROM spans s JOIN tasks t ON t.id = s.task_id '
+        'WHERE %s ORDER BY t.path, t.name' % where, params)
+    # Durations of one task at a time, so memory follows the task with the
+    # most runs rather than the database.
+    report = []
+    key, runs, durations = None, set(), []
+
+    def add():
+        durations.sort()
+        report.append({
+            'path': key[0], 'task': key[1], 'runs': len(runs),
+            'count': len(durations), 'mean_us': sum(durations) / len(durations),
+            'p50_us': percentile(durations, 50),
+            'p95_us': percentile(durations, 95), 'max_us': durations[-1]})
+    for path, name, run_id, duration in rows:
+        if (path, name) != key:
+            if key is not None:
+                add()
+            key, runs, durations = (path, name), set(), []
+        runs.add(run_id)
+        durations.append(duration)
+    if key is not None:
+        add()
+    report.sort(key=lambda task: -task['p95_us'])
+    return report[:args.top]
+
+
+def report_hosts(db: sqlite3.Connection, args) -> List[Dict[str, Any]]:
+    where, params = _task_filter(args)
+    rows = db.execute(
+        'SELECT h.name, COUNT(DISTINCT s.run_id), COUNT(*), '
+        'SUM(s.end_us - s.start_us), MAX(s.end_us - s.start_us), '
+        "SUM(s.status IN ('failed', 'unreachable')) "
+        'FROM spans s JOIN hosts h ON h.id = s.host_id '
+        'JOIN tasks t ON t.id = s.task_id '
+        'WHERE %s GROUP BY h.id ORDER BY SUM(s.end_us - s.start_us) DESC '
+        'LIMIT ?' % where, params + [args.top])
+    return [{'host': name, 'runs': runs, 'tasks': tasks, 'busy_us': busy,
+             'max_us': longest, 'failed': failed}
+            for name, runs, tasks, busy, longest, failed in rows]
+
+
+def report_history(db: sqlite3.Connection, args) -> List[Dict[str, Any]]:
+    where, params = _task_filter(args)
+    rows = db.execute(
+        'SELECT r.name, r.started_at, t.name, COUNT(*), '
+        'AVG(s.end_us - s.start_us), MAX(s.end_us - s.start_us) '
+        'FROM spans s JOIN tasks t ON t.id = s.task_id '
+        'JOIN runs r ON r.id = s.run_id '
+        'WHERE %s GROUP BY r.id, t.id ORDER BY r.start_us' % where, params)
+    return [{'run': run, 'started_at': started_at, 'task': task,
+             'hosts': hosts, 'mean_us': mean, 'max_us': longest}
+            for run, started_at, task, hosts, mean, longest in rows]
+
+
+def _s(us: Optional[float]) -> str:
+    return '%.3f' % (us / 1e6) if us is not None else '-'
+
+
+def print_report(command: str, report: List[Dict[str, Any]], out=sys.stdout):
+    if command == 'runs':
+        print('%-40s %-26s %10s %6s %8s' % (
+            'run', 'started at', 'seconds', 'hosts', 'spans'), file=out)
+        for r in report:
+            print('%-40s %-26s %10s %6d %8d' % (
+                r['run'], r['started_at'] or '-', _s(r['duration_us']),
+                r['hosts'], r['spans']), file=out)
+    elif command == 'tasks':
+        print('%6s %7s %9s %9s %9s  %s' % (
+            'runs', 'count', 'p50', 'p95', 'max', 'task'), file=out)
+        for t in report:
+            print('%6d %7d %9s %9s %9s  %s (%s)' % (
+                t['runs'], t['count'], _s(t['p50_us']), _s(t['p95_us']),
+                _s(t['max_us']), t['task'], t['path']), file=out)
+    elif command == 'hosts':
+        print('%6s %7s %10s %9s %7s  %s' % (
+            'runs', 'tasks', 'busy', 'max', 'failed', 'host'), file=out)
+        for h in report:
+            print('%6d %7d %10s %9s %7d  %s' % (
+                h['runs'], h['tasks'], _s(h['busy_us']), _s(h['max_us']),
+                h['failed'], h['host']), file=out)
+    elif command == 'history':
+        print('%-26s %6s %9s %9s  %s' % (
+            'started at', 'hosts', 'mean', 'max', 'task'), file=out)
+        for r in report:
+            print('%-26s %6d %9s %9s  %s' % (
+                r['started_at'] or r['run'], r['hosts'], _s(r['mean_us']),
+                _s(r['max_us']), r['task']), file=out)
+
+
+REPORTS = {
+    'runs': report_runs,
+    'tasks': report_tasks,
+    'hosts': report_hosts,
+    'history': report_history,
+}
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('database', help='SQLite database')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    importer = commands.add_parser('import', help='import trace files')
+    importer.add_argument('traces', nargs='+', metavar='trace',
+                          help='JSON trace, optionally gzip or zstd compressed')
+    for command, description in (
+            ('runs', 'list the runs'),
+            ('tasks', 'duration percentiles of the slowest tasks'),
+            ('hosts', 'hosts that spent the longest in tasks'),
+            ('history', "a task's duration in each run")):
+        report = commands.add_parser(command, help=description)
+        report.add_argument('--json', action='store_true',
+                            help='write the report as JSON')
+        if command == 'runs':
+            continue
+        report.add_argument('--days', type=float,
+                            help='only spans of the last this many days')
+        report.add_argument('--task', help='task name, a SQL LIKE pattern')
+        report.add_argument('--path', required=command == 'history',
+                            help='task path, a SQL LIKE pattern')
+        if command != 'history':
+            report.add_argument('--top', type=int, default=20,
+                                help='number of tasks or hosts to list')
+    args = parser.parse_args(argv)
+
+    if args.command == 'import':
+        return import_traces(args.database, args.traces)
+    if not os.path.exists(args.database):
+        parser.error('%s does not exist' % args.database)
+    with sqlite3.connect(args.database) as db:
+        report = REPORTS[args.command](db, args)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(args.command, report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,271 @@
+"""
+Compare traces of runs of the same playbook, and report what got slower.
+
+    python tools/trace_diff.py [options] BASELINE [BASELINE...] CANDIDATE
+
+Tasks are matched by their play, name and path, and hosts by their name.
+With several baselines, each duration is compared with its median across
+the baselines. A task or play regresses when its duration grows by more than
+--threshold (a fraction) and by at least --min-delta seconds, so small tasks
+don't flap on noise. Exits with status 1 if anything regressed.
+
+Each trace is streamed into an index of the duration of each task on each
+host, an array of numbers per task, so large traces are compared without
+holding their events in memory.
+"""
+import argparse
+import json
+import math
+import statistics
+import sys
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+from trace_reader import PlayGrouper, Span, SpanReader, TraceError, iter_events
+
+TASK_CATEGORIES = ('runner', 'handler')
+
+# (play, task path, task name)
+TaskKey = Tuple[str, str, str]
+
+
+class TraceIndex:
+    """The durations of the plays of a trace, and of its tasks on each host.
+
+    hosts maps host names to their column in the task arrays, and is shared
+    between the indexes being compared.
+    """
+
+    def __init__(self, path: str, hosts: Dict[str, int]):
+        self.path = path
+        self.hosts = hosts
+        self.tasks: Dict[TaskKey, array] = {}
+        # Start and end of each play.
+        self.plays: Dict[str, List[float]] = {}
+        # Play keys by play span id. Plays of the same name are numbered,
+        # as a playbook can import the same plays more than once.
+        self._play_keys: Dict[Any, str] = {}
+        self._play_names: Dict[str, int] = {}
+
+    @classmethod
+    def load(cls, path: str, hosts: Dict[str, int]) -> 'TraceIndex':
+        index = cls(path, hosts)
+        reader = SpanReader()
+        grouper = PlayGrouper(TASK_CATEGORIES)
+        last_ts = 0.0
+        for event in iter_events(path):
+            if 'ts' in event:
+                last_ts = max(last_ts, event['ts'] + event.get('dur', 0))
+            span = reader.feed(event)
+            if span is not None:
+                group = grouper.feed(span)
+                if group is not None:
+                    index._add(reader, *group)
+        for group in grouper.finish(reader, last_ts):
+            index._add(reader, *group)
+        return index
+
+    def _add(self, reader: SpanReader, play_span: Optional[Span],
+             task_spans: List[Span]):
+        if play_span is None:
+            play = ''
+        else:
+            play = self._play_keys.get(play_span.id)
+            if play is None:
+                n = self._play_names.get(play_span.name, 0) + 1
+                self._play_names[play_span.name] = n
+                play = play_span.name if n == 1 else '%s #%d' % (play_span.name, n)
+                self._play_keys[play_span.id] = play
+            bounds = self.plays.setdefault(play, [play_span.ts, play_span.end])
+            bounds[0] = min(bounds[0], play_span.ts)
+            bounds[1] = max(bounds[1], play_span.end)
+        for span in task_spans:
+            host = reader.processes.get(span.pid, str(span.pid))
+            column = self.hosts.setdefault(host, len(self.hosts))
+            durations = self.tasks.setdefault(
+                (play, span.args.get('path', ''), span.name), array('d'))
+            if len(durations) <= column:
+                durations.extend([math.nan] * (column + 1 - len(durations)))
+            if math.isnan(durations[column]):
+                durations[column] = 0.0
+            # A task can run more than once on a host, e.g. in a loop of
+            # include_tasks.
+            durations[column] += span.dur
+
+
+def _values(durations: array) -> List[float]:
+    return [d for d in durations if not math.isnan(d)]
+
+
+def _metric(values: List[float], metric: str) -> float:
+    if metric == 'mean':
+        return sum(values) / len(values)
+    if metric == 'max':
+        return max(values)
+    values = sorted(values)
+    rank = (len(values) - 1) * int(metric[1:]) / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def _median(values: List[float]) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+
+class Comparison:
+
+    def __init__(self, threshold: float, min_delta_us: float):
+        self.threshold = threshold
+        self.min_delta_us = min_delta_us
+
+    def compare(self, baseline: float, candidate: float) -> Dict[str, Any]:
+        delta = candidate - baseline
+        return {
+            'baseline_us': baseline,
+            'candidate_us': candidate,
+            'delta_us': delta,
+            'change': delta / baseline if baseline else None,
+            'regressed': delta >= self.min_delta_us
+            and delta > self.threshold * baseline,
+            'improved': -delta >= self.min_delta_us
+            and -delta > self.threshold * baseline,
+        }
+
+
+def diff(baselines: List[TraceIndex], candidate: TraceIndex, metric: str,
+         threshold: float, min_delta: float, top: int) -> Dict[str, Any]:
+    comparison = Comparison(threshold, min_delta * 1e6)
+    host_names = {column: host for host, column in candidate.hosts.items()}
+
+    plays = []
+    for play, (start, end) in candidate.plays.items():
+        baseline = _median([b.plays[play][1] - b.plays[play][0]
+                            for b in baselines if play in b.plays])
+        if baseline is None:
+            continue
+        plays.append(dict(play=play, **comparison.compare(baseline, end - start)))
+
+    tasks = []
+    for key, durations in candidate.tasks.items():
+        present = [b.tasks[key] for b in baselines if key in b.tasks]
+        if not present:
+            continue
+        values = _values(durations)
+        report = dict(
+            play=key[0], path=key[1], task=key[2], hosts=len(values),
+            **comparison.compare(
+                _median([_metric(_values(b), metric) for b in present]),
+                _metric(values, metric)))
+        if report['regressed']:
+            # The hosts that slowed down the most.
+            host_deltas = []
+            for column, duration in enumerate(durations):
+                base = _median([b[column] for b in present if column < len(b)
+                                and not math.isnan(b[column])])
+                if not math.isnan(duration) and base is not None:
+                    host_deltas.append((duration - base, host_names[column]))
+            host_deltas.sort(reverse=True)
+            report['slowest_hosts'] = [
+                {'host': host, 'delta_us': delta}
+                for delta, host in host_deltas[:top]]
+        tasks.append(report)
+
+    baseline_keys = set().union(*(b.tasks for b in baselines))
+    return {
+        'baselines': [b.path for b in baselines],
+        'candidate': candidate.path,
+        'metric': metric,
+        'threshold': threshold,
+        'min_delta_us': min_delta * 1e6,
+        'regressions': sum(r['regressed'] for r in plays + tasks),
+        'plays': plays,
+        'tasks': tasks,
+        'added': [{'play': k[0], 'path': k[1], 'task': k[2]}
+                  for k in candidate.tasks if k not in baseline_keys],
+        'removed': [{'play': k[0], 'path': k[1], 'task': k[2]}
+                    for k in sorted(baseline_keys) if k not in candidate.tasks],
+    }
+
+
+def _s(us: float) -> str:
+    return '%.3f' % (us / 1e6)
+
+
+def _change(report: Dict[str, Any]) -> str:
+    change = '%+.0f%%' % (report['change'] * 100) \
+        if report['change'] is not None else 'new'
+    return '%s s -> %s s (%s)' % (
+        _s(report['baseline_us']), _s(report['candidate_us']), change)
+
+
+def print_report(report: Dict[str, Any], out=sys.stdout):
+    print('Comparing %s with %s%s, tasks by their %s across hosts' % (
+        report['candidate'], report['baselines'][0],
+        ' and %d more (median)' % (len(report['baselines']) - 1)
+        if len(report['baselines']) > 1 else '', report['metric']), file=out)
+    for kind in ('regressed', 'improved'):
+        plays = [p for p in report['plays'] if p[kind]]
+        tasks = sorted((t for t in report['tasks'] if t[kind]),
+                       key=lambda t: -abs(t['delta_us']))
+        print('%s: %d plays, %d tasks' % (
+            kind.capitalize(), len(plays), len(tasks)), file=out)
+        for play in plays:
+            print('  play "%s": %s' % (play['play'], _change(play)), file=out)
+        for task in tasks:
+            print('  task "%s" (%s) in play "%s": %s' % (
+                task['task'], task['path'], task['play'], _change(task)),
+                file=out)
+            if 'slowest_hosts' in task:
+                print('    most slowed down: %s' % ', '.join(
+                    '%s +%s s' % (h['host'], _s(h['delta_us']))
+                    for h in task['slowest_hosts']), file=out)
+    for kind in ('added', 'removed'):
+        if report[kind]:
+            print('%s: %d tasks' % (kind.capitalize(), len(report[kind])),
+                  file=out)
+            for task in report[kind]:
+                print('  task "%s" (%s) in play "%s"' % (
+                    task['task'], task['path'], task['play']), file=out)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('traces', nargs='+', metavar='trace',
+                        help='baseline traces, then the candidate trace')
+    parser.add_argument('--metric', default='mean',
+                        choices=('mean', 'p50', 'p95', 'max'),
+                        help="how to summarise a task's durations across hosts")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown to report, e.g. 0.2 for 20%%')
+    parser.add_argument('--min-delta', type=float, default=0.5,
+                        help='smallest slowdown to report, in seconds')
+    parser.add_argument('--top', type=int, default=5,
+                        help='number of slowed down hosts to list per task')
+    parser.add_argument('--json', action='store_true',
+                        help='write the report as JSON')
+    args = parser.parse_args(argv)
+    if len(args.traces) < 2:
+        parser.error('needs a baseline and a candidate trace')
+
+    hosts: Dict[str, int] = {}
+    indexes = []
+    for path in args.traces:
+        try:
+            indexes.append(TraceIndex.load(path, hosts))
+        except TraceError as e:
+            print('%s: %s' % (path, e), file=sys.stderr)
+            return 2
+    report = diff(indexes[:-1], indexes[-1], args.metric, args.threshold,
+                  args.min_delta, args.top)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+    return 1 if report['regressions'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
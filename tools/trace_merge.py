@@ -0,0 +1,245 @@
+"""
+Merge the traces of the shards of a run into one trace.
+
+    python tools/trace_merge.py -o merged.json.gz trace/trace-*-shard*.json*
+
+Shards are the traces of controllers that ran parts of the same run, each
+with the same TRACE_RUN_ID and its own TRACE_SHARD_ID. They're read one
+event at a time and merged by time, keeping each shard's own order, so
+memory doesn't grow with their size.
+
+Each shard numbers its processes, plays, flows and task argument refs
+from 1, so they're renumbered. Each shard keeps its own processes, and its
+plays their own ids: a host that ran in several shards gets a process under
+its name in each, since shards run at the same time and their spans on one
+track wouldn't nest. Controllers are named after their shard. The merged trace starts with a trace_info event listing
+the shards.
+
+Each shard's timestamps count from when its own controller started, at
+the wall clock time in its trace_info, so they're moved to count from the
+earliest shard's start. Shards without one have wall clock timestamps.
+
+The merged trace is written as the callback writes compact traces, with
+only the standard library, or the zstandard package for .zst output.
+"""
+import argparse
+import gzip
+import heapq
+import io
+import itertools
+import json
+import os
+import sys
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
+
+from trace_reader import TraceError, iter_events
+
+
+class Shard:
+    """The events of one shard, and how its ids map to the merged trace's."""
+
+    def __init__(self, index: int, path: str):
+        self.index = index
+        self.path = path
+        self.info: Optional[Dict[str, Any]] = None
+        self.pids: Dict[int, int] = {}
+        self.play_ids: Dict[Any, int] = {}
+        self.refs: Dict[int, int] = {}
+        # Flows that have started but not finished.
+        self.flow_ids: Dict[int, int] = {}
+        # Added to the shard's timestamps.
+        self.offset = 0
+        events = iter_events(path)
+        first = next(events, None)
+        if first is not None and first.get('name') == 'trace_info':
+            self.info = first['args']
+        self._events = itertools.chain([first] if first is not None else [], events)
+
+    @property
+    def origin(self) -> Optional[int]:
+        """Wall clock time of the shard's timestamp 0, in microseconds."""
+        return (self.info or {}).get('time_origin_unix_us')
+
+    @property
+    def name(self) -> str:
+        if self.info and self.info.get('shard_id'):
+            return self.info['shard_id']
+        return os.path.basename(self.path)
+
+    def keyed_events(self) -> Iterator[Tuple[float, int, int, Dict[str, Any]]]:
+        """The shard's events, keyed by when they were written. Complete
+        events are written when they end, so the key never goes back."""
+        written = float('-inf')
+        for seq, event in enumerate(self._events):
+            if 'ts' in event:
+                if self.offset:
+                    event = dict(event, ts=event['ts'] + self.offset)
+                written = max(written, event['ts'] + event.get('dur', 0))
+            yield written, self.index, seq, event
+
+
+class Merger:
+
+    def __init__(self, shards: List[Shard]):
+        self.shards = shards
+        # Names of the hosts in any shard.
+        self.hosts: Set[str] = set()
+        self._next_pid = 1
+        self._next_play_id = 1
+        self._next_ref = 1
+        self._next_flow_id = 1
+        origins = [s.origin for s in shards if s.origin is not None]
+        self.origin: Optional[int] = min(origins) if origins else None
+        if self.origin is not None:
+            for shard in shards:
+                shard.offset = (shard.origin or 0) - self.origin
+
+    def info(self) -> Dict[str, Any]:
+        run_ids = {(s.info or {}).get('run_id') for s in self.shards}
+        return {
+            "name": "trace_info",
+            "pid": 0,
+            "cat": "trace_info",
+            "ph": "M",
+            "args": {
+                "run_id": run_ids.pop() if len(run_ids) == 1 else None,
+                "time_origin_unix_us": self.origin,
+                "shards": [dict(s.info or {}, path=s.path) for s in self.shards],
+            },
+        }
+
+    def events(self) -> Iterator[Dict[str, Any]]:
+        yield self.info()
+        for _, index, _, event in heapq.merge(
+                *(s.keyed_events() for s in self.shards)):
+            event = self._remap(self.shards[index], event)
+            if event is not None:
+                yield event
+
+    def _new_pid(self) -> int:
+        pid = self._next_pid
+        self._next_pid += 1
+        return pid
+
+    def _pid(self, shard: Shard, pid: Optional[int]) -> Optional[int]:
+        if not pid:
+            # pid 0 holds metadata about the whole run.
+            return pid
+        if pid not in shard.pids:
+            shard.pids[pid] = self._new_pid()
+        return shard.pids[pid]
+
+    def _remap(self, shard: Shard, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        event = dict(event)
+        ph = event.get('ph')
+        name = event.get('name')
+        if ph == 'M' and name == 'trace_info':
+            return None
+        if ph == 'M' and name == 'process_name':
+            host = event['args']['name']
+            if event.get('cat') == 'process':
+                self.hosts.add(host)
+            else:
+                event['args'] = dict(event['args'],
+                                     name='%s (%s)' % (host, shard.name))
+        if ph == 'M' and name == 'task_args':
+            args = dict(event['args'])
+            shard.refs[args['ref']] = self._next_ref
+            args['ref'] = self._next_ref
+            self._next_ref += 1
+            event['args'] = args
+        if 'pid' in event:
+            event['pid'] = self._pid(shard, event['pid'])
+        if event.get('cat') == 'play' and 'id' in event:
+            if event['id'] not in shard.play_ids:
+                shard.play_ids[event['id']] = self._next_play_id
+                self._next_play_id += 1
+            event['id'] = shard.play_ids[event['id']]
+        if ph == 's':
+            shard.flow_ids[event['id']] = self._next_flow_id
+            event['id'] = self._next_flow_id
+            self._next_flow_id += 1
+        elif ph == 'f':
+            event['id'] = shard.flow_ids.pop(event['id'])
+        args = event.get('args')
+        if isinstance(args, dict) and 'args_ref' in args:
+            event['args'] = dict(args, args_ref=shard.refs[args['args_ref']])
+        return event
+
+
+def open_output(path: str) -> BinaryIO:
+    """Open path for writing, compressing it if it ends in .gz or .zst."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wb')
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+class TraceWriter:
+    """Writes events to f as a JSON array, one compact event per line."""
+
+    def __init__(self, f: BinaryIO):
+        self._f = io.TextIOWrapper(f, encoding='utf-8')
+        self._f.write('[\n')
+        self._first = True
+        self._encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+    def write(self, event: Dict[str, Any]):
+        data = self._encoder.encode(event)
+        if not self._first:
+            self._f.write(',\n')
+        self._first = False
+        self._f.write(data)
+
+    def close(self):
+        self._f.write('\n]')
+        self._f.close()
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('shards', nargs='+', metavar='shard',
+                        help='JSON trace, optionally gzip or zstd compressed')
+    parser.add_argument('-o', '--output', required=True,
+                        help='merged trace, compressed if it ends in .gz or .zst')
+    parser.add_argument('--force', action='store_true',
+                        help='merge shards of different runs')
+    args = parser.parse_args(argv)
+
+    try:
+        shards = [Shard(i, path) for i, path in enumerate(args.shards)]
+    except TraceError as e:
+        print(e, file=sys.stderr)
+        return 2
+    run_ids = {(s.info or {}).get('run_id') for s in shards}
+    if len(run_ids) > 1 and not args.force:
+        print('Shards are from different runs (%s), use --force to merge them '
+              'anyway' % ', '.join(sorted(str(r) for r in run_ids)),
+              file=sys.stderr)
+        return 2
+
+    try:
+        writer = TraceWriter(open_output(args.output))
+    except ImportError:
+        parser.error('writing zstd needs the zstandard package')
+    merger = Merger(shards)
+    events = 0
+    status = 0
+    try:
+        for event in merger.events():
+            writer.write(event)
+            events += 1
+    except TraceError as e:
+        print(e, file=sys.stderr)
+        status = 2
+    finally:
+        writer.close()
+    print('%s: %d events of %d hosts from %d shards' % (
+        args.output, events, len(merger.hosts), len(shards)))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
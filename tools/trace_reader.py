@@ -0,0 +1,223 @@
+"""
+Streaming reader for traces written by the trace callback plugin.
+
+Events are decoded one at a time, so traces of any size are read in memory
+proportional to the largest event rather than the whole file. In-progress
+traces, which have no closing bracket and may end part way through an event,
+are read up to their last complete event. Gzip and zstd compressed traces
+are decompressed on the fly.
+
+    for event in iter_events('trace/trace-2021-01-01T00:00:00.json.gz'):
+        ...
+"""
+import codecs
+import gzip
+import json
+from dataclasses import dataclass
+from typing import (Any, BinaryIO, Dict, Iterable, Iterator, List, Optional,
+                    Tuple, Union)
+
+CHUNK_SIZE = 1 << 16
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class TraceError(ValueError):
+    """The trace is not a valid trace of the trace callback."""
+
+
+def open_trace(path: str) -> BinaryIO:
+    """Open a trace for reading, decompressing it if needed."""
+    f = open(path, 'rb')
+    magic = f.read(4)
+    f.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if magic.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError:
+            f.close()
+            raise TraceError('%s is zstd compressed, reading it needs the '
+                             'zstandard package' % path)
+        # read_across_frames: each flush of the callback ends a frame.
+        return zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=True, closefd=True)
+    return f
+
+
+def iter_events(source: Union[str, BinaryIO],
+                chunk_size: int = CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    """Yield the events of a JSON trace one at a time.
+
+    source is a path, or a binary file object that is read to its end.
+    """
+    if isinstance(source, str):
+        with open_trace(source) as f:
+            yield from iter_events(f, chunk_size)
+        return
+
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # Skip the separators between events.
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and not started:
+            if buf[pos] != '[':
+                raise TraceError('Trace is not a JSON array of events')
+            started = True
+            pos += 1
+            continue
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf):
+            try:
+                event, end = decoder.raw_decode(buf, pos)
+            except ValueError as e:
+                # The event continues in the next chunk, or was cut short
+                # by the end of an in-progress trace. Events start on a new
+                # line, so a later event means this one is broken.
+                if eof:
+                    if '\n{' in buf[pos:]:
+                        raise TraceError('Invalid trace event: %s' % e)
+                    return
+            else:
+                if not isinstance(event, dict):
+                    raise TraceError('Trace event %r is not an object' % (event,))
+                pos = end
+                yield event
+                continue
+        if eof:
+            return
+        chunk = source.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + text.decode(chunk, final=eof)
+        pos = 0
+
+
+@dataclass
+class Span:
+    """A span, from its B and E events, its X event, or its b and e async
+    events."""
+    name: str
+    cat: str
+    pid: int
+    id: Any
+    ts: float
+    end: float
+    args: Dict[str, Any]
+
+    @property
+    def dur(self) -> float:
+        return self.end - self.ts
+
+
+class SpanReader:
+    """Pairs the begin and end events of a trace into spans.
+
+    Feed it events in file order: feed returns each span once it has ended.
+    Only spans that haven't ended yet are kept, in a stack per process.
+    Process names from process_name metadata are collected in processes.
+    """
+
+    def __init__(self):
+        self.processes: Dict[int, str] = {}
+        self._stacks: Dict[int, List[Dict[str, Any]]] = {}
+        # Begin events of open async events, by (pid, id).
+        self._async: Dict[Tuple[int, Any], Dict[str, Any]] = {}
+
+    def feed(self, event: Dict[str, Any]) -> Optional[Span]:
+        ph = event.get('ph')
+        if ph == 'M':
+            if event.get('name') == 'process_name':
+                self.processes[event['pid']] = event['args']['name']
+            return None
+        if ph == 'B':
+            self._stacks.setdefault(event['pid'], []).append(event)
+            return None
+        if ph == 'E':
+            stack = self._stacks.get(event['pid'])
+            if not stack or stack[-1].get('id') != event.get('id'):
+                raise TraceError('End event %s of pid %s does not end the last '
+                                 'span begun' % (event.get('id'), event['pid']))
+            begin = stack.pop()
+            args = dict(begin.get('args') or {}, **(event.get('args') or {}))
+            return Span(name=begin['name'], cat=begin.get('cat', ''),
+                        pid=begin['pid'], id=begin.get('id'), ts=begin['ts'],
+                        end=event['ts'], args=args)
+        if ph == 'X':
+            return Span(name=event['name'], cat=event.get('cat', ''),
+                        pid=event['pid'], id=event.get('id'), ts=event['ts'],
+                        end=event['ts'] + event['dur'],
+                        args=event.get('args') or {})
+        if ph == 'b':
+            self._async[(event['pid'], event.get('id'))] = event
+            return None
+        if ph == 'e':
+            begin = self._async.pop((event['pid'], event.get('id')), None)
+            if begin is None:
+                raise TraceError('Async end event %s of pid %s was not begun'
+                                 % (event.get('id'), event['pid']))
+            args = dict(begin.get('args') or {}, **(event.get('args') or {}))
+            return Span(name=begin['name'], cat=begin.get('cat', ''),
+                        pid=begin['pid'], id=begin.get('id'), ts=begin['ts'],
+                        end=event['ts'], args=args)
+        return None
+
+    def open_spans(self) -> Iterator[Dict[str, Any]]:
+        """The begin events of the spans that haven't ended, outermost first."""
+        for stack in self._stacks.values():
+            yield from stack
+
+
+def iter_spans(events: Iterable[Dict[str, Any]],
+               reader: Optional[SpanReader] = None) -> Iterator[Span]:
+    """Yield the spans of a stream of events as they end."""
+    reader = reader or SpanReader()
+    for event in events:
+        span = reader.feed(event)
+        if span is not None:
+            yield span
+
+
+class PlayGrouper:
+    """Groups the task spans of each host by the play they ran in.
+
+    Feed it spans as they end: feed returns each host's play span with the
+    task spans within it once the play span has ended. In compact traces
+    play spans are written after their tasks, so the task spans of each
+    host's current play are kept until then.
+    """
+
+    def __init__(self, categories: Iterable[str] = ('runner',)):
+        self._categories = tuple(categories)
+        self._pending: Dict[int, List[Span]] = {}
+
+    def feed(self, span: Span) -> Optional[Tuple[Span, List[Span]]]:
+        if span.cat == 'play':
+            return span, self._pending.pop(span.pid, [])
+        if span.cat in self._categories:
+            self._pending.setdefault(span.pid, []).append(span)
+        return None
+
+    def finish(self, reader: SpanReader,
+               end: float) -> Iterator[Tuple[Optional[Span], List[Span]]]:
+        """Groups the spans left at the end of the trace. Plays still open
+        in an in-progress trace end at end. Task spans outside any play,
+        from older versions of the callback, are grouped with no play."""
+        for begin in reader.open_spans():
+            if begin.get('cat') == 'play':
+                yield (Span(name=begin['name'], cat='play', pid=begin['pid'],
+                            id=begin.get('id'), ts=begin['ts'], end=end,
+                            args=begin.get('args') or {}),
+                       self._pending.pop(begin['pid'], []))
+        for spans in self._pending.values():
+            yield None, spans
+        self._pending = {}
@@ -0,0 +1,258 @@
+"""
+Check that a trace written by the trace callback plugin is well formed.
+
+    python tools/trace_validate.py [--in-progress] TRACE [TRACE...]
+
+Checks the same rules as the integration tests: every event belongs to a
+process declared by process_name metadata, spans of a process nest without
+overlapping, each end event ends the last span begun with the same name and
+no earlier than it began, children begin no earlier than their parent, and
+task_args metadata is written before it is referred to. Async (b and e)
+events, which are on tracks of their own, only need to end after they begin.
+
+The trace is read one event at a time, keeping only the spans that are still
+open. Complete (X) events are written after their children, so those
+children are kept until their parent arrives, and outermost complete events
+are kept to check later ones don't overlap them: in compact traces, the
+spans of each host's current play, and a few numbers for each earlier play.
+"""
+import argparse
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from trace_reader import TraceError, iter_events
+
+
+class _Level:
+    """An open span of a process, or the process itself."""
+    __slots__ = ('id', 'name', 'ts', 'max_end', 'complete')
+
+    def __init__(self, id: Any = None, name: Optional[str] = None,
+                 ts: Optional[float] = None):
+        self.id = id
+        self.name = name
+        self.ts = ts
+        # Latest end of the spans that ended within this one.
+        self.max_end: Optional[float] = None
+        # (start, end, id) of the complete events directly within this span
+        # whose parent, if it's a complete event, hasn't arrived yet.
+        self.complete: List[Tuple[float, float, Any]] = []
+
+
+class TraceValidator:
+    """Validates a trace fed one event at a time, raising TraceError."""
+
+    def __init__(self):
+        self.events: int = 0
+        # Open spans of each process, outermost first, below the process.
+        self._levels: Dict[int, List[_Level]] = {}
+        # Begin timestamps of open async events, by (pid, id).
+        self._async: Dict[Tuple[int, Any], float] = {}
+        self._task_args_refs: set = set()
+
+    def feed(self, event: Dict[str, Any]):
+        self.events += 1
+        try:
+            self._feed(event)
+        except (KeyError, TypeError) as e:
+            raise TraceError('Event %d is missing %s: %r'
+                             % (self.events, e, event))
+        except TraceError as e:
+            raise TraceError('Event %d: %s' % (self.events, e))
+
+    def finish(self, in_progress: bool = False):
+        """Checks the end of the trace: every span must have ended, unless
+        the trace is still being written."""
+        if in_progress:
+            return
+        for pid, levels in self._levels.items():
+            if len(levels) > 1:
+                raise TraceError('Events %s of pid %s never ended' % (
+                    [level.id for level in levels[1:]], pid))
+        if self._async:
+            raise TraceError('Async events %s never ended'
+                             % [id for _, id in self._async])
+
+    def _feed(self, event: Dict[str, Any]):
+        ph = event.get('ph')
+        args = event.get('args') or {}
+        if ph == 'M':
+            if event.get('name') == 'task_args':
+                if args['ref'] in self._task_args_refs:
+                    raise TraceError('Task args %s already registered'
+                                     % args['ref'])
+                self._task_args_refs.add(args['ref'])
+            elif event.get('name') == 'process_name':
+                if 'name' not in args:
+                    raise TraceError('Host events needs to have name')
+                self._levels.setdefault(event['pid'], [_Level()])
+            return
+        if ph in ('B', 'E', 'X') and 'args_ref' in args \
+                and args['args_ref'] not in self._task_args_refs:
+            raise TraceError('Task args %s used before being registered'
+                             % args['args_ref'])
+        if ph == 'B':
+            self._begin(event)
+        elif ph == 'E':
+            self._end(event)
+        elif ph == 'X':
+            self._complete(event)
+        elif ph == 'C':
+            self._process(event)
+            if 'ts' not in event or 'name' not in event:
+                raise TraceError('Counter event needs a name and a timestamp')
+            for key, value in args.items():
+                if not isinstance(value, (int, float)):
+                    raise TraceError('Counter %s %s is not a number'
+                                     % (event['name'], key))
+        elif ph == 'i':
+            self._process(event)
+            if 'ts' not in event:
+                raise TraceError('Instant event %s needs a timestamp'
+                                 % event.get('name'))
+        elif ph == 'b':
+            self._check_span(event)
+            self._process(event)
+            key = (event['pid'], event['id'])
+            if key in self._async:
+                raise TraceError('Async event %s already registered' % event['id'])
+            self._async[key] = event['ts']
+        elif ph == 'e':
+            self._check_span(event)
+            begin = self._async.pop((event['pid'], event['id']), None)
+            if begin is None:
+                raise TraceError('Async event %s is not registered' % event['id'])
+            if begin > event['ts']:
+                raise TraceError('Async event id %s timestamp %s is lower than '
+                                 'its begin event with timestamp %s'
+                                 % (event['id'], event['ts'], begin))
+        elif ph in ('s', 'f'):
+            self._process(event)
+            if 'ts' not in event or 'id' not in event:
+                raise TraceError('Flow event %s needs an id and a timestamp'
+                                 % event.get('name'))
+        else:
+            raise TraceError('Event cannot be handled: %r' % (event,))
+
+    def _process(self, event: Dict[str, Any]) -> List[_Level]:
+        levels = self._levels.get(event.get('pid'))
+        if levels is None:
+            raise TraceError('Event %s pid %s does not match any registered '
+                             'process' % (event.get('id'), event.get('pid')))
+        return levels
+
+    @staticmethod
+    def _check_span(event: Dict[str, Any]):
+        for key in ('id', 'ts', 'name'):
+            if key not in event:
+                raise TraceError('Span event %s needs to have %s'
+                                 % (event.get('id'), key))
+
+    def _begin(self, event: Dict[str, Any]):
+        self._check_span(event)
+        levels = self._process(event)
+        parent = levels[-1]
+        if any(level.id == event['id'] for level in levels[1:]):
+            raise TraceError('Event %s already registered' % event['id'])
+        if parent.ts is not None and parent.ts > event['ts']:
+            raise TraceError('Event id %s begin timestamp %s is before its '
+                             'parent id %s begin timestamp %s' % (
+                                 event['id'], event['ts'], parent.id, parent.ts))
+        levels.append(_Level(event['id'], event['name'], event['ts']))
+
+    def _end(self, event: Dict[str, Any]):
+        self._check_span(event)
+        levels = self._process(event)
+        level = levels[-1]
+        if len(levels) == 1 or level.id != event['id']:
+            if any(open_level.id == event['id'] for open_level in levels[1:]):
+                raise TraceError('Cannot end event id %s if I have child that '
+                                 'are not yet ended (id %s ongoing)'
+                                 % (event['id'], level.id))
+            raise TraceError('Event %s is not registered' % event['id'])
+        if level.ts > event['ts']:
+            raise TraceError('Event id %s timestamp %s is lower than its begin '
+                             'event with timestamp %s'
+                             % (event['id'], event['ts'], level.ts))
+        if level.name != event['name']:
+            raise TraceError('Event id %s with name %s does not have the same '
+                             'name as event B %s'
+                             % (event['id'], event['name'], level.name))
+        if level.max_end is not None and level.max_end > event['ts']:
+            raise TraceError('Event id %s of pid %s ends at %s before its '
+                             'children ending at %s' % (
+                                 event['id'], event['pid'], event['ts'],
+                                 level.max_end))
+        levels.pop()
+        self._ended(levels[-1], event['ts'])
+
+    def _complete(self, event: Dict[str, Any]):
+        self._check_span(event)
+        levels = self._process(event)
+        if event.get('dur', -1) < 0:
+            raise TraceError('Complete event %s needs to have a positive '
+                             'duration' % event['id'])
+        parent = levels[-1]
+        start, end = event['ts'], event['ts'] + event['dur']
+        if parent.ts is not None and parent.ts > start:
+            raise TraceError('Event id %s begin timestamp %s is before its '
+                             'parent id %s begin timestamp %s' % (
+                                 event['id'], start, parent.id, parent.ts))
+        # Complete events that arrived earlier are either within this one,
+        # and are its children, or before or after it. They're kept in order
+        # of their end, and usually end before this one starts.
+        complete = parent.complete
+        i = len(complete)
+        while i and complete[i - 1][1] > start:
+            i -= 1
+        after = []
+        for child in complete[i:]:
+            if start <= child[0] and child[1] <= end:
+                continue
+            if child[0] < end:
+                raise TraceError('Event id %s of pid %s overlaps event id %s '
+                                 'without nesting' % (event['id'],
+                                                      event['pid'], child[2]))
+            after.append(child)
+        del complete[i:]
+        complete.append((start, end, event['id']))
+        complete.extend(after)
+        self._ended(parent, end)
+
+    @staticmethod
+    def _ended(parent: _Level, end: float):
+        if parent.max_end is None or end > parent.max_end:
+            parent.max_end = end
+
+
+def validate(events: Iterable[Dict[str, Any]], in_progress: bool = False) -> int:
+    """Validates a stream of events, returning how many there were."""
+    validator = TraceValidator()
+    for event in events:
+        validator.feed(event)
+    validator.finish(in_progress)
+    return validator.events
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('traces', nargs='+', metavar='trace',
+                        help='JSON trace, optionally gzip or zstd compressed')
+    parser.add_argument('--in-progress', action='store_true',
+                        help="allow spans that haven't ended yet")
+    args = parser.parse_args(argv)
+
+    status = 0
+    for path in args.traces:
+        try:
+            events = validate(iter_events(path), args.in_progress)
+        except TraceError as e:
+            print('%s: %s' % (path, e), file=sys.stderr)
+            status = 1
+        else:
+            print('%s: %d events ok' % (path, events))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))